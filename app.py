@@ -4,6 +4,7 @@ from fastapi import FastAPI, Response
 from fastapi.responses import FileResponse
 import uvicorn
 import os
+import multiprocessing
 from scripts.iib.api import infinite_image_browsing_api, index_html_path, DEFAULT_BASE
 from scripts.iib.tool import (
     get_sd_webui_conf,
@@ -11,7 +12,7 @@ from scripts.iib.tool import (
     sd_img_dirs,
     normalize_paths,
 )
-from scripts.iib.db.datamodel import DataBase, Image, ExtraPath
+from scripts.iib.db.datamodel import DataBase, Image, ExtraPath, ImageFts
 from scripts.iib.db.update_image_data import update_image_data
 import argparse
 from typing import Optional, Coroutine
@@ -239,6 +240,16 @@ def setup_parser() -> argparse.ArgumentParser:
         action="store_true",
         help="Export front-end functions to enable external access through iframe.",
     )
+    parser.add_argument(
+        "--rebuild_fts_index",
+        action="store_true",
+        help="Build the full-text index used by substring search. Only needed once for databases created by older versions.",
+    )
+    parser.add_argument(
+        "--migrate_cache_layout",
+        action="store_true",
+        help="Move a thumbnail/video cover cache created by older versions to the sharded layout. Stop IIB before running it.",
+    )
     parser.add_argument("--base", type=str, help="The base URL for the IIB Api.")
     return parser
 
@@ -274,6 +285,8 @@ async def async_launch_app(
 
 
 if __name__ == "__main__":
+    # 打包后的 exe 启动工作进程时需要
+    multiprocessing.freeze_support()
     parser = setup_parser()
     args = parser.parse_args()
     args_dict = vars(args)
@@ -287,6 +300,16 @@ if __name__ == "__main__":
             verbose=args.gen_cache_verbose,
         )
         exit(0)
+    if args_dict.get("rebuild_fts_index"):
+        ImageFts.rebuild(DataBase.get_conn())
+        print("rebuild full-text index completed. ✨")
+        exit(0)
+    if args_dict.get("migrate_cache_layout"):
+        from scripts.iib.cache_manager import migrate_cache_layout
+
+        moved = migrate_cache_layout(verbose=args.gen_cache_verbose)
+        print(f"Moved {moved} cache files to the sharded layout. ✨")
+        exit(0)
     if args_dict.get("generate_image_cache"):
         from scripts.iib.img_cache_gen import generate_image_cache
         generate_image_cache(
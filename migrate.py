@@ -77,6 +77,7 @@ if __name__ == "__main__":
     conn = DataBase.get_conn()
     conn.create_function("replace_path", 1, replace_path(old_base, new_base))
     update_paths(conn, "image", old_base)
+    update_paths(conn, "dir", old_base)
     update_paths(conn, "extra_path", old_base)
     update_paths(conn, "folders", old_base)
     shutil.copy(db_temp_path, "iib.db")
@@ -5,6 +5,8 @@ import os
 from pathlib import Path
 import shutil
 import sqlite3
+import json
+import struct
 
 from scripts.iib.dir_cover_cache import get_top_4_media_info
 from scripts.iib.tool import (
@@ -28,6 +30,7 @@ from scripts.iib.tool import (
     create_zip_file,
     normalize_paths,
     to_abs_path,
+    PathTrie,
     is_secret_key_required,
     open_file_with_default_app,
     is_exe_ver,
@@ -40,7 +43,7 @@ from scripts.iib.tool import (
 from fastapi import FastAPI, HTTPException, Header, Response
 from fastapi.staticfiles import StaticFiles
 import asyncio
-from typing import List, Optional
+from typing import Dict, List, Optional
 from pydantic import BaseModel
 from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from PIL import Image
@@ -59,14 +62,33 @@ from scripts.iib.db.datamodel import (
     FileInfoDict,
     Cursor, 
     GlobalSetting,
+    VideoMeta,
 )
 from scripts.iib.db.update_image_data import update_image_data, rebuild_image_index, add_image_data_single
+from scripts.iib.fs_watcher import start_fs_watcher
+from scripts.iib.thumbnail import atomic_write, probe_video, thumbnail_pool
+from scripts.iib.blob_store import blob_store, is_blob_backend_enabled
+from scripts.iib.cache_manager import (
+    cache_manager,
+    get_thumbnail_blob_key,
+    get_thumbnail_cache_path,
+    get_video_cover_cache_path,
+    has_legacy_cache_layout,
+)
 from scripts.iib.topic_cluster import mount_topic_cluster_routes
 from scripts.iib.tag_graph import mount_tag_graph_routes
 from scripts.iib.logger import logger
 from scripts.iib.seq import seq
 import urllib.parse
 from scripts.iib.fastapi_video import range_requests_response, close_video_file_reader
+from scripts.iib.dir_listing import (
+    dir_listing_cache,
+    iter_dir_chunks,
+    list_dir_page,
+    parse_sort,
+    scan_dir,
+    to_file_info,
+)
 from scripts.iib.parsers.index import parse_image_info
 import scripts.iib.plugin
 
@@ -87,7 +109,7 @@ index_html_path = get_data_file_path("vue/dist/index.html") if is_exe_ver else o
 
 
 send_img_path = {"value": ""}
-mem = {"secret_key_hash": None, "extra_paths": [], "all_scanned_paths": []}
+mem = {"secret_key_hash": None, "extra_paths": [], "all_scanned_paths": [], "all_scanned_paths_trie": PathTrie([])}
 secret_key = os.getenv("IIB_SECRET_KEY")
 if secret_key:
     print("Secret key loaded successfully. ")
@@ -226,6 +248,7 @@ def infinite_image_browsing_api(app: FastAPI, **kwargs):
                 + kwargs.get("extra_paths_cli", [])
             )
         mem["all_scanned_paths"] = unique_by(paths)
+        mem["all_scanned_paths_trie"] = PathTrie(mem["all_scanned_paths"])
 
     update_all_scanned_paths()
 
@@ -234,6 +257,24 @@ def infinite_image_browsing_api(app: FastAPI, **kwargs):
         mem["extra_paths"] = [x.path for x in r]
         update_all_scanned_paths()
 
+    def get_fs_watcher_dirs():
+        # 与 /db/update_image_data 的扫描范围保持一致
+        conn = DataBase.get_conn()
+        try:
+            return get_img_search_dirs() + [x.path for x in ExtraPath.get_extra_paths(conn)]
+        finally:
+            conn.commit()
+
+    watcher = start_fs_watcher(get_fs_watcher_dirs)
+    if watcher:
+        watcher.add_listener(dir_listing_cache.on_fs_event)
+    cache_manager.start()
+    if has_legacy_cache_layout():
+        logger.warning(
+            "The cache folder uses the old one-folder-per-image layout, "
+            "stop IIB and run `python app.py --migrate_cache_layout` to move it to the sharded one."
+        )
+
     def safe_commonpath(seq):
         try:
             return os.path.commonpath(seq)
@@ -250,7 +291,7 @@ def infinite_image_browsing_api(app: FastAPI, **kwargs):
         """
         try:
             if not parent_paths:
-                parent_paths = mem["all_scanned_paths"]
+                return mem["all_scanned_paths_trie"].is_under(path)
             path = to_abs_path(path)
             for parent_path in parent_paths:
                 if safe_commonpath([path, parent_path]) == parent_path:
@@ -263,15 +304,8 @@ def infinite_image_browsing_api(app: FastAPI, **kwargs):
         if not enable_access_control:
             return True
         try:
-            parent_paths = mem["all_scanned_paths"]
-            path = to_abs_path(path)
-            for parent_path in parent_paths:
-                if len(path) <= len(parent_path):
-                    if parent_path.startswith(path):
-                        return True
-                else:
-                    if path.startswith(parent_path):
-                        return True
+            # 允许的目录本身、其中的文件以及它们的上级目录(用于导航)
+            return mem["all_scanned_paths_trie"].is_related(path)
         except:
             pass
         return False
@@ -281,7 +315,22 @@ def infinite_image_browsing_api(app: FastAPI, **kwargs):
             raise HTTPException(status_code=403)
 
     def filter_allowed_files(files: List[FileInfoDict]):
-        return [x for x in files if is_path_trusted(x["fullpath"])]
+        if not enable_access_control:
+            return files
+        trie: PathTrie = mem["all_scanned_paths_trie"]
+        # 同一个文件夹只检查一次：在允许的目录之内时其中的文件都允许，无关的文件夹中的文件都不允许，
+        # 只有允许的目录的上级目录中的文件需要单独检查
+        dir_matches: Dict[str, Optional[bool]] = {}
+        res = []
+        for x in files:
+            parent = os.path.dirname(x["fullpath"])
+            if parent in dir_matches:
+                match = dir_matches[parent]
+            else:
+                match = dir_matches[parent] = trie.match(parent)
+            if match or (match is False and trie.is_related(x["fullpath"])):
+                res.append(x)
+        return res
 
 
 
@@ -545,7 +594,20 @@ def infinite_image_browsing_api(app: FastAPI, **kwargs):
         return {"errors": errors}
 
     @app.get(api_base + "/files", dependencies=[Depends(verify_secret)])
-    async def get_target_folder_files(folder_path: str):
+    async def get_target_folder_files(
+        folder_path: str,
+        sort: Optional[str] = None,
+        limit: Optional[int] = None,
+        cursor: str = "",
+        stream: bool = False,
+    ):
+        """
+        Without limit and stream the whole folder is returned at once.
+        limit: returns a page sorted by sort (the frontend's SortMethod except shuffle, default name-asc),
+            pass cursor.next to get the next one.
+        stream: returns NDJSON, one file per line, sorted by sort if given, otherwise in directory order
+            as the folder is being read. If reading fails partway the last line is {"error": message}.
+        """
         files: List[FileInfoDict] = []
         try:
             if is_win and folder_path == "/":
@@ -553,54 +615,57 @@ def infinite_image_browsing_api(app: FastAPI, **kwargs):
                     files.append(
                         {"type": "dir", "size": "-", "name": item, "fullpath": item}
                     )
+                if stream:
+                    return StreamingResponse(
+                        iter([json.dumps(f) + "\n" for f in files]), media_type="application/x-ndjson"
+                    )
+                if limit is not None:
+                    return {"files": files, "cursor": Cursor(has_next=False)}
             else:
                 if not os.path.exists(folder_path):
+                    if stream:
+                        return StreamingResponse(iter([]), media_type="application/x-ndjson")
+                    if limit is not None:
+                        return {"files": [], "cursor": Cursor(has_next=False)}
                     return {"files": []}
                 folder_path = to_abs_path(folder_path)
                 check_path_trust(folder_path)
-                folder_listing: List[os.DirEntry] = os.scandir(folder_path)
                 is_under_scanned_path = is_path_under_parents(folder_path)
-                for item in folder_listing:
-                    if not os.path.exists(item.path):
-                        continue
-                    fullpath = os.path.normpath(item.path)
-                    name = os.path.basename(item.path)
-                    stat = item.stat()
-                    date = get_formatted_date(stat.st_mtime)
-                    created_time = get_created_date_by_stat(stat)
-                    if item.is_file():
-                        bytes = stat.st_size
-                        size = human_readable_size(bytes)
-                        files.append(
-                            {
-                                "type": "file",
-                                "date": date,
-                                "size": size,
-                                "name": name,
-                                "bytes": bytes,
-                                "created_time": created_time,
-                                "fullpath": fullpath,
-                                "is_under_scanned_path": is_under_scanned_path,
-                            }
-                        )
-                    elif item.is_dir():
-                        files.append(
-                            {
-                                "type": "dir",
-                                "date": date,
-                                "created_time": created_time,
-                                "size": "-",
-                                "name": name,
-                                "is_under_scanned_path": is_under_scanned_path,
-                                "fullpath": fullpath,
-                            }
-                        )
+                if sort:
+                    parse_sort(sort)
+                if stream:
+                    return StreamingResponse(
+                        stream_folder_files(folder_path, sort, is_under_scanned_path),
+                        media_type="application/x-ndjson",
+                    )
+                if limit is not None:
+                    if limit <= 0:
+                        raise ValueError("limit must be positive")
+                    entries, next_cursor = await asyncio.to_thread(
+                        list_dir_page, folder_path, sort or "name-asc", cursor, limit
+                    )
+                    files = [to_file_info(folder_path, e, is_under_scanned_path) for e in entries]
+                    return JSONResponse({"files": filter_allowed_files(files), "cursor": vars(next_cursor)})
+                entries = await asyncio.to_thread(scan_dir, folder_path)
+                files = [to_file_info(folder_path, e, is_under_scanned_path) for e in entries]
+                # 只有普通的 dict，跳过 jsonable_encoder，大文件夹的大部分时间都花在它上面
+                return JSONResponse({"files": filter_allowed_files(files)})
         except Exception as e:
             # logger.error(e)
             raise HTTPException(status_code=400, detail=str(e))
 
         return {"files": filter_allowed_files(files)}
-    
+
+    def stream_folder_files(folder_path: str, sort: Optional[str], is_under_scanned_path: bool):
+        # 同步生成器由 starlette 在线程池中迭代，每次产出一批
+        try:
+            for entries in iter_dir_chunks(folder_path, sort):
+                files = [to_file_info(folder_path, e, is_under_scanned_path) for e in entries]
+                yield "".join(json.dumps(f) + "\n" for f in filter_allowed_files(files))
+        except Exception as e:
+            logger.error("Failed to list %s: %s", folder_path, e)
+            # 响应头已经发出，只能用最后一行告诉客户端列表不完整
+            yield json.dumps({"error": str(e)}) + "\n"
 
     @app.post(api_base + "/batch_get_files_info", dependencies=[Depends(verify_secret)])
     async def batch_get_files_info(req: PathsReq):
@@ -610,19 +675,49 @@ def infinite_image_browsing_api(app: FastAPI, **kwargs):
             res[path] = get_file_info_by_path(path)
         return res
 
+    async def load_blob_thumbnail(path: str, t: str, size: str):
+        """
+        IIB_THUMBNAIL_BACKEND=blob, returns (etag, webp bytes).
+        The bytes are None for images under 64KB, which are returned as they are.
+        """
+        etag, key = get_thumbnail_blob_key(path, t, size)
+        entry_path = blob_store.get_entry_path(key)
+        data = await asyncio.to_thread(blob_store.get, key)
+        if data is not None:
+            cache_manager.hit(entry_path)
+            return etag, data
+        if os.path.getsize(path) < 64 * 1024:
+            return etag, None
+        await thumbnail_pool.generate_blob(path, key, size, lambda: cache_manager.add(entry_path, path, t))
+        data = await asyncio.to_thread(blob_store.get, key)
+        if data is None:
+            raise HTTPException(status_code=500, detail=f"Failed to generate thumbnail for {path}")
+        return etag, data
+
     @app.get(api_base + "/image-thumbnail", dependencies=[Depends(verify_secret)])
     async def thumbnail(path: str, t: str, size: str = "256x256"):
         check_path_trust(path)
         if not cache_base_dir:
             return
+        if is_blob_backend_enabled():
+            hash, data = await load_blob_thumbnail(path, t, size)
+            if data is None:
+                return FileResponse(
+                    path,
+                    media_type="image/" + path.split(".")[-1],
+                    headers={"Cache-Control": "max-age=31536000", "ETag": hash},
+                )
+            return Response(
+                content=data,
+                media_type="image/webp",
+                headers={"Cache-Control": "max-age=31536000", "ETag": hash},
+            )
         # 生成缓存文件的路径
-        hash_dir = hashlib.md5((path + t).encode("utf-8")).hexdigest()
-        hash = hash_dir + size
-        cache_dir = os.path.join(cache_base_dir, "iib_cache", hash_dir)
-        cache_path = os.path.join(cache_dir, f"{size}.webp")
+        hash, cache_path = get_thumbnail_cache_path(path, t, size)
 
         # 如果缓存文件存在，则直接返回该文件
         if os.path.exists(cache_path):
+            cache_manager.hit(cache_path)
             return FileResponse(
                 cache_path,
                 media_type="image/webp",
@@ -639,13 +734,8 @@ def infinite_image_browsing_api(app: FastAPI, **kwargs):
             )
         
 
-        # 如果缓存文件不存在，则生成缩略图并保存
-        with Image.open(path) as img:
-            w, h = size.split("x")
-            img.thumbnail((int(w), int(h)))
-            os.makedirs(cache_dir, exist_ok=True)
-            img.save(cache_path, "webp")
-            # print(f"Image cache generated: {path}")
+        # 如果缓存文件不存在，则在进程池中生成缩略图并保存，不阻塞事件循环
+        await thumbnail_pool.generate(path, cache_path, size, lambda: cache_manager.add(cache_path, path, t))
 
         # 返回缓存文件
         return FileResponse(
@@ -654,6 +744,81 @@ def infinite_image_browsing_api(app: FastAPI, **kwargs):
             headers={"Cache-Control": "max-age=31536000", "ETag": hash},
         )
 
+    class ThumbnailBatchItem(BaseModel):
+        path: str
+        t: str
+
+    class ThumbnailBatchReq(BaseModel):
+        items: List[ThumbnailBatchItem]
+        size: str = "256x256"
+
+    thumbnail_batch_max_items = 1000
+
+    def pack_thumbnail_frame(index: int, status: int, body=b"", media_type: Optional[str] = None, etag: Optional[str] = None):
+        header = json.dumps(
+            {"index": index, "status": status, "media_type": media_type, "etag": etag}
+        ).encode("utf-8")
+        return struct.pack(">II", len(header), len(body)) + header + body
+
+    def read_file_bytes(path: str):
+        with open(path, "rb") as f:
+            return f.read()
+
+    @app.post(api_base + "/image-thumbnails/batch", dependencies=[Depends(verify_secret)])
+    async def thumbnail_batch(req: ThumbnailBatchReq):
+        """
+        Returns the thumbnails of a whole page in one response, a stream of frames:
+        [uint32 header length][uint32 body length][header json][body], big endian.
+        The header is {"index", "status", "media_type", "etag"}, index refers to req.items.
+        Cache hits are sent first and misses as soon as they are generated, so frames are not in request order.
+        """
+        if not cache_base_dir:
+            return
+        if len(req.items) > thumbnail_batch_max_items:
+            raise HTTPException(status_code=400, detail=f"At most {thumbnail_batch_max_items} items per request")
+
+        async def load(index: int, item: ThumbnailBatchItem):
+            try:
+                check_path_trust(item.path)
+                if is_blob_backend_enabled():
+                    etag, body = await load_blob_thumbnail(item.path, item.t, req.size)
+                    if body is not None:
+                        return pack_thumbnail_frame(index, 200, body, "image/webp", etag)
+                    body = await asyncio.to_thread(read_file_bytes, item.path)
+                    return pack_thumbnail_frame(index, 200, body, "image/" + item.path.split(".")[-1], etag)
+                etag, cache_path = get_thumbnail_cache_path(item.path, item.t, req.size)
+                if os.path.exists(cache_path):
+                    cache_manager.hit(cache_path)
+                elif os.path.getsize(item.path) < 64 * 1024:
+                    # 与单张接口一致，小图直接返回原图
+                    body = await asyncio.to_thread(read_file_bytes, item.path)
+                    return pack_thumbnail_frame(index, 200, body, "image/" + item.path.split(".")[-1], etag)
+                else:
+                    await thumbnail_pool.generate(
+                        item.path, cache_path, req.size, lambda: cache_manager.add(cache_path, item.path, item.t)
+                    )
+                body = await asyncio.to_thread(read_file_bytes, cache_path)
+                return pack_thumbnail_frame(index, 200, body, "image/webp", etag)
+            except HTTPException as e:
+                return pack_thumbnail_frame(index, e.status_code)
+            except FileNotFoundError:
+                return pack_thumbnail_frame(index, 404)
+            except Exception as e:
+                logger.error("Failed to generate thumbnail for %s: %s", item.path, e)
+                return pack_thumbnail_frame(index, 500)
+
+        async def stream():
+            tasks = [asyncio.ensure_future(load(i, item)) for i, item in enumerate(req.items)]
+            try:
+                for task in asyncio.as_completed(tasks):
+                    yield await task
+            finally:
+                # 客户端断开时不再读取剩余的缓存，已经开始生成的缩略图仍会完成并写入缓存
+                for task in tasks:
+                    task.cancel()
+
+        return StreamingResponse(stream(), media_type="application/octet-stream")
+
     @app.get(api_base + "/file", dependencies=[Depends(verify_secret)])
     async def get_file(path: str, t: str, disposition: Optional[str] = None):
         filename = path
@@ -696,6 +861,30 @@ def infinite_image_browsing_api(app: FastAPI, **kwargs):
             request, file_path=path, content_type=media_type
         )
 
+    def save_video_meta(path: str, mt: str, meta: Dict):
+        try:
+            VideoMeta.save(DataBase.get_conn(), path, mt, meta)
+        except Exception as e:
+            logger.error("Failed to save video meta for %s: %s", path, e)
+
+    @app.get(api_base + "/video_meta", dependencies=[Depends(verify_secret)])
+    async def video_meta(path: str, mt: str):
+        """
+        Duration, resolution and codec of a video, from the index if it was probed before.
+        """
+        check_path_trust(path)
+        meta = VideoMeta.get_by_path(DataBase.get_conn(), path, mt)
+        if meta:
+            return meta
+        if not os.path.isfile(path):
+            raise HTTPException(status_code=404)
+        try:
+            meta = await asyncio.to_thread(probe_video, path)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Failed to read video meta: {e}")
+        save_video_meta(path, mt, meta)
+        return meta
+
     @app.get(api_base + "/video_cover", dependencies=[Depends(verify_secret)])
     async def video_cover(path: str, mt: str):        
         check_path_trust(path)
@@ -707,12 +896,10 @@ def infinite_image_browsing_api(app: FastAPI, **kwargs):
         if not os.path.isfile(path) and get_video_type(path):
             raise HTTPException(status_code=400, detail=f"{path} is not a video file")
         # 生成缓存文件的路径
-        hash_dir = hashlib.md5((path + mt).encode("utf-8")).hexdigest()
-        hash = hash_dir
-        cache_dir = os.path.join(cache_base_dir, "iib_cache", "video_cover", hash_dir)
-        cache_path = os.path.join(cache_dir, "cover.webp")
+        hash, cache_path = get_video_cover_cache_path(path, mt)
         # 如果缓存文件存在，则直接返回该文件
         if os.path.exists(cache_path):
+            cache_manager.hit(cache_path)
             return FileResponse(
                 cache_path,
                 media_type="image/webp",
@@ -724,29 +911,25 @@ def infinite_image_browsing_api(app: FastAPI, **kwargs):
             raise HTTPException(status_code=400, detail=f"{path} is not a video file")
         # 如果缓存文件不存在，则生成缩略图并保存
         try:
-            import imageio.v3 as iio
             logger.info(
                 "Generating video cover thumbnail: path=%s, mt=%s, cache_path=%s",
                 path,
                 mt,
                 cache_path,
             )
-            frame = iio.imread(
-                path,
-                index=16,
-                plugin="pyav",
+            meta = await thumbnail_pool.generate_video_cover(
+                path, cache_path, lambda: cache_manager.add(cache_path, path, mt)
             )
-
-            os.makedirs(cache_dir, exist_ok=True)
-            iio.imwrite(cache_path, frame, extension=".webp")
             logger.info("Saved video cover thumbnail: %s", cache_path)
+            if meta:
+                save_video_meta(path, mt, meta)
         except Exception as e:
             # record full stack trace and contextual info in English
             logger.exception(
-                "Failed to generate video cover for path=%s mt=%s cache_dir=%s: %s",
+                "Failed to generate video cover for path=%s mt=%s cache_path=%s: %s",
                 path,
                 mt,
-                cache_dir,
+                cache_path,
                 e,
             )
             # return a clear HTTP error (detail contains exception message)
@@ -770,25 +953,28 @@ def infinite_image_browsing_api(app: FastAPI, **kwargs):
         if base64_str.startswith('data:image'):
             base64_str = base64_str.split(',')[1]
         image_data = base64.b64decode(base64_str)
-        with open(file_path, 'wb') as file:
-            file.write(image_data)
+
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as file:
+                file.write(image_data)
+
+        atomic_write(file_path, write)
 
     @app.post(api_base+ "/set_target_frame_as_video_cover", dependencies=[Depends(verify_secret), Depends(write_permission_required)])
     async def set_target_frame_as_video_cover(req: SetTargetFrameAsCoverReq):
-        hash_dir = hashlib.md5((req.path + req.updated_time).encode("utf-8")).hexdigest()
-        hash = hash_dir
-        cache_dir = os.path.join(cache_base_dir, "iib_cache", "video_cover", hash_dir)
-        cache_path = os.path.join(cache_dir, "cover.webp")
-
-        os.makedirs(cache_dir, exist_ok=True)
-        
+        hash, cache_path = get_video_cover_cache_path(req.path, req.updated_time)
         save_base64_image(req.base64_img, cache_path)
+        cache_manager.add(cache_path, req.path, req.updated_time, miss=False)
         return FileResponse(
             cache_path,
             media_type="image/webp",
             headers={"ETag": hash},
         )
 
+    @app.get(api_base + "/cache/stats", dependencies=[Depends(verify_secret)])
+    async def cache_stats():
+        return cache_manager.get_stats()
+
     @app.post(api_base + "/send_img_path", dependencies=[Depends(verify_secret)])
     async def api_set_send_img_path(path: str):
         send_img_path["value"] = path
@@ -1,6 +1,6 @@
 from typing import List, Dict, Any, Optional
 import re
-from scripts.iib.db.datamodel import GlobalSetting, Tag, ImageTag, DataBase
+from scripts.iib.db.datamodel import GlobalSetting, TagCache, ImageTag, DataBase
 from scripts.iib.logger import logger
 from scripts.iib.parsers.model import ImageGenerationParams
 
@@ -86,17 +86,24 @@ class AutoTagMatcher:
             
         return True
 
-    def apply(self, img_id: int, params: Any):
+    def match_tag_ids(self, params: Any, tag_cache: Optional[TagCache] = None) -> List[int]:
+        """返回命中规则的自定义标签 id，不写入 image_tag"""
         if not self.rules:
-            return
-            
+            return []
+        tag_cache = tag_cache or TagCache(self.conn, preload=False)
+        tag_ids = []
         for rule in self.rules:
             try:
                 if self.match(params, rule):
                     tag_name = rule.get("tag")
                     if tag_name:
-                        tag = Tag.get_or_create(self.conn, tag_name, "custom")
-                        if tag:
-                            ImageTag(img_id, tag.id).save_or_ignore(self.conn)
+                        tag_id = tag_cache.get_or_create(tag_name, "custom")
+                        if tag_id is not None:
+                            tag_ids.append(tag_id)
             except Exception as e:
                 logger.error(f"Error applying auto tag rule {rule}: {e}")
+        return tag_ids
+
+    def apply(self, img_id: int, params: Any, tag_cache: Optional[TagCache] = None):
+        for tag_id in self.match_tag_ids(params, tag_cache):
+            ImageTag(img_id, tag_id).save_or_ignore(self.conn)
@@ -0,0 +1,253 @@
+"""
+Optional thumbnail storage that appends thumbnails to large segment files instead of writing one
+small file per thumbnail, enabled with IIB_THUMBNAIL_BACKEND=blob.
+
+- iib_cache/blob/<id>.seg: segment files, only ever appended to. Every process that writes
+  thumbnails (the server, --generate_image_cache) appends to a segment it created itself.
+- iib_cache/blob/index.db: key -> (segment, offset, length).
+- Thumbnails are read through a read-only mmap of the segment.
+- Removed thumbnails leave dead space behind, segments that are mostly dead are compacted by
+  copying their live thumbnails to the current segment and deleting them.
+"""
+import mmap
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from typing import BinaryIO, Dict, Optional, Tuple
+
+from scripts.iib.logger import logger
+from scripts.iib.tool import get_cache_dir
+
+
+def is_blob_backend_enabled():
+    return os.getenv("IIB_THUMBNAIL_BACKEND", "file").lower() == "blob"
+
+
+class BlobStore:
+    segment_max_size = 256 * 1024 * 1024
+    # 累计删除这么多数据后才检查是否需要压缩
+    compact_threshold = 64 * 1024 * 1024
+    # 存活数据少于一半的段才压缩
+    compact_max_live_ratio = 0.5
+    # 最近还在写入的段可能属于其他进程，不压缩
+    compact_min_idle_seconds = 600
+    # 压缩时每批移动的缩略图数量，批与批之间释放锁，读取不会被长时间阻塞
+    compact_batch_rows = 200
+
+    def __init__(self, root: str):
+        self.root = root
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        self.maps: Dict[int, mmap.mmap] = {}
+        self.active_id: Optional[int] = None
+        self.active_file: Optional[BinaryIO] = None
+        self.active_size = 0
+        # 第一次检查时根据段文件大小计算，之后累加删除的数据
+        self.dead_bytes: Optional[int] = None
+
+    def get_conn(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            os.makedirs(self.root, exist_ok=True)
+            conn = sqlite3.connect(os.path.join(self.root, "index.db"), timeout=30)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS blob (
+                        key TEXT PRIMARY KEY,
+                        segment INTEGER,
+                        offset INTEGER,
+                        length INTEGER
+                    )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS blob_idx_segment ON blob(segment)")
+            conn.commit()
+            self.local.conn = conn
+        return conn
+
+    def get_entry_path(self, key: str):
+        """
+        Path used to record the thumbnail in the cache index, there is no such file.
+        """
+        return os.path.join(self.root, key)
+
+    def get_segment_path(self, segment: int):
+        return os.path.join(self.root, f"{segment:06d}.seg")
+
+    def get_segment_ids(self):
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[:-4]) for name in names if name.endswith(".seg") and name[:-4].isdigit())
+
+    def open_new_segment(self):
+        if self.active_file:
+            self.active_file.close()
+        os.makedirs(self.root, exist_ok=True)
+        segment = max(self.get_segment_ids(), default=0) + 1
+        while True:
+            try:
+                # 独占创建，其他进程不会写入同一个段
+                self.active_file = open(self.get_segment_path(segment), "xb")
+                break
+            except FileExistsError:
+                segment += 1
+        self.active_id = segment
+        self.active_size = 0
+
+    def append(self, data: bytes) -> Tuple[int, int]:
+        if self.active_file is None or self.active_size + len(data) > self.segment_max_size:
+            self.open_new_segment()
+        offset = self.active_size
+        self.active_file.write(data)
+        self.active_file.flush()
+        self.active_size += len(data)
+        return self.active_id, offset
+
+    def lookup(self, key: str) -> Optional[Tuple[int, int, int]]:
+        with closing(self.get_conn().cursor()) as cur:
+            cur.execute("SELECT segment, offset, length FROM blob WHERE key = ?", (key,))
+            return cur.fetchone()
+
+    def contains(self, key: str):
+        return self.lookup(key) is not None
+
+    def get_length(self, key: str) -> Optional[int]:
+        row = self.lookup(key)
+        return row[2] if row else None
+
+    def get_map(self, segment: int, end: int) -> mmap.mmap:
+        mm = self.maps.get(segment)
+        if mm is None or len(mm) < end:
+            # 段还在追加，映射的长度不够时重新映射
+            if mm is not None:
+                mm.close()
+            with open(self.get_segment_path(segment), "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = mm
+        return mm
+
+    def close_map(self, segment: int):
+        mm = self.maps.pop(segment, None)
+        if mm is not None:
+            mm.close()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self.lock:
+            row = self.lookup(key)
+            if row is None:
+                return None
+            segment, offset, length = row
+            try:
+                return self.get_map(segment, offset + length)[offset : offset + length]
+            except (OSError, ValueError) as e:
+                logger.error("failed to read thumbnail %s from segment %s: %s", key, segment, e)
+                return None
+
+    def put(self, key: str, data: bytes):
+        with self.lock:
+            conn = self.get_conn()
+            old = self.lookup(key)
+            segment, offset = self.append(data)
+            conn.execute(
+                "INSERT OR REPLACE INTO blob VALUES (?, ?, ?, ?)",
+                (key, segment, offset, len(data)),
+            )
+            conn.commit()
+            if old:
+                self.add_dead_bytes(old[2])
+
+    def delete(self, key: str):
+        with self.lock:
+            conn = self.get_conn()
+            row = self.lookup(key)
+            if row is None:
+                return
+            conn.execute("DELETE FROM blob WHERE key = ?", (key,))
+            conn.commit()
+            self.add_dead_bytes(row[2])
+
+    def add_dead_bytes(self, size: int):
+        if self.dead_bytes is not None:
+            self.dead_bytes += size
+
+    def get_live_sizes(self) -> Dict[int, int]:
+        with closing(self.get_conn().cursor()) as cur:
+            cur.execute("SELECT segment, SUM(length) FROM blob GROUP BY segment")
+            return dict(cur.fetchall())
+
+    def load_dead_bytes(self) -> int:
+        """
+        Dead space left by earlier runs: the size of each segment minus its live thumbnails.
+        """
+        segment_ids = self.get_segment_ids()
+        if not segment_ids:
+            return 0
+        live_sizes = self.get_live_sizes()
+        dead = 0
+        for segment in segment_ids:
+            try:
+                size = os.path.getsize(self.get_segment_path(segment))
+            except FileNotFoundError:
+                continue
+            dead += max(size - live_sizes.get(segment, 0), 0)
+        return dead
+
+    def compact_if_needed(self):
+        if self.dead_bytes is None:
+            self.dead_bytes = self.load_dead_bytes()
+        if self.dead_bytes >= self.compact_threshold:
+            self.compact()
+
+    def compact(self):
+        """
+        Copies the live thumbnails of mostly dead segments to the current one and deletes those segments.
+        """
+        self.dead_bytes = 0
+        conn = self.get_conn()
+        live_sizes = self.get_live_sizes()
+        for segment in self.get_segment_ids():
+            if segment == self.active_id:
+                continue
+            segment_path = self.get_segment_path(segment)
+            try:
+                stat = os.stat(segment_path)
+            except FileNotFoundError:
+                continue
+            if time.time() - stat.st_mtime < self.compact_min_idle_seconds:
+                continue
+            live = live_sizes.get(segment, 0)
+            if stat.st_size and live / stat.st_size > self.compact_max_live_ratio:
+                continue
+            while True:
+                with self.lock:
+                    with closing(conn.cursor()) as cur:
+                        cur.execute(
+                            "SELECT key, offset, length FROM blob WHERE segment = ? LIMIT ?",
+                            (segment, self.compact_batch_rows),
+                        )
+                        rows = cur.fetchall()
+                        if not rows:
+                            self.close_map(segment)
+                            os.remove(segment_path)
+                            break
+                        for key, offset, length in rows:
+                            data = self.get_map(segment, offset + length)[offset : offset + length]
+                            new_segment, new_offset = self.append(data)
+                            # 其他进程可能刚替换了这张缩略图，只更新仍指向旧位置的记录
+                            cur.execute(
+                                "UPDATE blob SET segment = ?, offset = ? WHERE key = ? AND segment = ? AND offset = ?",
+                                (new_segment, new_offset, key, segment, offset),
+                            )
+                    conn.commit()
+            logger.info(
+                "compacted thumbnail segment %s, moved %d bytes, freed %d bytes",
+                segment,
+                live,
+                stat.st_size - live,
+            )
+
+
+blob_store = BlobStore(os.path.join(get_cache_dir(), "iib_cache", "blob"))
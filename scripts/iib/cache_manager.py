@@ -0,0 +1,419 @@
+"""
+Keeps the iib_cache folder (thumbnails and video covers) under a size budget.
+
+Every cache file is recorded in a small sqlite index next to the cache (iib_cache/cache_index.db)
+with its size, the source file and the source date it was generated for, and the last time it was
+served. Hits and new files are buffered in memory and written by a background thread, which also:
+- removes entries whose source file is gone or has been modified since (a new entry with a new hash
+  is created for the new version, the old one would never be used again),
+- evicts the least recently used entries when the cache is larger than IIB_CACHE_MAX_BYTES.
+
+Cache files that existed before the index are imported once with their mtime as last access.
+
+Files are sharded by the first 4 hex digits of their hash, iib_cache/ab/cd/<hash>_<size>.webp and
+iib_cache/video_cover/ab/cd/<hash>.webp. The old layout with one folder per image put millions of
+folders into iib_cache, `python app.py --migrate_cache_layout` moves such a cache to the new one.
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from typing import Dict, Optional, Tuple
+
+from scripts.iib.blob_store import blob_store
+from scripts.iib.logger import logger
+from scripts.iib.tool import get_cache_dir, get_modified_date
+
+
+def parse_size(value: str) -> int:
+    """
+    "1073741824", "500M", "10G" -> bytes
+    """
+    value = (value or "").strip().upper().rstrip("B")
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value or 0))
+
+
+def get_cache_max_bytes() -> int:
+    """
+    IIB_CACHE_MAX_BYTES, 0 (default) means unlimited.
+    """
+    try:
+        return max(0, parse_size(os.getenv("IIB_CACHE_MAX_BYTES", "0")))
+    except ValueError:
+        logger.error("invalid IIB_CACHE_MAX_BYTES: %s", os.getenv("IIB_CACHE_MAX_BYTES"))
+        return 0
+
+
+class CacheManager:
+    flush_interval = 5
+    # 过期检查需要 stat 所有源文件，不必太频繁
+    stale_check_interval = 3600
+    # 超出预算时清理到预算的 90%，避免每次新增都触发清理
+    low_watermark = 0.9
+
+    def __init__(self, cache_root: str, max_bytes: int):
+        self.root = cache_root
+        self.db_path = os.path.join(cache_root, "cache_index.db")
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        # 相对路径 -> 访问时间
+        self.pending_hits: Dict[str, float] = {}
+        # 相对路径 -> (源文件, 源文件日期, 访问时间)
+        self.pending_adds: Dict[str, Tuple[Optional[str], Optional[str], float]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_removed = 0
+        self.bytes = 0
+        self.entries = 0
+        self.thread: Optional[threading.Thread] = None
+        self.last_stale_check = 0.0
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="iib-cache-manager", daemon=True)
+                self.thread.start()
+
+    def rel(self, cache_path: str):
+        return os.path.relpath(cache_path, self.root)
+
+    def hit(self, cache_path: str):
+        with self.lock:
+            self.hits += 1
+            self.pending_hits[self.rel(cache_path)] = time.time()
+
+    def add(self, cache_path: str, src: Optional[str] = None, t: Optional[str] = None, miss=True):
+        with self.lock:
+            if miss:
+                self.misses += 1
+            self.pending_adds[self.rel(cache_path)] = (src, t, time.time())
+        if self.max_bytes:
+            self.wakeup.set()
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "bytes": self.bytes,
+                "entries": self.entries,
+                "evictions": self.evictions,
+                "stale_removed": self.stale_removed,
+                "max_bytes": self.max_bytes,
+            }
+
+    def connect(self):
+        os.makedirs(self.root, exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        with closing(conn.cursor()) as cur:
+            cur.execute(
+                """CREATE TABLE IF NOT EXISTS cache_entry (
+                        path TEXT PRIMARY KEY,
+                        src TEXT,
+                        t TEXT,
+                        size INTEGER,
+                        atime REAL
+                    )"""
+            )
+            cur.execute("CREATE INDEX IF NOT EXISTS cache_entry_idx_atime ON cache_entry(atime)")
+        conn.commit()
+        return conn
+
+    def run(self):
+        try:
+            with closing(self.connect()) as conn:
+                self.import_existing(conn)
+                self.load_totals(conn)
+                while True:
+                    self.wakeup.wait(self.flush_interval)
+                    self.wakeup.clear()
+                    try:
+                        self.flush(conn)
+                        self.sweep(conn)
+                    except Exception as e:
+                        logger.error("cache manager failed: %s", e)
+        except Exception as e:
+            logger.error("cache manager stopped: %s", e)
+
+    def import_existing(self, conn: sqlite3.Connection):
+        with closing(conn.cursor()) as cur:
+            cur.execute("PRAGMA user_version")
+            if cur.fetchone()[0] >= 1:
+                return
+            rows = []
+            for dirpath, _, filenames in os.walk(self.root):
+                for name in filenames:
+                    if not name.endswith(".webp"):
+                        continue
+                    file_path = os.path.join(dirpath, name)
+                    try:
+                        stat = os.stat(file_path)
+                    except OSError:
+                        continue
+                    rows.append((self.rel(file_path), None, None, stat.st_size, stat.st_mtime))
+            cur.executemany("INSERT OR IGNORE INTO cache_entry VALUES (?, ?, ?, ?, ?)", rows)
+            cur.execute("PRAGMA user_version = 1")
+        conn.commit()
+        if rows:
+            logger.info("imported %d existing cache files", len(rows))
+
+    def load_totals(self, conn: sqlite3.Connection):
+        with closing(conn.cursor()) as cur:
+            cur.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entry")
+            entries, size = cur.fetchone()
+        with self.lock:
+            self.entries, self.bytes = entries, size
+
+    def flush(self, conn: Optional[sqlite3.Connection] = None):
+        """
+        Writes buffered hits and new files to the index. Also called directly by the CLI cache generators.
+        """
+        if conn is None:
+            with closing(self.connect()) as conn:
+                return self.flush(conn)
+        with self.lock:
+            hits, self.pending_hits = self.pending_hits, {}
+            adds, self.pending_adds = self.pending_adds, {}
+        if not hits and not adds:
+            return
+        size_delta = 0
+        entries_delta = 0
+        with closing(conn.cursor()) as cur:
+            for rel, (src, t, atime) in adds.items():
+                size = self.get_size(rel)
+                if size is None:
+                    continue
+                cur.execute("SELECT size FROM cache_entry WHERE path = ?", (rel,))
+                row = cur.fetchone()
+                size_delta += size - (row[0] if row else 0)
+                entries_delta += 0 if row else 1
+                cur.execute(
+                    "INSERT OR REPLACE INTO cache_entry VALUES (?, ?, ?, ?, ?)",
+                    (rel, src, t, size, atime),
+                )
+            cur.executemany(
+                "UPDATE cache_entry SET atime = ? WHERE path = ?",
+                [(atime, rel) for rel, atime in hits.items() if rel not in adds],
+            )
+        conn.commit()
+        with self.lock:
+            self.bytes += size_delta
+            self.entries += entries_delta
+
+    def get_blob_key(self, rel: str):
+        """
+        Thumbnails in the blob store are recorded as blob/<key>
+        """
+        head, key = os.path.split(rel)
+        return key if head == "blob" else None
+
+    def get_size(self, rel: str) -> Optional[int]:
+        key = self.get_blob_key(rel)
+        if key:
+            return blob_store.get_length(key)
+        try:
+            return os.path.getsize(os.path.join(self.root, rel))
+        except OSError:
+            return None
+
+    def exists(self, rel: str):
+        key = self.get_blob_key(rel)
+        if key:
+            return blob_store.contains(key)
+        return os.path.exists(os.path.join(self.root, rel))
+
+    def remove_file(self, rel: str):
+        key = self.get_blob_key(rel)
+        if key:
+            blob_store.delete(key)
+            return True
+        file_path = os.path.join(self.root, rel)
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error("failed to remove cache file %s: %s", file_path, e)
+            return False
+        try:
+            os.rmdir(os.path.dirname(file_path))
+        except OSError:
+            pass  # 目录下还有其他缓存
+        return True
+
+    def remove_entries(self, conn: sqlite3.Connection, rows, stale=False):
+        removed_size = 0
+        with closing(conn.cursor()) as cur:
+            for rel, size in rows:
+                if not self.remove_file(rel):
+                    continue
+                cur.execute("DELETE FROM cache_entry WHERE path = ?", (rel,))
+                removed_size += size or 0
+                with self.lock:
+                    self.bytes -= size or 0
+                    self.entries -= 1
+                    if stale:
+                        self.stale_removed += 1
+                    else:
+                        self.evictions += 1
+        conn.commit()
+        return removed_size
+
+    def sweep(self, conn: sqlite3.Connection):
+        if time.time() - self.last_stale_check > self.stale_check_interval:
+            self.last_stale_check = time.time()
+            self.remove_stale(conn)
+            # 命令行预生成的缓存由其他进程写入索引，顺便校正统计
+            self.load_totals(conn)
+        if self.max_bytes and self.bytes > self.max_bytes:
+            self.evict(conn)
+        blob_store.compact_if_needed()
+
+    def evict(self, conn: sqlite3.Connection):
+        target = self.max_bytes * self.low_watermark
+        with closing(conn.cursor()) as cur:
+            cur.execute("SELECT path, size FROM cache_entry ORDER BY atime")
+            while self.bytes > target:
+                rows = cur.fetchmany(200)
+                if not rows:
+                    break
+                need = self.bytes - target
+                batch = []
+                for rel, size in rows:
+                    batch.append((rel, size))
+                    need -= size or 0
+                    if need <= 0:
+                        break
+                self.remove_entries(conn, batch)
+
+    def remove_stale(self, conn: sqlite3.Connection):
+        with closing(conn.cursor()) as cur:
+            cur.execute("SELECT path, size, src, t FROM cache_entry WHERE src IS NOT NULL")
+            rows = cur.fetchall()
+        stale = []
+        for rel, size, src, t in rows:
+            try:
+                if get_modified_date(src) == t and self.exists(rel):
+                    continue
+            except OSError:
+                pass
+            stale.append((rel, size))
+        if stale:
+            self.remove_entries(conn, stale, stale=True)
+            logger.info("removed %d stale cache files", len(stale))
+
+
+cache_manager = CacheManager(os.path.join(get_cache_dir(), "iib_cache"), get_cache_max_bytes())
+
+
+def get_shard_dir(parent: str, hash: str):
+    return os.path.join(parent, hash[:2], hash[2:4])
+
+
+def get_cache_hash(path: str, t: str):
+    return hashlib.md5((path + t).encode("utf-8")).hexdigest()
+
+
+def get_thumbnail_cache_path(path: str, t: str, size: str):
+    """
+    Returns (etag, cache_path)
+    """
+    hash = get_cache_hash(path, t)
+    return hash + size, os.path.join(get_shard_dir(cache_manager.root, hash), f"{hash}_{size}.webp")
+
+
+def get_thumbnail_blob_key(path: str, t: str, size: str):
+    """
+    Returns (etag, key) of a thumbnail in the blob store, cache_manager records it as blob_store.get_entry_path(key)
+    """
+    hash = get_cache_hash(path, t)
+    return hash + size, f"{hash}_{size}"
+
+
+def get_video_cover_cache_path(path: str, mt: str):
+    """
+    Returns (etag, cache_path)
+    """
+    hash = get_cache_hash(path, mt)
+    video_cover_root = os.path.join(cache_manager.root, "video_cover")
+    return hash, os.path.join(get_shard_dir(video_cover_root, hash), f"{hash}.webp")
+
+
+legacy_dir_re = re.compile(r"^[0-9a-f]{32}$")
+
+
+def iter_legacy_dirs(parent: str):
+    try:
+        with os.scandir(parent) as it:
+            for entry in it:
+                if legacy_dir_re.match(entry.name) and entry.is_dir():
+                    yield entry
+    except FileNotFoundError:
+        return
+
+
+def has_legacy_cache_layout():
+    root = cache_manager.root
+    for _ in iter_legacy_dirs(root):
+        return True
+    for _ in iter_legacy_dirs(os.path.join(root, "video_cover")):
+        return True
+    return False
+
+
+def iter_legacy_cache_files():
+    """
+    Yields (old_path, new_path) of every cache file in the old layout.
+    """
+    root = cache_manager.root
+    video_cover_root = os.path.join(root, "video_cover")
+    for parent, is_video_cover in [(root, False), (video_cover_root, True)]:
+        for dir_entry in iter_legacy_dirs(parent):
+            hash = dir_entry.name
+            with os.scandir(dir_entry.path) as it:
+                files = list(it)
+            for file in files:
+                if not file.name.endswith(".webp"):
+                    if file.name.endswith(".tmp"):
+                        os.remove(file.path)  # 中断的写入留下的临时文件
+                    continue
+                if is_video_cover:
+                    name = f"{hash}.webp"
+                else:
+                    name = f"{hash}_{file.name}"  # 旧文件名就是 <size>.webp
+                yield file.path, os.path.join(get_shard_dir(parent, hash), name)
+            try:
+                os.rmdir(dir_entry.path)
+            except OSError:
+                pass  # 还有其他文件，保留
+
+
+def migrate_cache_layout(verbose=False):
+    """
+    Moves the files of a cache in the old layout into the sharded one, and updates the cache index.
+    Files are renamed in place, nothing is copied. Should be run while IIB is stopped.
+    """
+    moved = 0
+    renamed = []
+    with closing(cache_manager.connect()) as conn:
+        for old_path, new_path in iter_legacy_cache_files():
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            os.replace(old_path, new_path)
+            renamed.append((cache_manager.rel(new_path), cache_manager.rel(old_path)))
+            moved += 1
+            verbose and print(f"Moved {old_path} -> {new_path}")
+            if len(renamed) >= 1000:
+                conn.executemany("UPDATE OR REPLACE cache_entry SET path = ? WHERE path = ?", renamed)
+                conn.commit()
+                renamed = []
+        conn.executemany("UPDATE OR REPLACE cache_entry SET path = ? WHERE path = ?", renamed)
+        conn.commit()
+    return moved
@@ -4,7 +4,7 @@ import random
 from sqlite3 import Connection, connect
 from enum import Enum
 import sqlite3
-from typing import Dict, List, Optional, TypedDict, Union
+from typing import Dict, List, Optional, Tuple, TypedDict, Union
 from scripts.iib.tool import (
     cwd,
     get_modified_date,
@@ -12,13 +12,22 @@ from scripts.iib.tool import (
     tags_translate,
     is_dev,
     find,
+    get_seeded_random_key,
     unique_by,
 )
+from scripts.iib.db.file_exists import filter_existing
+from scripts.iib.db.tag_index import TagIndex, tag_index
 from contextlib import closing
 import os
 import threading
 import re
 import hashlib
+from functools import lru_cache
+
+try:
+    import re._parser as sre_parse
+except ImportError:  # python < 3.11
+    import sre_parse
 
 
 class FileInfoDict(TypedDict):
@@ -31,12 +40,86 @@ class FileInfoDict(TypedDict):
     fullpath: str
 
 
+@lru_cache(maxsize=64)
+def compile_regexp(expr: str):
+    return re.compile(expr, flags=re.IGNORECASE | re.MULTILINE | re.DOTALL)
+
+
+def _is_prefilter_char(ch: str):
+    # sqlite 的 LIKE 只忽略 ASCII 的大小写，而 python 忽略大小写时 i/k/s 还能匹配 ı İ K ſ
+    if ch.isascii():
+        return ch.lower() not in "iks"
+    return ch.lower() == ch == ch.upper()
+
+
+@lru_cache(maxsize=64)
+def get_regexp_literal(expr: str) -> str:
+    """
+    The longest literal every match of expr must contain, lower-cased, so rows can be pre-filtered
+    with `col LIKE '%literal%'` before calling the python regexp function.
+    Returns "" when there is none or the pattern can't be parsed.
+    """
+    try:
+        parsed = sre_parse.parse(expr, re.IGNORECASE | re.MULTILINE | re.DOTALL)
+    except Exception:
+        return ""
+    literals = []
+
+    def walk(items):
+        run = []
+        for op, av in items:
+            if op is sre_parse.LITERAL and _is_prefilter_char(chr(av)):
+                run.append(chr(av).lower())
+                continue
+            literals.append("".join(run))
+            run = []
+            if op is sre_parse.SUBPATTERN:
+                walk(av[-1])
+            elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] >= 1:
+                walk(av[2])
+        literals.append("".join(run))
+
+    walk(parsed)
+    return max(literals, key=len)
+
+
 class Cursor:
     def __init__(self, has_next=True, next=""):
         self.has_next = has_next
         self.next = next
 
 
+def encode_date_cursor(date: str, id: int) -> str:
+    return json.dumps([date, id], ensure_ascii=False)
+
+
+def decode_date_cursor(cursor: str) -> Tuple[str, int]:
+    """
+    (date, id) of the last image of the previous page, results continue with the images before it
+    in (date, id) order. Older cursors are only the date, (date, -1) gives the `date < cursor` they meant.
+    """
+    try:
+        date, id = json.loads(cursor)
+        return str(date), int(id)
+    except (ValueError, TypeError):
+        return cursor, -1
+
+
+def encode_random_cursor(seed: int, id: int) -> str:
+    return json.dumps([seed, id])
+
+
+def decode_random_cursor(cursor: str) -> Tuple[int, Optional[int]]:
+    """
+    (seed, id of the last image) of a random order page, or a new seed and None to start a new order.
+    """
+    try:
+        seed, id = json.loads(cursor)
+        return int(seed), int(id)
+    except (ValueError, TypeError):
+        return random.getrandbits(31), None
+
+
 class DataBase:
     local = threading.local()
 
@@ -72,20 +155,30 @@ class DataBase:
         def regexp(expr, item):
             if not isinstance(item, str):
                 return False
-            reg = re.compile(expr, flags=re.IGNORECASE | re.MULTILINE | re.DOTALL)
-            return reg.search(item) is not None
+            return compile_regexp(expr).search(item) is not None
 
-        conn.create_function("regexp", 2, regexp)
+        try:
+            conn.create_function("regexp", 2, regexp, deterministic=True)
+            conn.create_function("iib_random_key", 2, get_seeded_random_key, deterministic=True)
+        except sqlite3.NotSupportedError:
+            conn.create_function("regexp", 2, regexp)
+            conn.create_function("iib_random_key", 2, get_seeded_random_key)
+        # INSERT OR REPLACE 删除旧行时也要触发 image_fts 的同步触发器
+        conn.execute("PRAGMA recursive_triggers = ON")
         try:
             Folder.create_table(conn)
             ImageTag.create_table(conn)
             Tag.create_table(conn)
+            Dir.create_table(conn)
             Image.create_table(conn)
+            ImageFts.create_table(conn)
             ExtraPath.create_table(conn)
             DirCoverCache.create_table(conn)
             GlobalSetting.create_table(conn)
             ImageEmbedding.create_table(conn)
             ImageEmbeddingFail.create_table(conn)
+            VideoMeta.create_table(conn)
+            TagIndex.create_table(conn)
             TopicTitleCache.create_table(conn)
             TopicClusterCache.create_table(conn)
         finally:
@@ -118,19 +211,59 @@ class Image:
         }
 
     def save(self, conn):
+        dir_path = os.path.dirname(self.path)
+        Dir.batch_create(conn, [dir_path])
         with closing(conn.cursor()) as cur:
             cur.execute(
-                "INSERT OR REPLACE  INTO image (path, exif, size, date) VALUES (?, ?, ?, ?)",
-                (self.path, self.exif, self.size, self.date),
+                "INSERT OR REPLACE  INTO image (path, exif, size, date, dir_id) VALUES (?, ?, ?, ?, (SELECT id FROM dir WHERE path = ?))",
+                (self.path, self.exif, self.size, self.date, dir_path),
             )
             self.id = cur.lastrowid
 
+    @classmethod
+    def batch_save(cls, conn: Connection, images: List["Image"]):
+        """
+        Insert many images with one executemany, ids are resolved afterwards by path
+        because lastrowid is only available for single row inserts.
+        """
+        if not images:
+            return
+        Dir.batch_create(conn, [os.path.dirname(img.path) for img in images])
+        with closing(conn.cursor()) as cur:
+            cur.executemany(
+                "INSERT OR REPLACE  INTO image (path, exif, size, date, dir_id) VALUES (?, ?, ?, ?, (SELECT id FROM dir WHERE path = ?))",
+                [(img.path, img.exif, img.size, img.date, os.path.dirname(img.path)) for img in images],
+            )
+        ids = cls.get_ids_by_paths(conn, [img.path for img in images])
+        for img in images:
+            img.id = ids.get(img.path)
+
+    @classmethod
+    def get_ids_by_paths(cls, conn: Connection, paths: List[str]) -> Dict[str, int]:
+        paths = list(set(paths))
+        res: Dict[str, int] = {}
+        with closing(conn.cursor()) as cur:
+            for i in range(0, len(paths), 500):
+                chunk = paths[i : i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                cur.execute(
+                    f"SELECT id, path FROM image WHERE path IN ({placeholders})", chunk
+                )
+                for id, path in cur:
+                    res[path] = id
+        return res
+
     def update_path(self, conn: Connection, new_path: str, force=False):
         self.path = os.path.normpath(new_path)
+        dir_path = os.path.dirname(self.path)
+        Dir.batch_create(conn, [dir_path])
         with closing(conn.cursor()) as cur:
             if force: # force update path
                 cur.execute("DELETE FROM image WHERE path = ?", (self.path,))
-            cur.execute("UPDATE image SET path = ? WHERE id = ?", (self.path, self.id))
+            cur.execute(
+                "UPDATE image SET path = ?, dir_id = (SELECT id FROM dir WHERE path = ?) WHERE id = ?",
+                (self.path, dir_path, self.id),
+            )
 
     @classmethod
     def get(cls, conn: Connection, id_or_path):
@@ -165,6 +298,20 @@ class Image:
             images.append(cls.from_row(row))
         return images
 
+    @classmethod
+    def get_under_folder(cls, conn: Connection, folder_path: str) -> List["Image"]:
+        """
+        All images under folder_path, including sub folders.
+        """
+        folder_path = os.path.normpath(folder_path)
+        prefix = os.path.join(folder_path, "")
+        folder_sql, params = Dir.get_folder_filter_sql([folder_path])
+        with closing(conn.cursor()) as cur:
+            cur.execute(f"SELECT * FROM image WHERE {folder_sql}", params)
+            rows = cur.fetchall()
+        # LIKE 不区分大小写且会把 _ % 当作通配符，这里再精确过滤一次
+        return [cls.from_row(row) for row in rows if row[1].startswith(prefix)]
+
     @classmethod
     def create_table(cls, conn):
         with closing(conn.cursor()) as cur:
@@ -178,6 +325,28 @@ class Image:
                         )"""
             )
             cur.execute("CREATE INDEX IF NOT EXISTS image_idx_path ON image(path)")
+            try:
+                cur.execute("ALTER TABLE image ADD COLUMN dir_id INTEGER")
+            except sqlite3.OperationalError:
+                pass
+            cur.execute("CREATE INDEX IF NOT EXISTS image_idx_dir_id ON image(dir_id)")
+            # 搜索结果按 (date, id) 倒序分页
+            cur.execute("CREATE INDEX IF NOT EXISTS image_idx_date_id ON image(date, id)")
+        # 旧数据库升级后 dir_id 为空，在这里补上
+        cls.fill_dir_id(conn)
+
+    @classmethod
+    def fill_dir_id(cls, conn: Connection):
+        with closing(conn.cursor()) as cur:
+            cur.execute("SELECT id, path FROM image WHERE dir_id IS NULL")
+            rows = [(id, os.path.dirname(path)) for id, path in cur.fetchall() if path]
+            if not rows:
+                return
+            Dir.batch_create(conn, [dir_path for _, dir_path in rows])
+            cur.executemany(
+                "UPDATE image SET dir_id = (SELECT id FROM dir WHERE path = ?) WHERE id = ?",
+                [(dir_path, id) for id, dir_path in rows],
+            )
 
     @classmethod
     def count(cls, conn):
@@ -186,6 +355,13 @@ class Image:
             count = cur.fetchone()[0]
             return count
 
+    @classmethod
+    def is_empty(cls, conn):
+        # 不用 COUNT(*)，大图库上它要扫描整张表
+        with closing(conn.cursor()) as cur:
+            cur.execute("SELECT 1 FROM image LIMIT 1")
+            return cur.fetchone() is None
+
     @classmethod
     def from_row(cls, row: tuple):
         image = cls(path=row[1], exif=row[2], size=row[3], date=row[4])
@@ -202,6 +378,7 @@ class Image:
             cur.execute("DELETE FROM image_embedding WHERE image_id = ?", (int(image_id),))
             cur.execute("DELETE FROM image_embedding_fail WHERE image_id = ?", (int(image_id),))
             cur.execute("DELETE FROM image_tag WHERE image_id = ?", (int(image_id),))
+            cur.execute("DELETE FROM video_meta WHERE image_id = ?", (int(image_id),))
             cur.execute("DELETE FROM image WHERE id = ?", (image_id,))
             conn.commit()
 
@@ -226,6 +403,10 @@ class Image:
                     f"DELETE FROM image_tag WHERE image_id IN ({placeholders})",
                     image_ids,
                 )
+                cur.execute(
+                    f"DELETE FROM video_meta WHERE image_id IN ({placeholders})",
+                    image_ids,
+                )
                 cur.execute(
                     f"DELETE FROM image WHERE id IN ({placeholders})", image_ids
                 )
@@ -244,28 +425,46 @@ class Image:
             params = []
             where_clauses = []
             if regexp:
+                literal = get_regexp_literal(regexp)
+                fts_query = ImageFts.get_match_query(conn, literal, path_only) if literal else None
+                if fts_query:
+                    where_clauses.append("(image.id IN (SELECT rowid FROM image_fts WHERE image_fts MATCH ?))")
+                    params.append(fts_query)
+                # 先用 LIKE 排除不含必需字面量的行，减少 python 函数调用
+                like = "%" + re.sub(r"([\\%_])", r"\\\1", literal) + "%"
                 if path_only:
-                    where_clauses.append("(path REGEXP ?)")
-                    params.append(regexp)
+                    if literal:
+                        where_clauses.append("(path LIKE ? ESCAPE '\\' AND path REGEXP ?)")
+                        params.extend((like, regexp))
+                    else:
+                        where_clauses.append("(path REGEXP ?)")
+                        params.append(regexp)
+                elif literal:
+                    where_clauses.append(
+                        "((exif LIKE ? ESCAPE '\\' AND exif REGEXP ?) OR (path LIKE ? ESCAPE '\\' AND path REGEXP ?))"
+                    )
+                    params.extend((like, regexp, like, regexp))
                 else:
                     where_clauses.append("((exif REGEXP ?) OR (path REGEXP ?))")
                     params.extend((regexp, regexp))
             else:
-                if path_only:
+                fts_query = ImageFts.get_match_query(conn, substring, path_only)
+                if fts_query:
+                    where_clauses.append("(image.id IN (SELECT rowid FROM image_fts WHERE image_fts MATCH ?))")
+                    params.append(fts_query)
+                elif path_only:
                     where_clauses.append("(path LIKE ?)")
                     params.append(f"%{substring}%")
                 else:
                     where_clauses.append("(path LIKE ? OR exif LIKE ?)")
                     params.extend((f"%{substring}%", f"%{substring}%"))
             if cursor:
-                where_clauses.append("(date < ?)")
-                params.append(cursor)
+                where_clauses.append("((image.date, image.id) < (?, ?))")
+                params.extend(decode_date_cursor(cursor))
             if folder_paths:
-                folder_clauses = []
-                for folder_path in folder_paths:
-                    folder_clauses.append("(image.path LIKE ?)")
-                    params.append(os.path.join(folder_path, "%"))
-                where_clauses.append("(" + " OR ".join(folder_clauses) + ")")
+                folder_sql, folder_params = Dir.get_folder_filter_sql(folder_paths)
+                where_clauses.append(folder_sql)
+                params.extend(folder_params)
             
             # 构建SQL查询
             if media_type and media_type.lower() != "all":
@@ -283,23 +482,19 @@ class Image:
             if where_clauses:
                 sql += " WHERE "
                 sql += " AND ".join(where_clauses)
-            sql += " ORDER BY date DESC LIMIT ? "
+            sql += " ORDER BY image.date DESC, image.id DESC LIMIT ? "
             params.append(limit)
             cur.execute(sql, params)
             rows = cur.fetchall()
 
         api_cur.has_next = len(rows) >= limit
-        images = []
-        deleted_ids = []
-        for row in rows:
-            img = cls.from_row(row)
-            if os.path.exists(img.path):
-                images.append(img)
-            else:
-                deleted_ids.append(img.id)
+        images, deleted_ids = filter_existing(
+            [cls.from_row(row) for row in rows], lambda x: x.path, lambda x: x.id
+        )
         cls.safe_batch_remove(conn, deleted_ids)
-        if images:
-            api_cur.next = str(images[-1].date)
+        if rows:
+            # 用最后一行而不是最后一张存在的图片，整页都被删掉时也能继续往后翻
+            api_cur.next = encode_date_cursor(rows[-1][4], rows[-1][0])
         return images, api_cur
     
     @classmethod
@@ -307,25 +502,125 @@ class Image:
         if size <= 0:
             return []
         
-        images = []
-        deleted_ids = []
         with closing(conn.cursor()) as cur:
             cur.execute("SELECT * FROM image ORDER BY RANDOM() LIMIT ?", (size,))
             rows = cur.fetchall()
-            
-            for row in rows:
-                img = cls.from_row(row)
-                if os.path.exists(img.path):
-                    images.append(img)
-                else:
-                    deleted_ids.append(img.id)
-        
+        images, deleted_ids = filter_existing(
+            [cls.from_row(row) for row in rows], lambda x: x.path, lambda x: x.id
+        )
         if deleted_ids:
             cls.safe_batch_remove(conn, deleted_ids)
         
         return images
 
 
+class ImageFts:
+    """
+    FTS5 trigram index over image.path and image.exif, used by find_by_substring instead of
+    scanning the whole image table with LIKE.
+
+    The table is an external content table kept in sync by triggers. It only exists once it has
+    been fully built: a new database gets it right away, an existing one needs
+    `python app.py --rebuild_fts_index` once. Until then search falls back to LIKE.
+    """
+
+    # trigram 分词器至少需要 3 个字符才能命中索引
+    min_query_len = 3
+    # 命中太多行时按 date 排序的开销比直接扫表还大，交给 LIKE
+    max_match_rows = 20000
+
+    @classmethod
+    def create_table(cls, conn: Connection):
+        if cls.is_ready(conn):
+            return
+        with closing(conn.cursor()) as cur:
+            cur.execute("SELECT 1 FROM image LIMIT 1")
+            if cur.fetchone():
+                return  # 已有数据的旧数据库需要手动 --rebuild_fts_index
+        try:
+            cls.rebuild(conn)
+        except sqlite3.OperationalError as e:
+            # 旧版本 sqlite 不支持 fts5 或 trigram
+            print(f"FTS5 trigram index is not available, fallback to LIKE search: {e}")
+
+    @classmethod
+    def is_ready(cls, conn: Connection) -> bool:
+        with closing(conn.cursor()) as cur:
+            cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'image_fts'")
+            return cur.fetchone() is not None
+
+    @classmethod
+    def rebuild(cls, conn: Connection):
+        """
+        (Re)create the index and fill it from the image table in one transaction.
+        """
+        conn.commit()
+        with closing(conn.cursor()) as cur:
+            try:
+                cur.execute("BEGIN")
+                cls.drop(cur)
+                cur.execute(
+                    """CREATE VIRTUAL TABLE image_fts USING fts5(
+                            path, exif, content='image', content_rowid='id', tokenize='trigram'
+                        )"""
+                )
+                cur.execute(
+                    """CREATE TRIGGER image_fts_ai AFTER INSERT ON image BEGIN
+                            INSERT INTO image_fts (rowid, path, exif) VALUES (new.id, new.path, new.exif);
+                        END"""
+                )
+                cur.execute(
+                    """CREATE TRIGGER image_fts_ad AFTER DELETE ON image BEGIN
+                            INSERT INTO image_fts (image_fts, rowid, path, exif) VALUES ('delete', old.id, old.path, old.exif);
+                        END"""
+                )
+                cur.execute(
+                    """CREATE TRIGGER image_fts_au AFTER UPDATE OF path, exif ON image BEGIN
+                            INSERT INTO image_fts (image_fts, rowid, path, exif) VALUES ('delete', old.id, old.path, old.exif);
+                            INSERT INTO image_fts (rowid, path, exif) VALUES (new.id, new.path, new.exif);
+                        END"""
+                )
+                cur.execute("INSERT INTO image_fts (image_fts) VALUES ('rebuild')")
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+    @classmethod
+    def drop(cls, cur):
+        for trigger in ("image_fts_ai", "image_fts_ad", "image_fts_au"):
+            cur.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        cur.execute("DROP TABLE IF EXISTS image_fts")
+
+    @classmethod
+    def get_match_query(cls, conn: Connection, substring: str, path_only=False) -> Optional[str]:
+        """
+        Returns a MATCH expression with the same result as `LIKE '%substring%'`, or None when the
+        index can't serve it (not built, too short, LIKE wildcards in the substring) or wouldn't
+        be faster than a table scan because the substring is too common.
+        """
+        # trigram 分词器不区分所有 Unicode 字符的大小写，而 LIKE 只忽略 ASCII 的大小写，
+        # 非 ASCII 的子串（例如 "É"）两者结果不同，只能走 LIKE
+        if (
+            len(substring) < cls.min_query_len
+            or not substring.isascii()
+            or "%" in substring
+            or "_" in substring
+            or not cls.is_ready(conn)
+        ):
+            return None
+        phrase = '"' + substring.replace('"', '""') + '"'
+        query = f"path : {phrase}" if path_only else phrase
+        with closing(conn.cursor()) as cur:
+            cur.execute(
+                "SELECT COUNT(*) FROM (SELECT rowid FROM image_fts WHERE image_fts MATCH ? LIMIT ?)",
+                (query, cls.max_match_rows + 1),
+            )
+            if cur.fetchone()[0] > cls.max_match_rows:
+                return None
+        return query
+
+
 class ImageEmbedding:
     """
     Store embeddings for image prompt text.
@@ -476,6 +771,67 @@ class ImageEmbeddingFail:
             cur.execute("DELETE FROM image_embedding_fail WHERE image_id = ? AND model = ?", (int(image_id), str(model)))
 
 
+class VideoMeta:
+    """
+    Container metadata (duration, resolution, codec) of indexed videos, probed while generating the
+    video cover. mt is the modified time of the file when it was probed, rows of videos that were
+    modified afterwards are ignored.
+    """
+
+    @classmethod
+    def create_table(cls, conn: Connection):
+        with closing(conn.cursor()) as cur:
+            cur.execute(
+                """CREATE TABLE IF NOT EXISTS video_meta (
+                    image_id INTEGER PRIMARY KEY,
+                    mt TEXT NOT NULL,
+                    duration REAL,
+                    width INTEGER,
+                    height INTEGER,
+                    codec TEXT,
+                    FOREIGN KEY (image_id) REFERENCES image(id)
+                )"""
+            )
+
+    @classmethod
+    def get_by_path(cls, conn: Connection, path: str, mt: str) -> Optional[Dict]:
+        with closing(conn.cursor()) as cur:
+            cur.execute(
+                """SELECT video_meta.duration, video_meta.width, video_meta.height, video_meta.codec
+                FROM video_meta INNER JOIN image ON image.id = video_meta.image_id
+                WHERE image.path = ? AND video_meta.mt = ?""",
+                (path, mt),
+            )
+            row = cur.fetchone()
+        if row is None:
+            return None
+        return {"duration": row[0], "width": row[1], "height": row[2], "codec": row[3]}
+
+    @classmethod
+    def save(cls, conn: Connection, path: str, mt: str, meta: Dict) -> bool:
+        """
+        Returns False if the video isn't indexed.
+        """
+        image_id = Image.get_ids_by_paths(conn, [path]).get(path)
+        if image_id is None:
+            return False
+        with closing(conn.cursor()) as cur:
+            cur.execute(
+                """INSERT INTO video_meta (image_id, mt, duration, width, height, codec)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(image_id) DO UPDATE SET
+                    mt = excluded.mt,
+                    duration = excluded.duration,
+                    width = excluded.width,
+                    height = excluded.height,
+                    codec = excluded.codec
+                """,
+                (image_id, mt, meta.get("duration"), meta.get("width"), meta.get("height"), meta.get("codec")),
+            )
+        conn.commit()
+        return True
+
+
 class TopicTitleCache:
     """
     Cache cluster titles/keywords to avoid repeated LLM calls.
@@ -791,6 +1147,16 @@ class Tag:
             print(f"tag: loaded {len(tags)} tags (total: {total_count})")
             return tags
 
+    @classmethod
+    def batch_incr_count(cls, conn: Connection, tag_incr_count: Dict[int, int]):
+        if not tag_incr_count:
+            return
+        with closing(conn.cursor()) as cur:
+            cur.executemany(
+                "UPDATE tag SET count = count + ? WHERE id = ?",
+                [(incr, tag_id) for tag_id, incr in tag_incr_count.items()],
+            )
+
     @classmethod
     def get_or_create(cls, conn: Connection, name: str, type: str):
         assert name and type
@@ -848,6 +1214,37 @@ class Tag:
                 pass
 
 
+class TagCache:
+    """
+    In-memory (name, type) -> tag id map for one indexing session.
+
+    It is preloaded from the tag table and written through when a tag is created, so building
+    the index doesn't run a SELECT for every prompt token of every image.
+    """
+
+    def __init__(self, conn: Connection, preload=True):
+        self.conn = conn
+        self.ids: Dict[Tuple[str, str], Optional[int]] = {}
+        if preload:
+            self.load()
+
+    def load(self):
+        with closing(self.conn.cursor()) as cur:
+            cur.execute("SELECT id, name, type FROM tag")
+            for id, name, type in cur:
+                # 和 Tag.get_or_create 保持一致，不合法的旧标签不会被命中
+                if name and type and not Tag.validate_tag_name(name):
+                    self.ids[(name, type)] = id
+
+    def get_or_create(self, name: str, type: str) -> Optional[int]:
+        key = (name, type)
+        if key in self.ids:
+            return self.ids[key]
+        tag = Tag.get_or_create(self.conn, name, type)
+        self.ids[key] = tag.id if tag else None
+        return self.ids[key]
+
+
 class ImageTag:
     def __init__(self, image_id: int, tag_id: int):
         assert tag_id and image_id
@@ -868,6 +1265,19 @@ class ImageTag:
                 (self.image_id, self.tag_id),
             )
 
+    @classmethod
+    def batch_save_or_ignore(cls, conn: Connection, pairs: List[Tuple[int, int]]):
+        """
+        pairs: (image_id, tag_id)
+        """
+        if not pairs:
+            return
+        with closing(conn.cursor()) as cur:
+            cur.executemany(
+                "INSERT OR IGNORE INTO image_tag (image_id, tag_id, created_at) VALUES (?, ?, CURRENT_TIMESTAMP)",
+                pairs,
+            )
+
     @classmethod
     def get_tags_for_image(
         cls,
@@ -938,6 +1348,69 @@ class ImageTag:
         folder_paths: List[str] = None,
         random_sort: bool = False,
     ) -> tuple[List[Image], Cursor]:
+        """
+        Newest first, or in a random order that stays the same while paging (the seed is part of the cursor).
+        """
+        # 去掉重复的 id，索引和 SQL 两种查询都只看去重后的条件，HAVING 的计数才对得上
+        tag_dict = {k: list(dict.fromkeys(int(x) for x in v or [])) for k, v in tag_dict.items()}
+        seed = None
+        # 上一页最后一张图片的 (date, id)，随机排序时是 (随机值, id)
+        after = None
+        if random_sort:
+            seed, last_id = decode_random_cursor(cursor)
+            if last_id is not None:
+                after = (get_seeded_random_key(last_id, seed), last_id)
+        elif cursor:
+            after = decode_date_cursor(cursor)
+        dir_ids = Dir.get_folder_ids(conn, folder_paths) if folder_paths else None
+        ids = tag_index.query(conn, tag_dict, limit, after, dir_ids, seed)
+        if ids is not None:
+            rows = cls.get_image_rows_by_ids(conn, ids)
+        else:
+            rows = cls.query_images_by_tags(conn, tag_dict, limit, after, folder_paths, seed)
+        api_cur = Cursor()
+        images, deleted_ids = filter_existing(
+            [Image(id=row[0], path=row[1], size=row[2], date=row[3]) for row in rows],
+            lambda x: x.path,
+            lambda x: x.id,
+        )
+        Image.safe_batch_remove(conn, deleted_ids)
+        api_cur.has_next = len(rows) >= limit
+        if rows:
+            if random_sort:
+                api_cur.next = encode_random_cursor(seed, rows[-1][0])
+            else:
+                api_cur.next = encode_date_cursor(rows[-1][3], rows[-1][0])
+        return images, api_cur
+
+    @classmethod
+    def get_image_rows_by_ids(cls, conn: Connection, ids: List[int]) -> List[tuple]:
+        """
+        (id, path, size, date) of the given images, in the order of ids.
+        """
+        if not ids:
+            return []
+        with closing(conn.cursor()) as cur:
+            cur.execute(
+                f"SELECT id, path, size, date FROM image WHERE id IN ({','.join('?' * len(ids))})",
+                ids,
+            )
+            rows = {row[0]: row for row in cur.fetchall()}
+        return [rows[id] for id in ids if id in rows]
+
+    @classmethod
+    def query_images_by_tags(
+        cls,
+        conn: Connection,
+        tag_dict: Dict[str, List[int]],
+        limit: int,
+        after: Optional[Tuple],
+        folder_paths: List[str],
+        seed: Optional[int],
+    ) -> List[tuple]:
+        """
+        SQL version of the tag index query, (id, path, size, date) rows.
+        """
         query = """
             SELECT image.id, image.path, image.size,image.date
             FROM image
@@ -980,16 +1453,16 @@ class ImageTag:
                 params.extend(tag_ids)    
 
         if folder_paths:
-            folder_clauses = []
-            for folder_path in folder_paths:
-                folder_clauses.append("(image.path LIKE ?)")
-                params.append(os.path.join(folder_path, "%"))
-                print(folder_path)
-            where_clauses.append("(" + " OR ".join(folder_clauses) + ")")
-
-        if cursor and not random_sort:
-            where_clauses.append("(image.date < ?)")
-            params.append(cursor)
+            folder_sql, folder_params = Dir.get_folder_filter_sql(folder_paths)
+            where_clauses.append(folder_sql)
+            params.extend(folder_params)
+
+        if after and seed is not None:
+            where_clauses.append("((iib_random_key(image.id, ?), image.id) > (?, ?))")
+            params.extend((seed, *after))
+        elif after:
+            where_clauses.append("((image.date, image.id) < (?, ?))")
+            params.extend(after)
         if where_clauses:
             query += " WHERE " + " AND ".join(where_clauses)
         query += " GROUP BY image.id"
@@ -997,41 +1470,15 @@ class ImageTag:
             query += " HAVING COUNT(DISTINCT tag_id) = ?"
             params.append(len(tag_dict["and"]))
 
-        if random_sort:
-            query += " ORDER BY RANDOM() LIMIT ?"
-            # For random sort, use offset-based pagination
-            if cursor:
-                try:
-                    offset = int(cursor)
-                    query = query.replace("LIMIT ?", f"LIMIT ? OFFSET {offset}")
-                except (ValueError, TypeError):
-                    pass  # Invalid cursor, start from beginning
+        if seed is not None:
+            query += " ORDER BY iib_random_key(image.id, ?), image.id LIMIT ?"
+            params.append(seed)
         else:
-            query += " ORDER BY date DESC LIMIT ?"
+            query += " ORDER BY image.date DESC, image.id DESC LIMIT ?"
         params.append(limit)
-        api_cur = Cursor()
         with closing(conn.cursor()) as cur:
             cur.execute(query, params)
-            rows = cur.fetchall()
-            images = []
-            deleted_ids = []
-            for row in rows:
-                img = Image(id=row[0], path=row[1], size=row[2], date=row[3])
-                if os.path.exists(img.path):
-                    images.append(img)
-                else:
-                    deleted_ids.append(img.id)
-            Image.safe_batch_remove(conn, deleted_ids)
-            api_cur.has_next = len(rows) >= limit
-            if images:
-                if random_sort:
-                    # For random sort, use offset-based cursor
-                    current_offset = int(cursor) if cursor else 0
-                    api_cur.next = str(current_offset + len(images))
-                else:
-                    # For date sort, use date-based cursor
-                    api_cur.next = str(images[-1].date)
-            return images, api_cur
+            return cur.fetchall()
 
     @classmethod
     def batch_get_tags_by_path(
@@ -1080,6 +1527,63 @@ class ImageTag:
             conn.commit()
 
 
+class Dir:
+    """
+    Parent folders of indexed images. image.dir_id points here, so folder scoped queries go through
+    the image_idx_dir_id index instead of scanning every image path with LIKE.
+    """
+
+    @classmethod
+    def create_table(cls, conn):
+        with closing(conn.cursor()) as cur:
+            cur.execute(
+                """CREATE TABLE IF NOT EXISTS dir (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            path TEXT UNIQUE
+                        )"""
+            )
+
+    @classmethod
+    def batch_create(cls, conn: Connection, dir_paths: List[str]):
+        with closing(conn.cursor()) as cur:
+            cur.executemany(
+                "INSERT OR IGNORE INTO dir (path) VALUES (?)",
+                [(p,) for p in set(dir_paths)],
+            )
+
+    @classmethod
+    def get_folder_filter_sql(cls, folder_paths: List[str]) -> Tuple[str, List[str]]:
+        """
+        Returns a where clause matching images in any of folder_paths or their sub folders,
+        same as the old `image.path LIKE 'folder/%'` filter. Only the small dir table is scanned.
+        """
+        path_sql, params = cls.get_folder_path_sql(folder_paths)
+        return f"(image.dir_id IN (SELECT id FROM dir WHERE {path_sql}))", params
+
+    @classmethod
+    def get_folder_path_sql(cls, folder_paths: List[str]) -> Tuple[str, List[str]]:
+        """
+        Where clause on dir.path matching folder_paths and their sub folders.
+        """
+        clauses = []
+        params = []
+        for folder_path in folder_paths:
+            folder_path = os.path.normpath(folder_path)
+            clauses.append("path = ? OR path LIKE ?")
+            params.extend((folder_path, os.path.join(folder_path, "%")))
+        return " OR ".join(clauses), params
+
+    @classmethod
+    def get_folder_ids(cls, conn: Connection, folder_paths: List[str]) -> List[int]:
+        """
+        Ids of the dir rows matched by get_folder_filter_sql.
+        """
+        path_sql, params = cls.get_folder_path_sql(folder_paths)
+        with closing(conn.cursor()) as cur:
+            cur.execute(f"SELECT id FROM dir WHERE {path_sql}", params)
+            return [row[0] for row in cur.fetchall()]
+
+
 class Folder:
     def __init__(self, id: int, path: str, modified_date: str):
         self.id = id
@@ -1110,20 +1614,23 @@ class Folder:
             )
 
     @classmethod
-    def update_modified_date_or_create(cls, conn: Connection, folder_path: str):
+    def update_modified_date_or_create(
+        cls, conn: Connection, folder_path: str, modified_date: Optional[str] = None
+    ):
         folder_path = os.path.normpath(folder_path)
+        modified_date = modified_date or get_modified_date(folder_path)
         with closing(conn.cursor()) as cur:
             cur.execute("SELECT * FROM folders WHERE path = ?", (folder_path,))
             row = cur.fetchone()
             if row:
                 cur.execute(
                     "UPDATE folders SET modified_date = ? WHERE path = ?",
-                    (get_modified_date(folder_path), folder_path),
+                    (modified_date, folder_path),
                 )
             else:
                 cur.execute(
                     "INSERT INTO folders (path, modified_date) VALUES (?, ?)",
-                    (folder_path, get_modified_date(folder_path)),
+                    (folder_path, modified_date),
                 )
 
     @classmethod
@@ -0,0 +1,162 @@
+"""
+Existence checks for rows returned by index queries.
+
+Search results, random images and the topic cluster endpoints used to call os.path.exists on
+every row inline, which gets slow on network shares. Here the stats are:
+- cached for a few seconds, so scrolling/paging doesn't stat the same files again,
+- done in a thread pool when a page needs more than a handful of them,
+- or skipped entirely with IIB_TRUST_INDEX=true: rows are returned as they are and checked by a
+  background thread, which removes the missing ones from the index.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+
+from scripts.iib.logger import logger
+
+T = TypeVar("T")
+
+cache_ttl = 5
+cache_max_size = 100000
+# 每个线程一次检查的路径数，本地磁盘上 stat 很快，分得太细反而是线程调度的开销
+chunk_size = 32
+max_workers = 16
+
+
+def is_trust_index_enabled():
+    return os.getenv("IIB_TRUST_INDEX", "false").lower() == "true"
+
+
+class ExistsCache:
+    """
+    Remembers which paths existed a moment ago. Missing paths are not cached, their rows get removed
+    and a file re-created right after must not be treated as missing again.
+    """
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.items: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def has(self, path: str) -> bool:
+        checked_at = self.items.get(path)
+        return checked_at is not None and time.monotonic() - checked_at <= self.ttl
+
+    def add(self, paths: List[str]):
+        now = time.monotonic()
+        with self.lock:
+            if len(self.items) + len(paths) > self.max_size:
+                self.items = {k: v for k, v in self.items.items() if now - v <= self.ttl}
+                if len(self.items) + len(paths) > self.max_size:
+                    self.items = {}
+            for path in paths:
+                self.items[path] = now
+
+
+exists_cache = ExistsCache(cache_ttl, cache_max_size)
+_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="iib-exists")
+
+
+def _stat_chunk(paths: List[str]):
+    return [(path, os.path.exists(path)) for path in paths]
+
+
+def check_exists(paths: List[str]) -> Dict[str, bool]:
+    res: Dict[str, bool] = {}
+    todo = []
+    for path in paths:
+        if exists_cache.has(path):
+            res[path] = True
+        else:
+            todo.append(path)
+    if not todo:
+        return res
+    todo = list(dict.fromkeys(todo))
+    if len(todo) <= chunk_size:
+        checked = dict(_stat_chunk(todo))
+    else:
+        chunks = [todo[i : i + chunk_size] for i in range(0, len(todo), chunk_size)]
+        checked = {}
+        for chunk_res in _executor.map(_stat_chunk, chunks):
+            checked.update(chunk_res)
+    exists_cache.add([path for path, exists in checked.items() if exists])
+    res.update(checked)
+    return res
+
+
+class BackgroundVerifier:
+    """
+    Used when the index is trusted: checks the paths handed out by queries after the response and
+    removes the rows whose file is gone, so they disappear on the next query.
+    """
+
+    batch_size = 500
+
+    def __init__(self):
+        self.queue: "queue.Queue[Tuple[int, str]]" = queue.Queue(maxsize=100000)
+        self.thread: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+
+    def submit(self, items: List[Tuple[int, str]]):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="iib-exists-verifier", daemon=True)
+                self.thread.start()
+        for item in items:
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                return  # 尽力而为，下次查询还会再提交
+
+    def run(self):
+        while True:
+            batch = {self.queue.get()}
+            while len(batch) < self.batch_size:
+                try:
+                    batch.add(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                exists = check_exists([path for _, path in batch])
+                missing = [id for id, path in batch if not exists.get(path, True)]
+                if missing:
+                    self.remove(missing)
+            except Exception as e:
+                logger.error("background file check failed: %s", e)
+
+    def remove(self, ids: List[int]):
+        from scripts.iib.db.datamodel import DataBase, Image
+
+        Image.safe_batch_remove(DataBase.get_conn(), ids)
+        logger.info("removed %d missing files from the index", len(ids))
+
+
+background_verifier = BackgroundVerifier()
+
+
+def filter_existing(
+    items: List[T], get_path: Callable[[T], str], get_id: Callable[[T], int]
+) -> Tuple[List[T], List[int]]:
+    """
+    Splits query results into the items whose file exists and the ids of the missing ones.
+    When the index is trusted everything is returned and the check happens in the background.
+    """
+    items = [item for item in items if isinstance(get_path(item), str)]
+    if not items:
+        return [], []
+    if is_trust_index_enabled():
+        background_verifier.submit([(get_id(item), get_path(item)) for item in items])
+        return items, []
+    exists = check_exists([get_path(item) for item in items])
+    existing = []
+    missing_ids = []
+    for item in items:
+        if exists.get(get_path(item)):
+            existing.append(item)
+        else:
+            missing_ids.append(get_id(item))
+    return existing, missing_ids
@@ -0,0 +1,548 @@
+"""
+In memory index of image_tag for /db/match_images_by_tags, enabled with IIB_ENABLE_TAG_INDEX=true.
+
+The SQL version joins image_tag, groups by image and sorts every match by date, which takes seconds
+once there are millions of tag rows. Here each tag is a sorted numpy array of image ids:
+- AND intersects the shortest list with the others using binary search,
+- OR and NOT are a union / difference of the lists,
+- the newest `limit` matches are picked by (date, id), either with a partial sort of the matches or,
+  when most images match, by walking all images in that order until the page is full,
+- a seeded random order is a partial sort of the matches by get_seeded_random_key.
+
+Writes go through triggers that append every change of image_tag and image (date, folder) to
+image_tag_log, whichever process or code path made them. The next query applies the new log rows,
+so the index is never stale. Large backlogs (first start, a big rescan) rebuild the index in a
+background thread and queries use SQL until it's ready.
+
+Several processes can share the database (a second server, --generate_image_cache), so the log is
+shared schema: every process using the index records how far it has read in image_tag_log_reader,
+and rows are only deleted once all of them have read them. A process with the index disabled never
+touches the log, it's only dropped once no reader has been seen for reader_timeout_seconds.
+"""
+import calendar
+import os
+import threading
+import time
+import uuid
+from contextlib import closing
+from datetime import datetime
+from sqlite3 import Connection, OperationalError
+from typing import Dict, List, Optional, Tuple
+
+from scripts.iib.logger import logger
+from scripts.iib.tool import get_seeded_random_key
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# 积压的日志超过这么多行时直接在后台重建，而不是逐行应用
+max_incremental_rows = 200000
+# 应用过的日志累计到这么多行再删除，避免每次查询都写数据库
+trim_log_rows = 10000
+# 读取位置至少这么久更新一次
+reader_heartbeat_seconds = 300
+# 这么久没有更新位置的进程视为已经退出，不再等它读取日志
+reader_timeout_seconds = 24 * 3600
+load_chunk_rows = 500000
+# 不存在的图片
+missing_date = -(2**62)
+
+log_triggers = {
+    "image_tag_log_ai": """AFTER INSERT ON image_tag BEGIN
+            INSERT INTO image_tag_log (image_id, tag_id, added) VALUES (new.image_id, new.tag_id, 1);
+        END""",
+    "image_tag_log_ad": """AFTER DELETE ON image_tag BEGIN
+            INSERT INTO image_tag_log (image_id, tag_id, added) VALUES (old.image_id, old.tag_id, 0);
+        END""",
+    "image_tag_log_au": """AFTER UPDATE OF image_id, tag_id ON image_tag BEGIN
+            INSERT INTO image_tag_log (image_id, tag_id, added) VALUES (old.image_id, old.tag_id, 0);
+            INSERT INTO image_tag_log (image_id, tag_id, added) VALUES (new.image_id, new.tag_id, 1);
+        END""",
+    # tag_id 为空表示图片本身变了，重新读取它的 date 和 dir_id
+    "image_tag_log_image_ai": """AFTER INSERT ON image BEGIN
+            INSERT INTO image_tag_log (image_id) VALUES (new.id);
+        END""",
+    "image_tag_log_image_ad": """AFTER DELETE ON image BEGIN
+            INSERT INTO image_tag_log (image_id) VALUES (old.id);
+        END""",
+    "image_tag_log_image_au": """AFTER UPDATE OF date, dir_id ON image BEGIN
+            INSERT INTO image_tag_log (image_id) VALUES (new.id);
+        END""",
+}
+
+
+def is_tag_index_enabled():
+    return np is not None and os.getenv("IIB_ENABLE_TAG_INDEX", "false").lower() == "true"
+
+
+def parse_date_key(date: str) -> Optional[int]:
+    """
+    Same value as sqlite's strftime('%s', date), which is used to load the dates.
+    """
+    try:
+        return calendar.timegm(datetime.strptime(date, "%Y-%m-%d %H:%M:%S").timetuple())
+    except (TypeError, ValueError):
+        return None
+
+
+def contains_sorted(ids: "np.ndarray", sorted_ids: "np.ndarray") -> "np.ndarray":
+    """
+    Mask of the items of ids that are in sorted_ids.
+    """
+    if not len(sorted_ids):
+        return np.zeros(len(ids), dtype=bool)
+    pos = np.searchsorted(sorted_ids, ids)
+    np.minimum(pos, len(sorted_ids) - 1, out=pos)
+    return sorted_ids[pos] == ids
+
+
+class TagIndexData:
+    def __init__(self):
+        self.postings: Dict[int, "np.ndarray"] = {}
+        # 以下数组都按 image id 下标访问
+        self.tag_count = np.zeros(0, dtype=np.int32)
+        self.date_key = np.zeros(0, dtype=np.int64)
+        self.dir_id = np.zeros(0, dtype=np.int32)
+        # 所有图片按 (date, id) 倒序排列，图片变化后在用到时重新生成
+        self.order: Optional["np.ndarray"] = None
+        self.order_neg_dates: Optional["np.ndarray"] = None
+        self.last_log_id = 0
+
+    def grow(self, size: int):
+        if size <= len(self.date_key):
+            return
+        size = max(size, len(self.date_key) + len(self.date_key) // 4)
+        old = len(self.date_key)
+        self.tag_count = np.concatenate([self.tag_count, np.zeros(size - old, dtype=np.int32)])
+        self.date_key = np.concatenate([self.date_key, np.full(size - old, missing_date, dtype=np.int64)])
+        self.dir_id = np.concatenate([self.dir_id, np.full(size - old, -1, dtype=np.int32)])
+
+    def load_images(self, conn: Connection, ids: Optional[List[int]] = None):
+        """
+        Reads date and dir_id of the given images, or of all of them.
+        """
+        columns = "max(id), group_concat(id), group_concat(coalesce(strftime('%s', date), -1)), group_concat(coalesce(dir_id, -1))"
+        with closing(conn.cursor()) as cur:
+            if ids is None:
+                last_id = 0
+                while last_id is not None:
+                    cur.execute(
+                        f"SELECT {columns} FROM (SELECT id, date, dir_id FROM image WHERE id > ? ORDER BY id LIMIT ?)",
+                        (last_id, load_chunk_rows),
+                    )
+                    last_id = self.set_images(cur.fetchone())
+            else:
+                for i in range(0, len(ids), 500):
+                    chunk = ids[i : i + 500]
+                    self.grow(max(chunk) + 1)
+                    self.date_key[chunk] = missing_date  # 没查到的是已经删除的图片
+                    cur.execute(f"SELECT {columns} FROM image WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+                    self.set_images(cur.fetchone())
+        self.order = None
+
+    def set_images(self, row: tuple) -> Optional[int]:
+        last_id, image_ids, dates, dir_ids = row
+        if last_id is not None:
+            image_ids = np.fromstring(image_ids, dtype=np.int64, sep=",")
+            self.grow(last_id + 1)
+            self.date_key[image_ids] = np.fromstring(dates, dtype=np.int64, sep=",")
+            self.dir_id[image_ids] = np.fromstring(dir_ids, dtype=np.int64, sep=",")
+        return last_id
+
+    def load_tags(self, conn: Connection):
+        image_ids = []
+        tag_ids = []
+        last_rowid = 0
+        with closing(conn.cursor()) as cur:
+            while True:
+                cur.execute(
+                    """SELECT max(rowid), group_concat(image_id), group_concat(tag_id) FROM (
+                        SELECT rowid, image_id, tag_id FROM image_tag WHERE rowid > ? ORDER BY rowid LIMIT ?
+                    )""",
+                    (last_rowid, load_chunk_rows),
+                )
+                last_rowid, images, tags = cur.fetchone()
+                if last_rowid is None:
+                    break
+                image_ids.append(np.fromstring(images, dtype=np.int64, sep=","))
+                tag_ids.append(np.fromstring(tags, dtype=np.int64, sep=","))
+        if not image_ids:
+            return
+        image_ids = np.concatenate(image_ids)
+        tag_ids = np.concatenate(tag_ids)
+        if image_ids.max() >= 2**31 or tag_ids.max() >= 2**31:
+            raise ValueError("image or tag ids are too large for the tag index")
+        # 按 (tag_id, image_id) 排序后每个标签就是一段连续的有序 id
+        keys = (tag_ids << 32) | image_ids
+        keys.sort()
+        # 加载期间被删除又重新插入的行可能读到两次
+        keys = keys[np.append(True, keys[1:] != keys[:-1])]
+        tag_ids = keys >> 32
+        image_ids = (keys & 0xFFFFFFFF).astype(np.int32)
+        tags, starts = np.unique(tag_ids, return_index=True)
+        ends = np.append(starts[1:], len(tag_ids))
+        self.postings = {int(tag): image_ids[start:end] for tag, start, end in zip(tags, starts, ends)}
+        self.grow(int(image_ids.max()) + 1)
+        counts = np.bincount(image_ids)
+        self.tag_count[: len(counts)] = counts
+
+    def apply_log(self, conn: Connection, rows: List[tuple]):
+        tag_changes: Dict[int, Dict[int, bool]] = {}
+        changed_images = set()
+        for _, image_id, tag_id, added in rows:
+            if tag_id is None:
+                changed_images.add(image_id)
+            else:
+                # 同一对 (image_id, tag_id) 只有最后一次操作有效
+                tag_changes.setdefault(tag_id, {})[image_id] = bool(added)
+        for tag_id, changes in tag_changes.items():
+            ids = self.postings.get(tag_id, np.zeros(0, dtype=np.int32))
+            # 重建时加载的数据可能已经包含了部分日志，只处理真正变化的图片
+            changed = np.array(sorted(changes), dtype=np.int32)
+            present = contains_sorted(changed, ids)
+            wanted = np.array([changes[k] for k in changed.tolist()], dtype=bool)
+            added = changed[wanted & ~present]
+            removed = changed[~wanted & present]
+            if len(removed):
+                ids = ids[~contains_sorted(ids, removed)]
+                self.tag_count[removed] -= 1
+            if len(added):
+                ids = np.union1d(ids, added).astype(np.int32)
+                self.grow(int(added[-1]) + 1)
+                self.tag_count[added] += 1
+            if len(ids):
+                self.postings[tag_id] = ids
+            else:
+                self.postings.pop(tag_id, None)
+        if changed_images:
+            self.load_images(conn, sorted(changed_images))
+        self.last_log_id = rows[-1][0]
+
+    def get_order(self):
+        if self.order is None:
+            ids = np.flatnonzero(self.date_key != missing_date)
+            ids = ids[np.lexsort((ids, self.date_key[ids]))[::-1]]
+            self.order = ids
+            self.order_neg_dates = -self.date_key[ids]
+        return self.order, self.order_neg_dates
+
+    @staticmethod
+    def top_k(ids: "np.ndarray", keys: "np.ndarray", limit: int, desc: bool) -> "np.ndarray":
+        """
+        The first `limit` ids in (key, id) order.
+        """
+        if len(ids) > limit:
+            kth_pos = len(keys) - limit if desc else limit - 1
+            kth = np.partition(keys, kth_pos)[kth_pos]
+            sel = keys >= kth if desc else keys <= kth
+            ids, keys = ids[sel], keys[sel]
+        order = np.lexsort((ids, keys))
+        return ids[order[::-1] if desc else order][:limit]
+
+    def walk(self, mask: "np.ndarray", limit: int, after: Optional[Tuple[int, int]], filter) -> "np.ndarray":
+        """
+        Walks all images in (date, id) order and keeps the ones in mask that pass filter, for queries
+        that match a large part of the images. Only the images that were walked are filtered.
+        """
+        order, neg_dates = self.get_order()
+        pos = 0
+        if after:
+            date, id = after
+            # 同一秒的图片在 order 里按 id 倒序相邻
+            lo = int(np.searchsorted(neg_dates, -date, side="left"))
+            hi = int(np.searchsorted(neg_dates, -date, side="right"))
+            pos = lo + int(np.count_nonzero(order[lo:hi] >= id))
+        step = max(4096, limit * 4)
+        res = []
+        found = 0
+        while pos < len(order) and found < limit:
+            chunk = order[pos : pos + step]
+            hits = filter(chunk[mask[chunk]])
+            res.append(hits)
+            found += len(hits)
+            pos += step
+            step *= 2
+        return np.concatenate(res)[:limit] if res else np.zeros(0, dtype=np.int64)
+
+    def query(
+        self,
+        tag_dict: Dict[str, List[int]],
+        limit: int,
+        after: Optional[Tuple[int, int]],
+        dir_ids: Optional[List[int]],
+        seed: Optional[int],
+    ) -> List[int]:
+        """
+        after is the (date, id) of the last image of the previous page, or its (random key, id) when
+        a seed is given. The tag ids are already deduplicated by ImageTag.get_images_by_tags.
+        """
+        size = len(self.date_key)
+        empty = np.zeros(0, dtype=np.int32)
+        and_lists = sorted((self.postings.get(int(x), empty) for x in tag_dict.get("and") or []), key=len)
+        or_lists = [self.postings.get(int(x), empty) for x in tag_dict.get("or") or []]
+        not_lists = [self.postings.get(int(x), empty) for x in tag_dict.get("not") or []]
+        if dir_ids is not None:
+            dir_ids = np.array(dir_ids, dtype=np.int32)
+
+        # 从最短的列表出发，其他条件只检查它里面的图片
+        if and_lists:
+            ids = and_lists.pop(0)
+        elif or_lists and sum(map(len, or_lists)) < size // 8:
+            ids = np.unique(np.concatenate(or_lists))
+            or_lists = []
+        else:
+            ids = None
+
+        def filter(ids: "np.ndarray"):
+            for other in and_lists:
+                ids = ids[contains_sorted(ids, other)]
+            if or_lists:
+                ids = ids[np.any([contains_sorted(ids, other) for other in or_lists], axis=0)]
+            for other in not_lists:
+                ids = ids[~contains_sorted(ids, other)]
+            if dir_ids is not None:
+                ids = ids[np.isin(self.dir_id[ids], dir_ids)]
+            return ids
+
+        if ids is None or (seed is None and len(ids) >= size // 8):
+            if ids is not None:
+                mask = np.zeros(size, dtype=bool)
+                mask[ids] = True
+            elif or_lists:
+                mask = np.zeros(size, dtype=bool)
+                for other in or_lists:
+                    mask[other] = True
+                or_lists = []
+            else:
+                # 没有 and/or 时和 SQL 版本一样，范围是所有打过标签的图片
+                mask = self.tag_count > 0
+            if seed is None:
+                return self.walk(mask, limit, after, filter).tolist()
+            ids = np.flatnonzero(mask)
+
+        # 命中的图片不多，或者是随机排序，对所有命中的图片取前 limit 个
+        ids = filter(ids)
+        ids = ids[self.date_key[ids] != missing_date].astype(np.int64)
+        if seed is None:
+            keys = self.date_key[ids]
+        else:
+            keys = get_seeded_random_key(ids.astype(np.uint64), np.uint64(seed)).astype(np.int64)
+        if after:
+            key, id = after
+            if seed is None:
+                keep = (keys < key) | ((keys == key) & (ids < id))
+            else:
+                keep = (keys > key) | ((keys == key) & (ids > id))
+            ids, keys = ids[keep], keys[keep]
+        return self.top_k(ids, keys, limit, desc=seed is None).tolist()
+
+
+class TagIndex:
+    def __init__(self):
+        self.data: Optional[TagIndexData] = None
+        self.lock = threading.Lock()
+        self.building = False
+        # 在 image_tag_log_reader 中代表这个进程
+        self.reader_id = uuid.uuid4().hex
+        self.saved_log_id: Optional[int] = None
+        self.saved_at = 0.0
+
+    @classmethod
+    def create_table(cls, conn: Connection):
+        """
+        Creates the change log and its triggers. With the index disabled they are left alone while
+        another process may still read them, and dropped once no reader has been seen for
+        reader_timeout_seconds so writes don't pay for a log nobody reads.
+        """
+        with closing(conn.cursor()) as cur:
+            if not is_tag_index_enabled():
+                cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'image_tag_log'")
+                if not cur.fetchone():
+                    return
+                cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'image_tag_log_reader'")
+                if cur.fetchone():
+                    cur.execute(
+                        "SELECT 1 FROM image_tag_log_reader WHERE updated_at >= ? LIMIT 1",
+                        (int(time.time()) - reader_timeout_seconds,),
+                    )
+                    if cur.fetchone():
+                        return
+                for name in log_triggers:
+                    cur.execute(f"DROP TRIGGER IF EXISTS {name}")
+                cur.execute("DROP TABLE IF EXISTS image_tag_log")
+                cur.execute("DROP TABLE IF EXISTS image_tag_log_reader")
+                return
+            cur.execute(
+                """CREATE TABLE IF NOT EXISTS image_tag_log_reader (
+                        id TEXT PRIMARY KEY,
+                        last_log_id INTEGER,
+                        updated_at INTEGER
+                    )"""
+            )
+            cur.execute(
+                """CREATE TABLE IF NOT EXISTS image_tag_log (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        image_id INTEGER,
+                        tag_id INTEGER,
+                        added INTEGER
+                    )"""
+            )
+            for name, sql in log_triggers.items():
+                cur.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {sql}")
+
+    @classmethod
+    def get_last_log_id(cls, conn: Connection) -> Optional[int]:
+        """
+        None when the log doesn't exist, e.g. it was dropped by a process with the index disabled.
+        """
+        with closing(conn.cursor()) as cur:
+            cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'image_tag_log'")
+            if not cur.fetchone():
+                return None
+            cur.execute("SELECT seq FROM sqlite_sequence WHERE name = 'image_tag_log'")
+            row = cur.fetchone()
+            return row[0] if row else 0
+
+    def build(self):
+        from scripts.iib.db.datamodel import DataBase
+
+        try:
+            conn = DataBase.get_conn()
+            data = TagIndexData()
+            # 不用一个长的读事务，否则加载期间所有写入都会被阻塞。加载前记下日志的位置，
+            # 加载期间的变化会在之后重新应用一遍
+            data.last_log_id = self.get_last_log_id(conn)
+            if data.last_log_id is None:
+                return
+            # 先登记读取位置，加载期间其他进程不会删掉之后的日志
+            self.save_position(conn, data.last_log_id)
+            data.load_tags(conn)
+            data.load_images(conn)
+            data.get_order()
+            with self.lock:
+                self.data = data
+            logger.info("tag index built, %d tags, %d images", len(data.postings), len(data.order))
+            self.trim_log(conn, data.last_log_id)
+        except Exception as e:
+            logger.error("failed to build the tag index: %s", e)
+        finally:
+            with self.lock:
+                self.building = False
+
+    def start_build(self):
+        """
+        Builds the index in a background thread unless a build is already running, the caller holds self.lock.
+        """
+        if self.building:
+            return
+        self.building = True
+        threading.Thread(target=self.build, daemon=True, name="iib-tag-index").start()
+
+    def save_position(self, conn: Connection, last_log_id: int):
+        """
+        Records how far this process has read the log, no process trims beyond it.
+        """
+        now = time.time()
+        with closing(conn.cursor()) as cur:
+            cur.execute(
+                """INSERT INTO image_tag_log_reader (id, last_log_id, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET last_log_id = excluded.last_log_id, updated_at = excluded.updated_at""",
+                (self.reader_id, last_log_id, int(now)),
+            )
+        conn.commit()
+        self.saved_log_id = last_log_id
+        self.saved_at = now
+
+    def trim_log(self, conn: Connection, last_log_id: int):
+        """
+        Saves the read position from time to time and deletes the rows every reader has read.
+        """
+        if (
+            self.saved_log_id is not None
+            and last_log_id - self.saved_log_id < trim_log_rows
+            and time.time() - self.saved_at < reader_heartbeat_seconds
+        ):
+            return
+        try:
+            self.save_position(conn, last_log_id)
+            with closing(conn.cursor()) as cur:
+                cur.execute(
+                    "DELETE FROM image_tag_log_reader WHERE updated_at < ?",
+                    (int(time.time()) - reader_timeout_seconds,),
+                )
+                cur.execute("DELETE FROM image_tag_log WHERE id <= (SELECT MIN(last_log_id) FROM image_tag_log_reader)")
+            conn.commit()
+        except OperationalError as e:
+            # 其他进程正在写入，下次再删
+            logger.warning("failed to trim image_tag_log: %s", e)
+
+    def sync(self, conn: Connection) -> bool:
+        """
+        Applies new log rows, returns False when the index isn't usable right now.
+        """
+        data = self.data
+        last_log_id = self.get_last_log_id(conn)
+        if last_log_id is None:
+            self.create_table(conn)
+            conn.commit()
+            self.data = None
+            self.start_build()
+            return False
+        if data is None:
+            self.start_build()
+            return False
+        if last_log_id == data.last_log_id:
+            self.trim_log(conn, data.last_log_id)
+            return True
+        if last_log_id < data.last_log_id or last_log_id - data.last_log_id > max_incremental_rows:
+            self.start_build()
+            return False
+        with closing(conn.cursor()) as cur:
+            cur.execute(
+                "SELECT id, image_id, tag_id, added FROM image_tag_log WHERE id > ? ORDER BY id",
+                (data.last_log_id,),
+            )
+            rows = cur.fetchall()
+        if not rows or rows[0][0] != data.last_log_id + 1:
+            # 日志被其他进程删掉或重建过，中间的变化已经丢了
+            self.start_build()
+            return False
+        data.apply_log(conn, rows)
+        self.trim_log(conn, data.last_log_id)
+        return True
+
+    def query(
+        self,
+        conn: Connection,
+        tag_dict: Dict[str, List[int]],
+        limit: int,
+        after: Optional[Tuple] = None,
+        dir_ids: Optional[List[int]] = None,
+        seed: Optional[int] = None,
+    ) -> Optional[List[int]]:
+        """
+        Ids of the matching images like ImageTag.get_images_by_tags, after is the (date, id) of the
+        last image of the previous page, or its (random key, id) when a seed is given.
+        None means the index can't answer and the caller should use SQL.
+        """
+        if not is_tag_index_enabled():
+            return None
+        if after and seed is None:
+            date_key = parse_date_key(after[0])
+            if date_key is None:
+                return None
+            after = (date_key, after[1])
+        with self.lock:
+            try:
+                if not self.sync(conn):
+                    return None
+            except Exception as e:
+                logger.error("failed to update the tag index: %s", e)
+                self.data = None
+                return None
+            return self.data.query(tag_dict, limit, after, dir_ids, seed)
+
+
+tag_index = TagIndex()
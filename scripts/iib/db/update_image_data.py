@@ -1,6 +1,8 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import closing
-from typing import Dict, List
-from scripts.iib.db.datamodel import Image as DbImg, Tag, ImageTag, DataBase, Folder
+from typing import Dict, Iterable, List, Optional, Tuple
+from scripts.iib.db.datamodel import Image as DbImg, Tag, TagCache, ImageTag, DataBase, Folder
 import os
 from scripts.iib.tool import (
     is_valid_media_path,
@@ -12,6 +14,7 @@ from scripts.iib.tool import (
     is_audio_file,
     case_insensitive_get,
     get_img_geninfo_txt_path,
+    get_process_pool_context,
     parse_generation_parameters
 )
 from scripts.iib.parsers.model import ImageGenerationInfo, ImageGenerationParams
@@ -19,6 +22,9 @@ from scripts.iib.logger import logger
 from scripts.iib.parsers.index import parse_image_info
 from scripts.iib.plugin import plugin_inst_map
 from scripts.iib.auto_tag import AutoTagMatcher
+from scripts.iib.blob_store import blob_store, is_blob_backend_enabled
+from scripts.iib.cache_manager import cache_manager, get_thumbnail_blob_key, get_thumbnail_cache_path
+from scripts.iib.thumbnail import generate_thumbnails
 
 # 定义一个函数来获取图片文件的EXIF数据
 def get_exif_data(file_path):
@@ -52,73 +58,311 @@ def get_exif_data(file_path):
     return ImageGenerationInfo()
 
 
-def update_image_data(search_dirs: List[str], is_rebuild = False):
+def get_index_thumbnail_sizes() -> List[str]:
+    """
+    IIB_INDEX_GENERATE_THUMBNAILS=true also generates the thumbnails of IIB_INDEX_THUMBNAIL_SIZES
+    (default 512x512) while indexing.
+    """
+    if os.getenv("IIB_INDEX_GENERATE_THUMBNAILS", "false").lower() != "true":
+        return []
+    sizes = os.getenv("IIB_INDEX_THUMBNAIL_SIZES", "512x512")
+    return [x.strip() for x in sizes.split(",") if x.strip()]
+
+
+def get_exif_data_and_thumbnails(file_path, thumbnails: List[Tuple[str, Optional[str]]]):
+    """
+    Runs in the index worker, the thumbnails are generated right after parsing while the file is still in the page cache.
+    """
+    info = get_exif_data(file_path)
+    rendered = []
+    if thumbnails:
+        try:
+            rendered = generate_thumbnails(file_path, thumbnails)
+        except Exception as e:
+            logger.error("Failed to generate thumbnails while indexing. file:%s error: %s", file_path, e)
+    return info, rendered
+
+
+class IndexThumbnails:
+    """
+    Decides which thumbnails an indexed image is missing and stores what the workers rendered.
+    Runs in the indexing thread, the workers never touch the blob store or the cache index.
+    """
+
+    def __init__(self, sizes: List[str]):
+        self.sizes = sizes
+        self.use_blob = is_blob_backend_enabled()
+        self.generated = 0
+
+    def get_targets(self, file_path: str) -> Tuple[Optional[str], List[Tuple[str, Optional[str]]]]:
+        """
+        Returns (t, [(size, cache_path)]), cache_path is None for the blob store.
+        """
+        if not self.sizes or not is_image_file(file_path):
+            return None, []
+        # 小于64KB的图片浏览时直接返回原图
+        if os.path.getsize(file_path) < 64 * 1024:
+            return None, []
+        t = get_modified_date(file_path)
+        targets = []
+        for size in self.sizes:
+            if self.use_blob:
+                _, key = get_thumbnail_blob_key(file_path, t, size)
+                if not blob_store.contains(key):
+                    targets.append((size, None))
+            else:
+                _, cache_path = get_thumbnail_cache_path(file_path, t, size)
+                if not os.path.exists(cache_path):
+                    targets.append((size, cache_path))
+        return t, targets
+
+    def save(self, file_path: str, t: str, rendered: List[Tuple[str, Optional[bytes]]]):
+        for size, data in rendered:
+            if data is None:
+                _, cache_path = get_thumbnail_cache_path(file_path, t, size)
+            else:
+                _, key = get_thumbnail_blob_key(file_path, t, size)
+                blob_store.put(key, data)
+                cache_path = blob_store.get_entry_path(key)
+            cache_manager.add(cache_path, file_path, t, miss=False)
+            self.generated += 1
+
+
+class ExifParserPool:
+    """
+    Run get_exif_data in worker processes and hand the results back in submission order.
+    If the process pool can't be started or breaks, parsing continues in the calling thread.
+    With thumbnail sizes, the same workers also generate the missing thumbnails of each image.
+    """
+
+    def __init__(self, workers: int, thumbnail_sizes: Optional[List[str]] = None):
+        self.workers = workers
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.disabled = workers <= 1
+        self.thumbnails = IndexThumbnails(thumbnail_sizes or [])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+    def _disable(self, e: Exception):
+        logger.error("Index worker processes are unavailable, parsing in the current thread. error: %s", e)
+        self.disabled = True
+        try:
+            self.shutdown()
+        except Exception:
+            pass
+
+    def _submit(self, file_path: str, thumbnails: List[Tuple[str, Optional[str]]]):
+        if self.disabled:
+            return None
+        try:
+            if not self.executor:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=get_process_pool_context())
+            return self.executor.submit(get_exif_data_and_thumbnails, file_path, thumbnails)
+        except Exception as e:
+            self._disable(e)
+        return None
+
+    def _result(self, file_path: str, job) -> ImageGenerationInfo:
+        t, thumbnails, future = job
+        res = None
+        if future is not None:
+            try:
+                res = future.result()
+            except Exception as e:
+                self._disable(e)
+        if res is None:
+            res = get_exif_data_and_thumbnails(file_path, thumbnails)
+        info, rendered = res
+        if rendered:
+            try:
+                self.thumbnails.save(file_path, t, rendered)
+            except Exception as e:
+                logger.error("Failed to save thumbnails while indexing. file:%s error: %s", file_path, e)
+        return info
+
+    def _start(self, file_path: str):
+        try:
+            t, thumbnails = self.thumbnails.get_targets(file_path)
+        except OSError:
+            t, thumbnails = None, []
+        return t, thumbnails, self._submit(file_path, thumbnails)
+
+    def imap(self, tasks: Iterable[Tuple[str, str]]):
+        """
+        tasks yields ("file", path) or ("folder", path), results are (kind, path, info) in the same order.
+        Only "file" tasks are parsed, the others are passed through so the writer keeps the walk order.
+        """
+        pending = deque()
+        window = self.workers * 8
+        for kind, path in tasks:
+            pending.append((kind, path, self._start(path) if kind == "file" else None))
+            while len(pending) > (0 if self.disabled else window):
+                kind, path, job = pending.popleft()
+                yield kind, path, self._result(path, job) if kind == "file" else None
+        while pending:
+            kind, path, job = pending.popleft()
+            yield kind, path, self._result(path, job) if kind == "file" else None
+
+
+def get_index_workers() -> int:
+    """
+    Number of worker processes used to parse image metadata while indexing.
+    IIB_INDEX_WORKERS=1 (default) keeps everything in the calling thread, 0 means one per CPU.
+    """
+    value = os.getenv("IIB_INDEX_WORKERS", "1")
+    try:
+        workers = int(value)
+    except ValueError:
+        logger.warning("invalid IIB_INDEX_WORKERS %r, parsing in the calling thread", value)
+        return 1
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+class IndexWriter:
+    """
+    Buffer the rows produced while indexing and write them with executemany in large transactions,
+    instead of one statement per row and a commit per folder.
+
+    A flush applies removed images -> images -> image tags -> tag counts -> folders in one transaction,
+    folders go last so a folder is only marked up to date together with the images under it.
+    """
+
+    flush_threshold = 2000
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.removed_img_ids: List[int] = []
+        self.imgs: List[DbImg] = []
+        self.img_tags: List[Tuple[str, int]] = []  # (image path, tag id)
+        self.tag_incr_count_rec: Dict[int, int] = {}
+        self.folders: List[Tuple[str, str]] = []  # (folder path, modified date)
+
+    def remove_img(self, img_id: int):
+        self.removed_img_ids.append(img_id)
+
+    def save_img(self, img: DbImg):
+        self.imgs.append(img)
+
+    def save_img_tag(self, img_path: str, tag_id: int, incr_count=True):
+        self.img_tags.append((img_path, tag_id))
+        if incr_count:
+            self.tag_incr_count_rec[tag_id] = self.tag_incr_count_rec.get(tag_id, 0) + 1
+
+    def update_folder(self, folder_path: str):
+        # 在遍历完成时记录修改时间，避免把 flush 前新增的文件标记为已索引
+        self.folders.append((folder_path, get_modified_date(folder_path)))
+
+    def maybe_flush(self):
+        if len(self.imgs) >= self.flush_threshold or len(self.img_tags) >= self.flush_threshold * 32:
+            self.flush()
+
+    def flush(self):
+        conn = self.conn
+        DbImg.safe_batch_remove(conn, self.removed_img_ids)
+        DbImg.batch_save(conn, self.imgs)
+        img_ids = DbImg.get_ids_by_paths(conn, [path for path, _ in self.img_tags])
+        ImageTag.batch_save_or_ignore(
+            conn,
+            [(img_ids[path], tag_id) for path, tag_id in self.img_tags if path in img_ids],
+        )
+        Tag.batch_incr_count(conn, self.tag_incr_count_rec)
+        for folder_path, modified_date in self.folders:
+            Folder.update_modified_date_or_create(conn, folder_path, modified_date)
+        conn.commit()
+        self.removed_img_ids = []
+        self.imgs = []
+        self.img_tags = []
+        self.tag_incr_count_rec = {}
+        self.folders = []
+
+
+def update_image_data(search_dirs: List[str], is_rebuild = False, workers: Optional[int] = None):
+    """
+    Index all media files under search_dirs.
+
+    The work is split into three stages:
+    - the walker lists folders and decides which files need (re)indexing,
+    - a pool of worker processes runs the parser chain (get_exif_data),
+    - the calling thread is the only writer and applies the results to SQLite in walk order
+      through an IndexWriter, so the produced index is the same as a single threaded run.
+    With IIB_INDEX_GENERATE_THUMBNAILS=true the workers also generate the missing thumbnails.
+    """
     conn = DataBase.get_conn()
-    tag_incr_count_rec: Dict[int, int] = {}
+    workers = workers or get_index_workers()
 
     if is_rebuild:
         Folder.remove_all(conn)
+    tag_cache = TagCache(conn)
+    writer = IndexWriter(conn)
 
-    def safe_save_img_tag(img_tag: ImageTag):
-        tag_incr_count_rec[img_tag.tag_id] = (
-            tag_incr_count_rec.get(img_tag.tag_id, 0) + 1
-        )
-        img_tag.save_or_ignore(conn)  # 原先用来处理一些意外，但是写的正确完全没问题,去掉了try catch
+    walked_folders = set()
 
-    # 递归处理每个文件夹
-    def process_folder(folder_path: str):
-        if not Folder.check_need_update(conn, folder_path):
+    # 递归遍历每个文件夹，按处理顺序产出待解析的文件和已遍历完成的文件夹
+    def walk_folder(folder_path: str):
+        folder_key = os.path.normpath(folder_path)
+        if folder_key in walked_folders or not Folder.check_need_update(conn, folder_path):
             return
+        walked_folders.add(folder_key)
         print(f"Processing folder: {folder_path}")
         for filename in os.listdir(folder_path):
             file_path = os.path.normpath(os.path.join(folder_path, filename))
             try:
-
                 if os.path.isdir(file_path):
-                    process_folder(file_path)
-                elif is_valid_media_path(file_path):
-                    build_single_img_idx(conn, file_path, is_rebuild, safe_save_img_tag)
+                    yield from walk_folder(file_path)
+                elif is_valid_media_path(file_path) and need_update_img_idx(conn, file_path, is_rebuild):
+                    yield "file", file_path
                 # neg暂时跳过感觉个没人会搜索这个
             except Exception as e:
                 logger.error("Tag generation failed. Skipping this file. file:%s error: %s", file_path, e)
-        # 提交对数据库的更改
-        Folder.update_modified_date_or_create(conn, folder_path)
-        conn.commit()
+        yield "folder", folder_path
 
-    for dir in search_dirs:
-        process_folder(dir)
-        conn.commit()
-    for tag_id in tag_incr_count_rec:
-        tag = Tag.get(conn, tag_id)
-        tag.count += tag_incr_count_rec[tag_id]
-        tag.save(conn)
-    conn.commit()
+    def walk():
+        for dir in search_dirs:
+            yield from walk_folder(dir)
 
-def add_image_data_single(file_path):
-    conn = DataBase.get_conn()
-    tag_incr_count_rec: Dict[int, int] = {}
+    with ExifParserPool(workers, get_index_thumbnail_sizes()) as parser_pool:
+        for kind, path, info in parser_pool.imap(walk()):
+            if kind == "folder":
+                writer.update_folder(path)
+                writer.maybe_flush()
+                continue
+            try:
+                build_single_img_idx(conn, path, is_rebuild, writer, info=info, tag_cache=tag_cache)
+            except Exception as e:
+                logger.error("Tag generation failed. Skipping this file. file:%s error: %s", path, e)
+        if parser_pool.thumbnails.generated:
+            cache_manager.flush()
+            print(f"Generated {parser_pool.thumbnails.generated} thumbnails while indexing")
+    writer.flush()
 
-    def safe_save_img_tag(img_tag: ImageTag):
-        tag_incr_count_rec[img_tag.tag_id] = (
-            tag_incr_count_rec.get(img_tag.tag_id, 0) + 1
-        )
-        img_tag.save_or_ignore(conn)
+def add_image_data_single(file_path, tag_cache: Optional[TagCache] = None):
+    """
+    Callers that add many files in a row can pass a shared TagCache (e.g. TagCache(conn))
+    to resolve tags from memory, by default tags are looked up lazily.
+    """
+    conn = DataBase.get_conn()
+    writer = IndexWriter(conn)
 
     file_path = os.path.normpath(file_path)
     try:
         if not is_valid_media_path(file_path):
             return
-        build_single_img_idx(conn, file_path, False, safe_save_img_tag)
+        build_single_img_idx(conn, file_path, False, writer, tag_cache=tag_cache)
         # neg暂时跳过感觉个没人会搜索这个
     except Exception as e:
         logger.error("Tag generation failed. Skipping this file. file:%s error: %s", file_path, e)
-        conn.commit()
-
-    for tag_id in tag_incr_count_rec:
-        tag = Tag.get(conn, tag_id)
-        tag.count += tag_incr_count_rec[tag_id]
-        tag.save(conn)
-    conn.commit()
+    writer.flush()
 
 def rebuild_image_index(search_dirs: List[str]):
     conn = DataBase.get_conn()
@@ -144,11 +388,31 @@ def get_extra_meta_keys_from_plugins(source_identifier: str):
         logger.error("get_extra_meta_keys_from_plugins %s", e)
     return []
 
-def build_single_img_idx(conn, file_path, is_rebuild, safe_save_img_tag):
+def need_update_img_idx(conn, file_path, is_rebuild) -> bool:
+    if is_rebuild:
+        return True
+    img = DbImg.get(conn, file_path)
+    return not img or img.date != get_modified_date(img.path)
+
+
+def build_single_img_idx(
+    conn,
+    file_path,
+    is_rebuild,
+    writer: IndexWriter,
+    info: Optional[ImageGenerationInfo] = None,
+    tag_cache: Optional[TagCache] = None,
+):
+    """
+    Rows are only buffered in writer, call writer.flush() to write them to the database.
+    info can be passed in when the metadata was already parsed elsewhere (e.g. by ExifParserPool).
+    tag_cache should be shared across a whole indexing run to avoid a tag lookup per prompt token.
+    """
+    tag_cache = tag_cache or TagCache(conn, preload=False)
     img = DbImg.get(conn, file_path)
     parsed_params = None
     if is_rebuild:
-        info = get_exif_data(file_path)
+        info = info or get_exif_data(file_path)
         parsed_params = info.params
         if not img:
             img = DbImg(
@@ -157,14 +421,14 @@ def build_single_img_idx(conn, file_path, is_rebuild, safe_save_img_tag):
                 os.path.getsize(file_path),
                 get_modified_date(file_path),
             )
-            img.save(conn)
+            writer.save_img(img)
     else:
         if img:  # 已存在的跳过
             if img.date == get_modified_date(img.path):
                 return
             else:
-                DbImg.safe_batch_remove(conn=conn, image_ids=[img.id])
-        info = get_exif_data(file_path)
+                writer.remove_img(img.id)
+        info = info or get_exif_data(file_path)
         parsed_params = info.params
         img = DbImg(
             file_path,
@@ -172,7 +436,7 @@ def build_single_img_idx(conn, file_path, is_rebuild, safe_save_img_tag):
             os.path.getsize(file_path),
             get_modified_date(file_path),
         )
-        img.save(conn)
+        writer.save_img(img)
 
     if not parsed_params:
         return
@@ -184,13 +448,14 @@ def build_single_img_idx(conn, file_path, is_rebuild, safe_save_img_tag):
     else:
         size_str = "Unknown Size"
     pos = parsed_params.pos_prompt
-    size_tag = Tag.get_or_create(
-        conn,
-        size_str,
-        type="size",
-    )
-    if size_tag:
-        safe_save_img_tag(ImageTag(img.id, size_tag.id))
+
+    def save_tag(name: str, type: str):
+        tag_id = tag_cache.get_or_create(name, type)
+        if tag_id is not None:
+            writer.save_img_tag(img.path, tag_id)
+        return tag_id
+
+    save_tag(size_str, "size")
     # 确定媒体类型：Image / Video / Audio / Unknown
     if is_image_file(file_path):
         media_type_name = "Image"
@@ -200,9 +465,7 @@ def build_single_img_idx(conn, file_path, is_rebuild, safe_save_img_tag):
         media_type_name = "Video"
     else:
         media_type_name = "Unknown"
-    media_type_tag = Tag.get_or_create(conn, media_type_name, 'Media Type')
-    if media_type_tag:
-        safe_save_img_tag(ImageTag(img.id, media_type_tag.id))
+    save_tag(media_type_name, 'Media Type')
     keys = [
         "Model",
         "Sampler",
@@ -219,28 +482,17 @@ def build_single_img_idx(conn, file_path, is_rebuild, safe_save_img_tag):
         if not v:
             continue
         
-        tag = Tag.get_or_create(conn, str(v), k)
-        if tag:
-            safe_save_img_tag(ImageTag(img.id, tag.id))
+        if save_tag(str(v), k) is not None:
             if "Hires upscaler" == k:
-                tag = Tag.get_or_create(conn, 'Hires All', k)
-                if tag:
-                    safe_save_img_tag(ImageTag(img.id, tag.id))
+                save_tag('Hires All', k)
             elif "Refiner" == k:
-                tag = Tag.get_or_create(conn, 'Refiner All', k)
-                if tag:
-                    safe_save_img_tag(ImageTag(img.id, tag.id))
+                save_tag('Refiner All', k)
     for i in lora:
-        tag = Tag.get_or_create(conn, i["name"], "lora")
-        if tag:
-            safe_save_img_tag(ImageTag(img.id, tag.id))
+        save_tag(i["name"], "lora")
     for i in lyco:
-        tag = Tag.get_or_create(conn, i["name"], "lyco")
-        if tag:
-            safe_save_img_tag(ImageTag(img.id, tag.id))
+        save_tag(i["name"], "lyco")
     for k in pos:
-        tag = Tag.get_or_create(conn, k, "pos")
-        if tag:
-            safe_save_img_tag(ImageTag(img.id, tag.id))
+        save_tag(k, "pos")
     
-    AutoTagMatcher.get_instance(conn).apply(img.id, parsed_params)
\ No newline at end of file
+    for tag_id in AutoTagMatcher.get_instance(conn).match_tag_ids(parsed_params, tag_cache):
+        writer.save_img_tag(img.path, tag_id, incr_count=False)
\ No newline at end of file
@@ -0,0 +1,415 @@
+"""
+Directory listing for /files, with server side sorting and cursor pagination.
+
+Sorting by name doesn't need a stat, so only the entries of the requested page (or the streamed
+chunk) are stat'ed. The other sorts have to stat the whole folder first, but only the entries
+that are returned are turned into FileInfoDicts. Folders always come first, like sortFiles in the
+frontend, and ties are broken by name so the cursor is stable.
+
+Listings are cached in memory as DirSnapshots (columns of names, sizes, times and folder bits,
+plus the sort orders that were requested), keyed by the folder and validated by the folder's
+mtime and inode. Adding, removing or renaming an entry changes the folder's mtime, a file that is
+rewritten in place doesn't, the fs watcher invalidates those when it's enabled.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from stat import S_ISDIR, S_ISREG
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from scripts.iib.cache_manager import parse_size
+from scripts.iib.db.datamodel import Cursor, FileInfoDict
+from scripts.iib.logger import logger
+from scripts.iib.tool import (
+    get_created_timestamp_by_stat,
+    get_formatted_date,
+    human_readable_size,
+)
+
+# 与前端的 SortMethod 一致
+sort_fields = ("name", "date", "size", "created-time")
+
+
+class DirEntry(NamedTuple):
+    name: str
+    is_dir: bool
+    size: int
+    mtime: float
+    created: float
+
+
+def parse_sort(sort: str) -> Tuple[str, bool]:
+    """
+    "date-desc" -> ("date", True)
+    """
+    field, _, order = sort.rpartition("-")
+    if field not in sort_fields or order not in ("asc", "desc"):
+        raise ValueError(f"invalid sort: {sort}")
+    return field, order == "desc"
+
+
+def stat_entry(folder_path: str, name: str) -> Optional[DirEntry]:
+    """
+    Returns None for entries that are neither files nor folders, or can't be stat'ed (broken links).
+    """
+    try:
+        stat = os.stat(os.path.join(folder_path, name))
+    except OSError:
+        return None
+    return to_dir_entry(name, stat)
+
+
+def to_dir_entry(name: str, stat: os.stat_result) -> Optional[DirEntry]:
+    is_dir = S_ISDIR(stat.st_mode)
+    if not is_dir and not S_ISREG(stat.st_mode):
+        return None
+    return DirEntry(name, is_dir, stat.st_size, stat.st_mtime, get_created_timestamp_by_stat(stat))
+
+
+def to_file_info(folder_path: str, entry: DirEntry, is_under_scanned_path: bool) -> FileInfoDict:
+    fullpath = os.path.normpath(os.path.join(folder_path, entry.name))
+    date = get_formatted_date(entry.mtime)
+    created_time = get_formatted_date(entry.created)
+    if entry.is_dir:
+        return {
+            "type": "dir",
+            "date": date,
+            "created_time": created_time,
+            "size": "-",
+            "name": entry.name,
+            "is_under_scanned_path": is_under_scanned_path,
+            "fullpath": fullpath,
+        }
+    return {
+        "type": "file",
+        "date": date,
+        "size": human_readable_size(entry.size),
+        "name": entry.name,
+        "bytes": entry.size,
+        "created_time": created_time,
+        "fullpath": fullpath,
+        "is_under_scanned_path": is_under_scanned_path,
+    }
+
+
+def get_entry_key(entry: DirEntry, field: str):
+    if field == "name":
+        return (entry.name.lower(), entry.name)
+    if field == "date":
+        return (entry.mtime, entry.name)
+    if field == "size":
+        return (0 if entry.is_dir else entry.size, entry.name)
+    return (entry.created, entry.name)
+
+
+def encode_cursor(is_dir: bool, key: tuple) -> str:
+    return json.dumps([is_dir, *key], ensure_ascii=False)
+
+
+def find_cursor_index(count: int, key_at: Callable[[int], Tuple[bool, tuple]], desc: bool, cursor: str) -> int:
+    """
+    Index of the first entry after the cursor, key_at(i) returns (is_dir, get_entry_key) of the
+    i-th entry in sort order. The entry the cursor was taken from doesn't need to exist any more.
+    """
+    try:
+        is_dir, *key = json.loads(cursor)
+        key = tuple(key)
+    except (ValueError, TypeError):
+        raise ValueError(f"invalid cursor: {cursor}")
+
+    def is_after(i: int):
+        entry_is_dir, entry_key = key_at(i)
+        if entry_is_dir != is_dir:
+            return is_dir
+        return entry_key < key if desc else entry_key > key
+
+    lo, hi = 0, count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if is_after(mid):
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+def get_listing_cache_max_bytes() -> int:
+    """
+    IIB_DIR_LISTING_CACHE_BYTES, 0 disables the cache.
+    """
+    try:
+        return max(0, parse_size(os.getenv("IIB_DIR_LISTING_CACHE_BYTES", "64M")))
+    except ValueError:
+        logger.error("invalid IIB_DIR_LISTING_CACHE_BYTES: %s", os.getenv("IIB_DIR_LISTING_CACHE_BYTES"))
+        return 0
+
+
+class DirSnapshot:
+    """
+    The entries of a folder as columns, a few bytes per entry instead of a tuple and several
+    objects each. Without stat only the names and folder bits are known, entries are then stat'ed
+    when they're returned.
+    """
+
+    def __init__(self, version: tuple, names: List[str], is_dir: bytearray, stats: Optional[Tuple[array, array, array]]):
+        self.version = version
+        self.count = len(names)
+        # 名字拼成一个字符串，按偏移取
+        self.names = "\0".join(names)
+        offsets = array("I", [0])
+        for name in names:
+            offsets.append(offsets[-1] + len(name) + 1)
+        self.offsets = offsets
+        self.is_dir = is_dir
+        self.has_stat = stats is not None
+        self.sizes, self.mtimes, self.ctimes = stats or (array("q"), array("d"), array("d"))
+        # (field, desc) -> 排序后的下标
+        self.orders: Dict[Tuple[str, bool], array] = {}
+
+    @classmethod
+    def scan(cls, folder_path: str, version: tuple, with_stat: bool) -> "DirSnapshot":
+        names, is_dir = [], bytearray()
+        stats = (array("q"), array("d"), array("d")) if with_stat else None
+        with os.scandir(folder_path) as it:
+            for item in it:
+                if with_stat:
+                    try:
+                        entry = to_dir_entry(item.name, item.stat())
+                    except OSError:
+                        entry = None
+                    if entry is None:
+                        continue
+                    stats[0].append(entry.size)
+                    stats[1].append(entry.mtime)
+                    stats[2].append(entry.created)
+                    entry_is_dir = entry.is_dir
+                else:
+                    try:
+                        entry_is_dir = item.is_dir()
+                    except OSError:
+                        entry_is_dir = False
+                names.append(item.name)
+                is_dir.append(entry_is_dir)
+        return cls(version, names, is_dir, stats)
+
+    def get_nbytes(self):
+        arrays = [self.offsets, self.sizes, self.mtimes, self.ctimes, *self.orders.values()]
+        return sys.getsizeof(self.names) + len(self.is_dir) + sum(a.itemsize * len(a) for a in arrays)
+
+    def name_at(self, i: int) -> str:
+        return self.names[self.offsets[i] : self.offsets[i + 1] - 1]
+
+    def entry_at(self, i: int, folder_path: str) -> Optional[DirEntry]:
+        if not self.has_stat:
+            return stat_entry(folder_path, self.name_at(i))
+        return DirEntry(self.name_at(i), bool(self.is_dir[i]), self.sizes[i], self.mtimes[i], self.ctimes[i])
+
+    def key_at(self, i: int, field: str) -> Tuple[bool, tuple]:
+        """
+        Same as get_entry_key(entry_at(i)).
+        """
+        name = self.name_at(i)
+        if field == "name":
+            key = (name.lower(), name)
+        elif field == "date":
+            key = (self.mtimes[i], name)
+        elif field == "size":
+            key = (0 if self.is_dir[i] else self.sizes[i], name)
+        else:
+            key = (self.ctimes[i], name)
+        return bool(self.is_dir[i]), key
+
+    def sort(self, field: str, desc: bool) -> array:
+        """
+        Indexes in the order of sorting by (not is_dir, get_entry_key), with C level sort keys,
+        it's the slow part of a large folder.
+        """
+        names = self.names.split("\0") if self.count else []
+        if field == "name":
+            primary = [name.lower() for name in names]
+        elif field == "date":
+            primary = self.mtimes
+        elif field == "size":
+            primary = [0 if d else size for d, size in zip(self.is_dir, self.sizes)]
+        else:
+            primary = self.ctimes
+        order = list(range(self.count))
+        order.sort(key=names.__getitem__, reverse=desc)
+        order.sort(key=primary.__getitem__, reverse=desc)
+        is_file = bytes(not d for d in self.is_dir)
+        order.sort(key=is_file.__getitem__)  # 稳定排序，文件夹在前
+        return array("I", order)
+
+
+def get_dir_version(stat: os.stat_result) -> tuple:
+    return (stat.st_mtime_ns, stat.st_ino, stat.st_dev)
+
+
+class DirListingCache:
+    # mtime 这么近的文件夹不缓存，同一时间精度内的后续修改看不出来
+    racy_seconds = 2
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.items: "OrderedDict[str, DirSnapshot]" = OrderedDict()
+        self.bytes = 0
+
+    def get(self, folder_path: str, with_stat: bool) -> DirSnapshot:
+        stat = os.stat(folder_path)
+        version = get_dir_version(stat)
+        with self.lock:
+            snapshot = self.items.get(folder_path)
+            if snapshot and snapshot.version == version and (snapshot.has_stat or not with_stat):
+                self.items.move_to_end(folder_path)
+                return snapshot
+        # 版本在扫描前取得，扫描期间的修改会让下次访问重新扫描
+        snapshot = DirSnapshot.scan(folder_path, version, with_stat)
+        if self.max_bytes and time.time() - stat.st_mtime > self.racy_seconds:
+            self.put(folder_path, snapshot)
+        return snapshot
+
+    def get_cached(self, folder_path: str) -> Optional[DirSnapshot]:
+        """
+        The cached listing with stat if it's still valid, nothing is scanned.
+        """
+        stat = os.stat(folder_path)
+        with self.lock:
+            snapshot = self.items.get(folder_path)
+        if snapshot and snapshot.has_stat and snapshot.version == get_dir_version(stat):
+            return snapshot
+        return None
+
+    def get_order(self, snapshot: DirSnapshot, field: str, desc: bool) -> array:
+        order = snapshot.orders.get((field, desc))
+        if order is None:
+            order = snapshot.sort(field, desc)
+            with self.lock:
+                # 其他请求可能同时排好了同一个顺序，只记一次大小
+                existing = snapshot.orders.get((field, desc))
+                if existing is not None:
+                    return existing
+                snapshot.orders[(field, desc)] = order
+                if any(s is snapshot for s in self.items.values()):
+                    self.bytes += order.itemsize * len(order)
+                    self.evict()
+        return order
+
+    def put(self, folder_path: str, snapshot: DirSnapshot):
+        nbytes = snapshot.get_nbytes()
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            old = self.items.pop(folder_path, None)
+            if old:
+                self.bytes -= old.get_nbytes()
+            self.items[folder_path] = snapshot
+            self.bytes += nbytes
+            self.evict()
+
+    def evict(self):
+        while self.bytes > self.max_bytes and self.items:
+            _, snapshot = self.items.popitem(last=False)
+            self.bytes -= snapshot.get_nbytes()
+
+    def invalidate(self, path: str):
+        with self.lock:
+            snapshot = self.items.pop(os.path.normpath(path), None)
+            if snapshot:
+                self.bytes -= snapshot.get_nbytes()
+
+    def on_fs_event(self, kind: str, path: str, src: Optional[str] = None):
+        """
+        FsWatcher listener, the parent folder of a changed file is invalidated even if its mtime didn't change.
+        """
+        for p in (path, src):
+            if p:
+                self.invalidate(p)
+                self.invalidate(os.path.dirname(p))
+
+
+dir_listing_cache = DirListingCache(get_listing_cache_max_bytes())
+
+
+class SortedDir:
+    """
+    A folder in sort order. Sorted by name only the names are read, entries are stat'ed when
+    they're returned, otherwise every entry was stat'ed to sort them.
+    """
+
+    def __init__(self, folder_path: str, sort: str):
+        self.folder_path = folder_path
+        self.field, self.desc = parse_sort(sort)
+        self.snapshot = dir_listing_cache.get(folder_path, with_stat=self.field != "name")
+        self.order = dir_listing_cache.get_order(self.snapshot, self.field, self.desc)
+
+    def __len__(self):
+        return self.snapshot.count
+
+    def key_at(self, i: int) -> Tuple[bool, tuple]:
+        return self.snapshot.key_at(self.order[i], self.field)
+
+    def get_entries(self, start: int, end: int) -> List[DirEntry]:
+        """
+        Entries that vanished in the meantime are skipped.
+        """
+        entries = (self.snapshot.entry_at(i, self.folder_path) for i in self.order[start:end])
+        return [e for e in entries if e]
+
+    def get_page(self, cursor: str, limit: int) -> Tuple[List[DirEntry], Cursor]:
+        """
+        A page can have fewer than limit entries, use the returned cursor's has_next to tell
+        whether there are more.
+        """
+        count = len(self)
+        start = find_cursor_index(count, self.key_at, self.desc, cursor) if cursor else 0
+        end = min(start + limit, count)
+        next_cursor = Cursor(end < count, encode_cursor(*self.key_at(end - 1)) if end > start else "")
+        return self.get_entries(start, end), next_cursor
+
+
+def scan_dir(folder_path: str) -> List[DirEntry]:
+    """
+    All entries in directory order.
+    """
+    snapshot = dir_listing_cache.get(folder_path, with_stat=True)
+    return [snapshot.entry_at(i, folder_path) for i in range(snapshot.count)]
+
+
+def list_dir_page(folder_path: str, sort: str, cursor: str, limit: int) -> Tuple[List[DirEntry], Cursor]:
+    return SortedDir(folder_path, sort).get_page(cursor, limit)
+
+
+def iter_dir_chunks(folder_path: str, sort: Optional[str] = None, chunk_size=1000) -> Iterator[List[DirEntry]]:
+    """
+    Without sort and a cached listing the entries are returned in directory order while the
+    folder is being read.
+    """
+    snapshot = None if sort else dir_listing_cache.get_cached(folder_path)
+    if snapshot:
+        for i in range(0, snapshot.count, chunk_size):
+            yield [snapshot.entry_at(j, folder_path) for j in range(i, min(i + chunk_size, snapshot.count))]
+        return
+    if not sort:
+        chunk = []
+        with os.scandir(folder_path) as it:
+            for item in it:
+                try:
+                    entry = to_dir_entry(item.name, item.stat())
+                except OSError:
+                    entry = None
+                if entry:
+                    chunk.append(entry)
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+        return
+    sorted_dir = SortedDir(folder_path, sort)
+    for i in range(0, len(sorted_dir), chunk_size):
+        yield sorted_dir.get_entries(i, i + chunk_size)
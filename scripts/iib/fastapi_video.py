@@ -1,127 +1,313 @@
+"""
+Range responses for /stream_video.
+
+The body is sent by an ASGI response instead of a sync generator, the next chunk is read with
+os.pread in a worker thread while the current one is being sent. When the server supports the
+ASGI zero copy extension (http.response.zerocopysend) the ranges are handed to it as offsets of
+the open file, so it can use sendfile.
+
+Every request opens its own file handle. close_video_file_reader closes all handles of a path
+(open files can't be deleted or renamed on Windows), a handle is only really closed once the read
+that is using it finishes, and its stream stops at the next chunk.
+"""
+import asyncio
 import os
-from typing import BinaryIO, Dict, Tuple
+import secrets
+import threading
+from email.utils import formatdate
+from typing import Dict, List, Optional, Set, Tuple
 
 from fastapi import HTTPException, Request, status
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response
 from scripts.iib.tool import get_video_type
 
-video_file_handler: Dict[str, "BinaryIO"] = {}
+chunk_size = 1024 * 1024
+# 超过这么多段的 Range 请求直接返回整个文件
+max_ranges = 64
+
+
+class VideoFileHandle:
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, mode="rb", buffering=0)
+        self.lock = threading.Lock()
+        self.refs = 1  # 请求本身持有一个引用
+        self.closing = False
+
+    def acquire(self) -> bool:
+        with self.lock:
+            if self.closing:
+                return False
+            self.refs += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.refs -= 1
+            if self.refs:
+                return
+        try:
+            self.file.close()
+        except Exception as e:
+            print(f"close file error: {e}")
+
+    def close(self):
+        with self.lock:
+            if self.closing:
+                return
+            self.closing = True
+        self.release()
+
+    def read(self, offset: int, size: int) -> Optional[bytes]:
+        """
+        Returns None once the handle was closed.
+        """
+        if not self.acquire():
+            return None
+        try:
+            if hasattr(os, "pread"):
+                return os.pread(self.file.fileno(), size, offset)
+            # windows 没有 pread，每个请求有自己的句柄，seek + read 也是安全的
+            self.file.seek(offset)
+            return self.file.read(size)
+        finally:
+            self.release()
+
+
+video_file_handles: Dict[str, Set[VideoFileHandle]] = {}
+video_file_handles_lock = threading.Lock()
+
+
+def open_video_file(path: str) -> VideoFileHandle:
+    handle = VideoFileHandle(path)
+    with video_file_handles_lock:
+        video_file_handles.setdefault(os.path.normpath(path), set()).add(handle)
+    return handle
+
+
+def release_video_file(handle: VideoFileHandle):
+    key = os.path.normpath(handle.path)
+    with video_file_handles_lock:
+        handles = video_file_handles.get(key)
+        if handles is not None:
+            handles.discard(handle)
+            if not handles:
+                del video_file_handles[key]
+    handle.close()
+
 
 def close_video_file_reader(path):
     if not get_video_type(path):
         return
-    try:
-        f = video_file_handler.get(path)
-        if f is not None:
-            f.close()
-    except Exception as e:
-        print(f"close file error: {e}")
-    
-
-def send_bytes_range_requests(
-    file_path: str,
-    start: int,
-    end: int,
-    chunk_size: int = 1024 * 1024,
-):
-    """Send a file in chunks using Range Requests specification RFC7233
+    with video_file_handles_lock:
+        handles = list(video_file_handles.get(os.path.normpath(path), ()))
+    for handle in handles:
+        handle.close()
 
-    `start` and `end` parameters are inclusive due to specification
-    """
-    f = None
+
+# (part header, start, end)，start 和 end 都包含在内
+RangePart = Tuple[bytes, int, int]
+
+
+class RangeFileResponse(Response):
+    def __init__(self, file_path: str, parts: List[RangePart], trailer: bytes, headers: Dict[str, str], status_code: int):
+        super().__init__(status_code=status_code, headers=headers)
+        self.file_path = file_path
+        self.parts = parts
+        self.trailer = trailer
+
+    async def __call__(self, scope, receive, send):
+        handle = open_video_file(self.file_path)
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        try:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            if scope.get("method") == "HEAD":
+                await send({"type": "http.response.body", "body": b""})
+                return
+            zero_copy = "http.response.zerocopysend" in scope.get("extensions", {})
+            for header, start, end in self.parts:
+                if header:
+                    await send({"type": "http.response.body", "body": header, "more_body": True})
+                if zero_copy:
+                    sent = await send_range_zero_copy(handle, start, end, send)
+                else:
+                    sent = await send_range(handle, start, end, send, disconnected)
+                if not sent:
+                    return  # 客户端断开或文件被关闭，不再发送剩下的内容
+            await send({"type": "http.response.body", "body": self.trailer})
+        finally:
+            disconnected.cancel()
+            release_video_file(handle)
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def send_range(handle: VideoFileHandle, start: int, end: int, send, disconnected: asyncio.Future) -> bool:
+    loop = asyncio.get_running_loop()
+
+    def read(pos: int):
+        if pos > end:
+            return None
+        return loop.run_in_executor(None, handle.read, pos, min(chunk_size, end + 1 - pos))
+
+    pending = read(start)
+    while pending is not None:
+        data = await pending
+        if not data:
+            return False
+        # 发送当前块的同时读取下一块
+        pending = read(start := start + len(data))
+        if disconnected.done():
+            if pending is not None:
+                pending.add_done_callback(lambda f: f.exception())
+            return False
+        await send({"type": "http.response.body", "body": data, "more_body": True})
+    return True
+
+
+async def send_range_zero_copy(handle: VideoFileHandle, start: int, end: int, send) -> bool:
+    if not handle.acquire():
+        return False
     try:
-        # Larger chunk size improves throughput for large video files.
-        f = open(file_path, mode="rb")
-        video_file_handler[file_path] = f
-        f.seek(start)
-        while (pos := f.tell()) <= end:
-            read_size = min(chunk_size, end + 1 - pos)
-            data = f.read(read_size)
-            if not data:
-                break
-            yield data
+        await send(
+            {
+                "type": "http.response.zerocopysend",
+                "file": handle.file,
+                "offset": start,
+                "count": end - start + 1,
+                "more_body": True,
+            }
+        )
     finally:
-        # Best-effort cleanup; the file may already be closed by external code.
-        try:
-            cur = video_file_handler.get(file_path)
-            if cur is f:
-                video_file_handler.pop(file_path, None)
-            if f is not None:
-                f.close()
-        except Exception:
-            pass
+        handle.release()
+    return True
+
 
+def _get_ranges(range_header: str, file_size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Returns the satisfiable ranges sorted and merged, or None if the Range header should be ignored.
+    """
 
-def _get_range_header(range_header: str, file_size: int) -> Tuple[int, int]:
     def _invalid_range():
         return HTTPException(
             status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
             detail=f"Invalid request range (Range:{range_header!r})",
+            headers={"content-range": f"bytes */{file_size}"},
         )
 
     # RFC7233 supports:
     # - bytes=START-END
     # - bytes=START-
     # - bytes=-SUFFIX_LENGTH
-    # Browsers usually send a single range; if multiple, we take the first one.
+    # and a comma separated list of them, which is answered with multipart/byteranges.
+    ranges = []
     try:
         raw = range_header.strip()
         if not raw.startswith("bytes="):
             raise _invalid_range()
-        raw = raw[len("bytes=") :].split(",")[0].strip()
-        start_s, end_s = raw.split("-", 1)
+        specs = [spec.strip() for spec in raw[len("bytes=") :].split(",") if spec.strip()]
+        if len(specs) > max_ranges:
+            return None
+        for spec in specs:
+            start_s, end_s = spec.split("-", 1)
 
-        # suffix-byte-range-spec: bytes=-<length>
-        if start_s == "" and end_s != "":
-            suffix_len = int(end_s)
-            if suffix_len <= 0:
+            # suffix-byte-range-spec: bytes=-<length>
+            if start_s == "" and end_s != "":
+                suffix_len = int(end_s)
+                if suffix_len <= 0:
+                    raise _invalid_range()
+                start = max(file_size - suffix_len, 0)
+                end = file_size - 1
+            else:
+                start = int(start_s)
+                end = int(end_s) if end_s != "" else file_size - 1
+            if start > end or start < 0:
                 raise _invalid_range()
-            start = max(file_size - suffix_len, 0)
-            end = file_size - 1
-        else:
-            start = int(start_s) if start_s != "" else 0
-            end = int(end_s) if end_s != "" else file_size - 1
+            if start < file_size:
+                ranges.append((start, min(end, file_size - 1)))
     except HTTPException:
         raise
     except Exception:
         raise _invalid_range()
 
-    if start > end or start < 0 or end > file_size - 1:
+    if not ranges:
         raise _invalid_range()
-    return start, end
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        if start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _if_range_matches(if_range: str, etag: str, last_modified: str):
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return if_range == etag  # 弱 ETag 永远不匹配
+    return if_range == last_modified
 
 
 def range_requests_response(
     request: Request, file_path: str, content_type: str
 ):
-    """Returns StreamingResponse using Range Requests of a given file"""
+    """Returns a response using Range Requests of a given file"""
 
-    file_size = os.stat(file_path).st_size
+    stat = os.stat(file_path)
+    file_size = stat.st_size
+    content_type = content_type or "application/octet-stream"
+    etag = f'"{stat.st_mtime_ns:x}-{file_size:x}"'
+    last_modified = formatdate(stat.st_mtime, usegmt=True)
     range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
 
     headers = {
         "content-type": content_type,
         "accept-ranges": "bytes",
         "content-encoding": "identity",
         "content-length": str(file_size),
+        "etag": etag,
+        "last-modified": last_modified,
         "access-control-expose-headers": (
             "content-type, accept-ranges, content-length, "
-            "content-range, content-encoding"
+            "content-range, content-encoding, etag, last-modified"
         ),
     }
-    start = 0
-    end = file_size - 1
+    parts: List[RangePart] = [(b"", 0, file_size - 1)]
+    trailer = b""
     status_code = status.HTTP_200_OK
 
-    if range_header is not None:
-        start, end = _get_range_header(range_header, file_size)
-        size = end - start + 1
-        headers["content-length"] = str(size)
+    ranges = None
+    # If-Range 不匹配说明文件已经变了，返回整个文件
+    if range_header is not None and (if_range is None or _if_range_matches(if_range, etag, last_modified)):
+        ranges = _get_ranges(range_header, file_size)
+    if ranges and len(ranges) == 1:
+        start, end = ranges[0]
+        parts = [(b"", start, end)]
+        headers["content-length"] = str(end - start + 1)
         headers["content-range"] = f"bytes {start}-{end}/{file_size}"
         status_code = status.HTTP_206_PARTIAL_CONTENT
+    elif ranges:
+        boundary = secrets.token_hex(16)
+        parts = []
+        for i, (start, end) in enumerate(ranges):
+            header = (
+                ("" if i == 0 else "\r\n")
+                + f"--{boundary}\r\n"
+                f"content-type: {content_type}\r\n"
+                f"content-range: bytes {start}-{end}/{file_size}\r\n\r\n"
+            )
+            parts.append((header.encode("latin-1"), start, end))
+        trailer = f"\r\n--{boundary}--\r\n".encode("latin-1")
+        length = sum(len(header) + end - start + 1 for header, start, end in parts) + len(trailer)
+        headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+        headers["content-length"] = str(length)
+        status_code = status.HTTP_206_PARTIAL_CONTENT
 
-    return StreamingResponse(
-        send_bytes_range_requests(file_path, start, end),
-        headers=headers,
-        status_code=status_code,
-    )
+    return RangeFileResponse(file_path, parts, trailer, headers, status_code)
@@ -0,0 +1,361 @@
+"""
+Optional background watcher that keeps the image index in sync with the file system.
+
+Enabled with IIB_ENABLE_FS_WATCHER=true. inotify/FSEvents/ReadDirectoryChangesW are used through
+watchdog when it is installed, otherwise the watched folders are polled by their modification time.
+Events are debounced and applied by a single worker thread:
+- created/modified files are (re)indexed with add_image_data_single,
+- deleted files and folders are removed from the index,
+- moved files and folders keep their id and custom tags through Image.update_path.
+
+The first event in a folder also syncs that folder once (new files + folder mtime), after that the
+folder's row in the folders table is kept up to date so /db/update_image_data doesn't rescan it.
+Listeners added with add_listener see every event as soon as it arrives, the /files listing
+cache uses that to drop folders whose files changed without changing the folder's mtime.
+"""
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from scripts.iib.db.datamodel import DataBase, Folder, Image as DbImg, TagCache
+from scripts.iib.db.update_image_data import (
+    add_image_data_single,
+    need_update_img_idx,
+    update_image_data,
+)
+from scripts.iib.logger import logger
+from scripts.iib.tool import get_cache_dir, is_media_file, is_valid_media_path
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except Exception:
+    FileSystemEventHandler = object
+    Observer = None
+
+
+def is_fs_watcher_enabled():
+    return os.getenv("IIB_ENABLE_FS_WATCHER", "false").lower() == "true"
+
+
+def get_poll_interval() -> float:
+    try:
+        return max(0.1, float(os.getenv("IIB_FS_WATCHER_POLL_INTERVAL", "1")))
+    except ValueError:
+        return 1.0
+
+
+class WatchdogHandler(FileSystemEventHandler):
+    def __init__(self, watcher: "FsWatcher"):
+        super().__init__()
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        kind = event.event_type
+        if kind == "moved":
+            self.watcher.push(
+                "move_dir" if event.is_directory else "move", event.dest_path, event.src_path
+            )
+        elif kind == "deleted":
+            self.watcher.push("delete_dir" if event.is_directory else "delete", event.src_path)
+        elif kind == "created" and event.is_directory:
+            self.watcher.push("create_dir", event.src_path)
+        elif kind in ("created", "modified", "closed") and not event.is_directory:
+            self.watcher.push("upsert", event.src_path)
+
+
+class DirPoller:
+    """
+    Fallback when watchdog isn't installed: stat every watched folder and diff its listing when
+    its mtime changes. Files rewritten in place without touching the folder are not noticed.
+    """
+
+    def __init__(self, watcher: "FsWatcher"):
+        self.watcher = watcher
+        # folder -> (mtime_ns, files, sub folders)
+        self.snapshots: Dict[str, Tuple[int, Set[str], Set[str]]] = {}
+        # 由 FsWatcher.refresh_dirs 设置，在轮询线程里生效
+        self.roots: List[str] = []
+        self.applied_roots: List[str] = []
+
+    def scan(self, folder: str):
+        try:
+            mtime_ns = os.stat(folder).st_mtime_ns
+            files, dirs = set(), set()
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    (dirs if entry.is_dir() else files).add(entry.name)
+        except OSError:
+            return None
+        self.snapshots[folder] = (mtime_ns, files, dirs)
+        return files, dirs
+
+    def add_tree(self, folder: str, notify=False):
+        res = self.scan(folder)
+        if res is None:
+            return
+        files, dirs = res
+        if notify:
+            for name in files:
+                self.watcher.push("upsert", os.path.join(folder, name))
+        for name in dirs:
+            self.add_tree(os.path.join(folder, name), notify)
+
+    def remove_tree(self, folder: str):
+        prefix = folder + os.sep
+        for key in [k for k in self.snapshots if k == folder or k.startswith(prefix)]:
+            self.snapshots.pop(key, None)
+
+    def set_roots(self, roots: List[str]):
+        for key in [k for k in self.snapshots if not any(is_under(k, r) for r in roots)]:
+            self.snapshots.pop(key, None)
+        for root in roots:
+            if root not in self.snapshots:
+                self.add_tree(root)
+
+    def poll(self):
+        if self.roots is not self.applied_roots:
+            self.applied_roots = self.roots
+            self.set_roots(self.applied_roots)
+        for folder, (mtime_ns, files, dirs) in list(self.snapshots.items()):
+            if folder not in self.snapshots:
+                continue  # removed together with a parent during this round
+            try:
+                if os.stat(folder).st_mtime_ns == mtime_ns:
+                    continue
+            except OSError:
+                self.remove_tree(folder)
+                self.watcher.push("delete_dir", folder)
+                continue
+            res = self.scan(folder)
+            if res is None:
+                continue
+            new_files, new_dirs = res
+            for name in new_files - files:
+                self.watcher.push("upsert", os.path.join(folder, name))
+            for name in files - new_files:
+                self.watcher.push("delete", os.path.join(folder, name))
+            for name in new_dirs - dirs:
+                self.add_tree(os.path.join(folder, name))
+                self.watcher.push("create_dir", os.path.join(folder, name))
+            for name in dirs - new_dirs:
+                self.remove_tree(os.path.join(folder, name))
+                self.watcher.push("delete_dir", os.path.join(folder, name))
+
+
+def is_under(path: str, parent: str):
+    return path == parent or path.startswith(parent.rstrip(os.sep) + os.sep)
+
+
+class FsWatcher:
+    debounce = 0.5
+    dirs_refresh_interval = 10
+
+    def __init__(self, get_dirs: Callable[[], List[str]]):
+        self.get_dirs = get_dirs
+        self.dirs: List[str] = []
+        # path -> (kind, last event time, src path of moves)
+        self.pending: Dict[str, Tuple[str, float, Optional[str]]] = {}
+        self.cond = threading.Condition()
+        self.stopped = threading.Event()
+        self.synced_dirs: Set[str] = set()
+        self.observer = None
+        self.watches = {}
+        self.poller: Optional[DirPoller] = None
+        # 收到事件时立即调用 listener(kind, path, src)，不等防抖，在监听线程中执行
+        self.listeners: List[Callable[[str, str, Optional[str]], None]] = []
+        self.cache_dir = os.path.join(os.path.normpath(get_cache_dir()), "iib_cache")
+
+    def start(self):
+        if Observer is not None:
+            self.observer = Observer()
+            self.observer.daemon = True
+            self.observer.start()
+        else:
+            self.poller = DirPoller(self)
+        self.refresh_dirs()
+        threading.Thread(target=self.run, name="iib-fs-watcher", daemon=True).start()
+        if self.poller:
+            threading.Thread(target=self.run_poller, name="iib-fs-poller", daemon=True).start()
+        logger.info(
+            "fs watcher started (%s) dirs: %s", "watchdog" if self.observer else "polling", self.dirs
+        )
+
+    def stop(self):
+        self.stopped.set()
+        if self.observer:
+            self.observer.stop()
+        with self.cond:
+            self.cond.notify_all()
+
+    def refresh_dirs(self):
+        try:
+            dirs = [os.path.normpath(x) for x in self.get_dirs() if x and os.path.isdir(x)]
+        except Exception as e:
+            logger.error("fs watcher failed to get dirs: %s", e)
+            return
+        # 嵌套的目录只监听最外层
+        dirs = sorted(set(dirs), key=len)
+        roots = [d for i, d in enumerate(dirs) if not any(is_under(d, r) for r in dirs[:i])]
+        if roots == self.dirs:
+            return
+        self.dirs = roots
+        if self.observer:
+            for path in list(self.watches):
+                if path not in roots:
+                    self.observer.unschedule(self.watches.pop(path))
+            for path in roots:
+                if path not in self.watches:
+                    try:
+                        self.watches[path] = self.observer.schedule(
+                            WatchdogHandler(self), path, recursive=True
+                        )
+                    except Exception as e:
+                        logger.error("fs watcher failed to watch %s: %s", path, e)
+        else:
+            self.poller.roots = roots
+
+    def add_listener(self, listener: Callable[[str, str, Optional[str]], None]):
+        self.listeners.append(listener)
+
+    def push(self, kind: str, path: str, src: Optional[str] = None):
+        path = os.path.normpath(path)
+        if is_under(path, self.cache_dir):
+            return
+        for listener in self.listeners:
+            try:
+                listener(kind, path, src and os.path.normpath(src))
+            except Exception as e:
+                logger.error("fs watcher listener failed: %s", e)
+        with self.cond:
+            if src:
+                src = os.path.normpath(src)
+                prev = self.pending.pop(src, None)
+                if prev and prev[0] in ("move", "move_dir"):
+                    src = prev[2]  # a -> b -> c
+                elif prev and prev[0] in ("upsert", "create_dir"):
+                    # 还没处理过的新文件直接按新路径处理
+                    kind, src = ("upsert" if kind == "move" else "create_dir"), None
+            elif kind in ("upsert", "create_dir"):
+                prev = self.pending.get(path)
+                if prev and prev[0] in ("move", "move_dir"):
+                    kind, src = prev[0], prev[2]
+            self.pending[path] = (kind, time.time(), src)
+            self.cond.notify()
+
+    def run_poller(self):
+        interval = get_poll_interval()
+        self.poller.poll()  # 建立初始快照
+        while not self.stopped.wait(interval):
+            try:
+                self.poller.poll()
+            except Exception as e:
+                logger.error("fs watcher poll failed: %s", e)
+
+    def take_due_events(self):
+        with self.cond:
+            while not self.stopped.is_set():
+                now = time.time()
+                due = [(p, v) for p, v in self.pending.items() if now - v[1] >= self.debounce]
+                # 全量索引进行中时先不处理，避免和它争抢写锁
+                if due and not DataBase._initing:
+                    for path, _ in due:
+                        self.pending.pop(path)
+                    return sorted(due, key=lambda x: x[1][1])
+                timeout = self.debounce
+                if self.pending and not DataBase._initing:
+                    timeout = max(0.01, self.debounce - (now - min(v[1] for v in self.pending.values())))
+                self.cond.wait(timeout)
+        return []
+
+    def run(self):
+        last_refresh = time.time()
+        while not self.stopped.is_set():
+            events = self.take_due_events()
+            if events:
+                try:
+                    self.apply(events)
+                except Exception as e:
+                    logger.error("fs watcher failed to apply events: %s", e)
+            if time.time() - last_refresh > self.dirs_refresh_interval:
+                last_refresh = time.time()
+                self.refresh_dirs()
+
+    def apply(self, events: List[Tuple[str, Tuple[str, float, Optional[str]]]]):
+        conn = DataBase.get_conn()
+        if DbImg.is_empty(conn):
+            # 还没有建立索引，首次打开时会全量生成
+            return
+        tag_cache = TagCache(conn, preload=False)
+        touched_dirs: Set[str] = set()
+        for path, (kind, _, src) in events:
+            try:
+                if kind == "upsert":
+                    if is_valid_media_path(path):
+                        add_image_data_single(path, tag_cache)
+                    elif is_media_file(path) and not os.path.exists(path):
+                        remove_images(conn, [DbImg.get(conn, path)])
+                elif kind == "delete":
+                    remove_images(conn, [DbImg.get(conn, path)])
+                elif kind == "delete_dir":
+                    remove_images(conn, DbImg.get_under_folder(conn, path))
+                    Folder.remove_folder(conn, path)
+                elif kind == "move":
+                    img = DbImg.get(conn, src)
+                    if img:
+                        img.update_path(conn, path, force=True)
+                        conn.commit()
+                    elif is_valid_media_path(path):
+                        add_image_data_single(path, tag_cache)
+                    touched_dirs.add(os.path.dirname(src))
+                elif kind == "move_dir":
+                    for img in DbImg.get_under_folder(conn, src):
+                        img.update_path(conn, path + img.path[len(src) :], force=True)
+                    Folder.remove_folder(conn, src)
+                    conn.commit()
+                    touched_dirs.add(os.path.dirname(src))
+                    update_image_data([path], workers=1)
+                elif kind == "create_dir":
+                    update_image_data([path], workers=1)
+                touched_dirs.add(os.path.dirname(path))
+            except Exception as e:
+                logger.error("fs watcher failed to apply %s %s: %s", kind, path, e)
+        for folder in touched_dirs:
+            try:
+                self.sync_folder(conn, folder, tag_cache)
+            except Exception as e:
+                logger.error("fs watcher failed to sync %s: %s", folder, e)
+        conn.commit()
+
+    def sync_folder(self, conn, folder: str, tag_cache: TagCache):
+        """
+        The first time a folder changes, index whatever is missing in it (non recursive) so marking
+        the folder as up to date can't hide files that changed while the watcher wasn't running.
+        """
+        if not any(is_under(folder, r) for r in self.dirs) or not os.path.isdir(folder):
+            return
+        if folder not in self.synced_dirs:
+            for name in os.listdir(folder):
+                file_path = os.path.normpath(os.path.join(folder, name))
+                if is_valid_media_path(file_path) and need_update_img_idx(conn, file_path, False):
+                    add_image_data_single(file_path, tag_cache)
+            self.synced_dirs.add(folder)
+        Folder.update_modified_date_or_create(conn, folder)
+
+
+def remove_images(conn, imgs: List[Optional[DbImg]]):
+    ids = [img.id for img in imgs if img]
+    if ids:
+        DbImg.safe_batch_remove(conn, ids)
+
+
+fs_watcher: Optional[FsWatcher] = None
+
+
+def start_fs_watcher(get_dirs: Callable[[], List[str]]) -> Optional[FsWatcher]:
+    global fs_watcher
+    if fs_watcher is None and is_fs_watcher_enabled():
+        fs_watcher = FsWatcher(get_dirs)
+        fs_watcher.start()
+    return fs_watcher
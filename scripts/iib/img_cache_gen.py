@@ -1,14 +1,14 @@
-import hashlib
 import os
 from typing import List
-from scripts.iib.tool import get_formatted_date, get_cache_dir, is_image_file
+from scripts.iib.tool import get_formatted_date, is_image_file
 from concurrent.futures import ThreadPoolExecutor
 import time
-from PIL import Image
+from scripts.iib.blob_store import blob_store, is_blob_backend_enabled
+from scripts.iib.cache_manager import cache_manager, get_thumbnail_blob_key, get_thumbnail_cache_path
+from scripts.iib.thumbnail import generate_thumbnail, render_thumbnail
 
 def generate_image_cache(dirs: List[str], size:str, verbose=True): 
   start_time = time.time()
-  cache_base_dir = get_cache_dir()
   def process_image(item):
     if '\\node_modules\\' in item.path:
       return
@@ -24,11 +24,16 @@ def generate_image_cache(dirs: List[str], size:str, verbose=True):
       path = os.path.normpath(item.path)
       stat = item.stat()
       t = get_formatted_date(stat.st_mtime)
-      hash_dir = hashlib.md5((path + t).encode("utf-8")).hexdigest()
-      cache_dir = os.path.join(cache_base_dir, "iib_cache", hash_dir)
-      cache_path = os.path.join(cache_dir, f"{size}.webp")
+      blob_key = None
+      if is_blob_backend_enabled():
+          _, blob_key = get_thumbnail_blob_key(path, t, size)
+          cache_path = blob_store.get_entry_path(blob_key)
+          exists = blob_store.contains(blob_key)
+      else:
+          _, cache_path = get_thumbnail_cache_path(path, t, size)
+          exists = os.path.exists(cache_path)
 
-      if os.path.exists(cache_path):
+      if exists:
           verbose and print(f"Image cache already exists: {path}")
           return
 
@@ -36,11 +41,11 @@ def generate_image_cache(dirs: List[str], size:str, verbose=True):
           verbose and print(f"Image size less than 64KB: {path}", "skip")
           return
         
-      with Image.open(path) as img:
-          w, h = size.split("x")
-          img.thumbnail((int(w), int(h)))
-          os.makedirs(cache_dir, exist_ok=True)
-          img.save(cache_path, "webp")
+      if blob_key:
+          blob_store.put(blob_key, render_thumbnail(path, size))
+      else:
+          generate_thumbnail(path, cache_path, size)
+      cache_manager.add(cache_path, path, t, miss=False)
 
       verbose and print(f"Image cache generated: {path}")
     except Exception as e:
@@ -53,6 +58,7 @@ def generate_image_cache(dirs: List[str], size:str, verbose=True):
       for item in folder_listing:
         executor.submit(process_image, item)
 
+  cache_manager.flush()
   print("Image cache generation completed. ✨")
   end_time = time.time()
   execution_time = end_time - start_time
@@ -0,0 +1,311 @@
+"""
+Read generation metadata from PNG/WebP files without handing them to PIL.
+
+PNG: only the chunks before the first IDAT are read, like PIL does when opening.
+WebP: chunk headers are walked and the image data is skipped with seek, PIL reads the whole file.
+
+The info dict mirrors what PIL puts into img.info for text chunks (tEXt/zTXt/iTXt), exif and xmp.
+Other keys (gamma, dpi, icc_profile ...) are not filled. Whenever the file looks unusual
+(bad checksum, APNG, truncated data, unknown compression ...) read_image_header returns None
+and the caller should fall back to PIL, so the parsers see the same result either way.
+"""
+import os
+import re
+import struct
+import zlib
+from typing import Optional, Tuple
+
+from PIL import Image
+from PIL.PngImagePlugin import MAX_TEXT_CHUNK, MAX_TEXT_MEMORY, iTXt
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+is_png_cid = re.compile(rb"\w\w\w\w").match
+
+# IHDR 的 (位深, 颜色类型) -> PIL 的 mode，与 PngImagePlugin._MODES 相同，不依赖 PIL 的私有变量
+png_modes = {
+    (1, 0): "1",
+    (2, 0): "L",
+    (4, 0): "L",
+    (8, 0): "L",
+    (16, 0): "I;16",
+    (8, 2): "RGB",
+    (16, 2): "RGB",
+    (1, 3): "P",
+    (2, 3): "P",
+    (4, 3): "P",
+    (8, 3): "P",
+    (8, 4): "LA",
+    (16, 4): "RGBA",
+    (8, 6): "RGBA",
+    (16, 6): "RGBA",
+}
+
+# PIL 中会抛出异常或改变读取流程的块，遇到时直接交给 PIL
+png_fallback_cids = {b"IEND", b"acTL", b"fcTL", b"fdAT"}
+
+WEBP_ICCP_FLAG = 0x20
+WEBP_ALPHA_FLAG = 0x10
+WEBP_EXIF_FLAG = 0x08
+WEBP_XMP_FLAG = 0x04
+
+
+class HeaderNotSupported(Exception):
+    pass
+
+
+class HeaderImage:
+    """
+    Lightweight stand-in for PIL.Image.Image carrying format, size and info.
+    Any other attribute (mode, load(), getexif() ...) opens the file with PIL on first use.
+    """
+
+    def __init__(self, path: str, format: str, size: Tuple[int, int], info: dict):
+        self._img = None
+        self.filename = path
+        self.format = format
+        self.size = size
+        self.width, self.height = size
+        self.info = info
+
+    def _get_pil_image(self) -> Image.Image:
+        if self._img is None:
+            self._img = Image.open(self.filename)
+        return self._img
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self._get_pil_image(), name)
+
+    def close(self):
+        if self._img is not None:
+            self._img.close()
+            self._img = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _read_exact(f, size: int) -> bytes:
+    data = f.read(size)
+    if len(data) < size:
+        raise HeaderNotSupported("truncated file")
+    return data
+
+
+def _safe_zlib_decompress(s: bytes) -> bytes:
+    dobj = zlib.decompressobj()
+    plaintext = dobj.decompress(s, MAX_TEXT_CHUNK)
+    if dobj.unconsumed_tail:
+        raise HeaderNotSupported("decompressed data too large")
+    return plaintext
+
+
+def _read_png_text_chunk(cid: bytes, s: bytes, info: dict) -> int:
+    """
+    Same semantics as PngStream.chunk_tEXt/zTXt/iTXt/eXIf, returns the text length counted
+    towards MAX_TEXT_MEMORY.
+    """
+    if cid == b"eXIf":
+        info["exif"] = b"Exif\x00\x00" + s
+        return 0
+    if cid in (b"tEXt", b"zTXt"):
+        k, _, v = s.partition(b"\0")
+        if cid == b"zTXt":
+            if v and v[0] != 0:
+                raise HeaderNotSupported("unknown zTXt compression")
+            try:
+                v = _safe_zlib_decompress(v[1:])
+            except zlib.error:
+                v = b""
+        if not k:
+            return 0
+        k_str = k.decode("latin-1", "strict")
+        v_str = v.decode("latin-1", "replace")
+        info[k_str] = v if cid == b"tEXt" and k == b"exif" else v_str
+        return len(v_str)
+    # iTXt
+    try:
+        k, r = s.split(b"\0", 1)
+    except ValueError:
+        return 0
+    if len(r) < 2:
+        return 0
+    cf, cm, r = r[0], r[1], r[2:]
+    try:
+        lang, tk, v = r.split(b"\0", 2)
+    except ValueError:
+        return 0
+    if cf != 0:
+        if cm != 0:
+            return 0
+        try:
+            v = _safe_zlib_decompress(v)
+        except zlib.error:
+            return 0
+    if k == b"XML:com.adobe.xmp":
+        info["xmp"] = v
+    try:
+        k_str = k.decode("latin-1", "strict")
+        lang_str = lang.decode("utf-8", "strict")
+        tk_str = tk.decode("utf-8", "strict")
+        v_str = v.decode("utf-8", "strict")
+    except UnicodeError:
+        return 0
+    info[k_str] = iTXt(v_str, lang_str, tk_str)
+    return len(v_str)
+
+
+def _check_png_chunk(cid: bytes, s: bytes, mode: Optional[str]):
+    """
+    Chunks we don't keep but whose PIL handler raises on malformed data.
+    """
+    if cid == b"iCCP":
+        i = s.find(b"\0")
+        if i < 0 or len(s) < i + 2 or s[i + 1] != 0:
+            raise HeaderNotSupported("unsupported iCCP chunk")
+        try:
+            _safe_zlib_decompress(s[i + 2 :])
+        except zlib.error:
+            pass
+    elif cid == b"gAMA" and len(s) < 4:
+        raise HeaderNotSupported("truncated gAMA chunk")
+    elif cid == b"sRGB" and len(s) < 1:
+        raise HeaderNotSupported("truncated sRGB chunk")
+    elif cid == b"pHYs" and len(s) < 9:
+        raise HeaderNotSupported("truncated pHYs chunk")
+    elif cid == b"tRNS" and len(s) < {"1": 2, "L": 2, "I;16": 2, "RGB": 6}.get(mode, 0):
+        raise HeaderNotSupported("truncated tRNS chunk")
+
+
+def _read_png(f, path: str) -> HeaderImage:
+    info = {}
+    size = None
+    mode = None
+    text_memory = 0
+    while True:
+        header = _read_exact(f, 8)
+        length, cid = struct.unpack(">I4s", header)
+        if not is_png_cid(cid) or cid in png_fallback_cids:
+            raise HeaderNotSupported(f"chunk {cid!r}")
+        if cid == b"IDAT":
+            break
+        s = _read_exact(f, length)
+        crc = _read_exact(f, 4)
+        if zlib.crc32(s, zlib.crc32(cid)) & 0xFFFFFFFF != struct.unpack(">I", crc)[0]:
+            raise HeaderNotSupported(f"bad checksum in {cid!r}")
+        if cid == b"IHDR":
+            if length < 13 or s[11]:
+                raise HeaderNotSupported("unsupported IHDR chunk")
+            size = struct.unpack(">II", s[:8])
+            mode = png_modes.get((s[8], s[9]))
+        elif cid in (b"tEXt", b"zTXt", b"iTXt", b"eXIf"):
+            text_memory += _read_png_text_chunk(cid, s, info)
+            if text_memory > MAX_TEXT_MEMORY:
+                raise HeaderNotSupported("too much memory used in text chunks")
+        else:
+            _check_png_chunk(cid, s, mode)
+    if not size or not mode or size[0] <= 0 or size[1] <= 0:
+        raise HeaderNotSupported("missing IHDR chunk")
+    return HeaderImage(path, "PNG", size, info)
+
+
+def _read_webp_size(fourcc: bytes, payload: bytes, chunk_size: int) -> Tuple[int, int]:
+    if fourcc == b"VP8X" and len(payload) >= 10:
+        width = 1 + int.from_bytes(payload[4:7], "little")
+        height = 1 + int.from_bytes(payload[7:10], "little")
+        return width, height
+    if fourcc == b"VP8 " and len(payload) >= 10 and payload[3:6] == b"\x9d\x01\x2a":
+        frame_tag = int.from_bytes(payload[:3], "little")
+        # 必须是可显示的关键帧，且第一个分区不能超出块的大小
+        if frame_tag & 0x01 or (frame_tag >> 1) & 0x07 > 3 or not frame_tag & 0x10 or frame_tag >> 5 >= chunk_size:
+            raise HeaderNotSupported("unsupported VP8 frame")
+        width, height = struct.unpack("<HH", payload[6:10])
+        return width & 0x3FFF, height & 0x3FFF
+    if fourcc == b"VP8L" and len(payload) >= 5 and payload[0] == 0x2F:
+        bits = struct.unpack("<I", payload[1:5])[0]
+        if bits >> 29:
+            raise HeaderNotSupported("unsupported VP8L version")
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    raise HeaderNotSupported(f"unsupported {fourcc!r} chunk")
+
+
+def _read_webp(f, path: str) -> HeaderImage:
+    riff_size = struct.unpack("<I", _read_exact(f, 12)[4:8])[0]
+    end = riff_size + 8
+    if riff_size % 2 or os.fstat(f.fileno()).st_size < end:
+        raise HeaderNotSupported("truncated RIFF container")
+    info = {}
+    size = None
+    frame_size = None
+    flags = 0
+    pos = 12
+    while pos < end:
+        f.seek(pos)
+        fourcc, chunk_size = struct.unpack("<4sI", _read_exact(f, 8))
+        pos += 8 + chunk_size + (chunk_size & 1)
+        if pos > end:
+            raise HeaderNotSupported("chunk exceeds RIFF container")
+        if size is None:
+            # 第一个块决定格式，只需要读出宽高
+            payload = _read_exact(f, min(chunk_size, 10))
+            size = _read_webp_size(fourcc, payload, chunk_size)
+            if fourcc != b"VP8X":
+                # 简单格式的文件不会带元数据块
+                if pos != end:
+                    raise HeaderNotSupported("unexpected chunk after image data")
+                frame_size = size
+                break
+            flags = payload[0]
+            # 动图和保留位交给 PIL(libwebp) 处理
+            if flags & ~(WEBP_ICCP_FLAG | WEBP_ALPHA_FLAG | WEBP_EXIF_FLAG | WEBP_XMP_FLAG):
+                raise HeaderNotSupported("unsupported VP8X flags")
+            continue
+        if fourcc in (b"VP8 ", b"VP8L"):
+            if frame_size is not None:
+                raise HeaderNotSupported("multiple image chunks")
+            frame_size = _read_webp_size(fourcc, _read_exact(f, min(chunk_size, 10)), chunk_size)
+            continue
+        key = {
+            b"EXIF": ("exif", WEBP_EXIF_FLAG),
+            b"XMP ": ("xmp", WEBP_XMP_FLAG),
+        }.get(fourcc)
+        if key and flags & key[1] and key[0] not in info and chunk_size:
+            info[key[0]] = _read_exact(f, chunk_size)
+    if size is None or frame_size != size or size[0] <= 0 or size[1] <= 0:
+        raise HeaderNotSupported("missing image chunk")
+    return HeaderImage(path, "WEBP", size, info)
+
+
+def read_image_header(path: str) -> Optional[HeaderImage]:
+    """
+    Returns None for other formats or when the header can't be read the same way PIL would.
+    """
+    try:
+        with open(path, "rb") as f:
+            prefix = f.read(16)
+            f.seek(0)
+            if prefix[:8] == PNG_SIGNATURE:
+                f.seek(8)
+                img = _read_png(f, path)
+            elif prefix[:4] == b"RIFF" and prefix[8:12] == b"WEBP":
+                img = _read_webp(f, path)
+            else:
+                return None
+        if Image.MAX_IMAGE_PIXELS and img.size[0] * img.size[1] > Image.MAX_IMAGE_PIXELS:
+            # 交给 PIL 给出同样的 DecompressionBombWarning 或 DecompressionBombError
+            return None
+        return img
+    except Exception:
+        return None
+
+
+def open_image(path: str):
+    """
+    Like PIL.Image.open, but PNG/WebP files are served by read_image_header when possible.
+    """
+    return read_image_header(path) or Image.open(path)
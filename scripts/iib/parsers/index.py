@@ -7,6 +7,7 @@ from scripts.iib.parsers.model import ImageGenerationInfo
 from scripts.iib.parsers.stable_swarm_ui import StableSwarmUIParser
 from scripts.iib.parsers.invoke_ai import InvokeAIParser
 from scripts.iib.parsers.sd_webui_stealth import SdWebUIStealthParser
+from scripts.iib.parsers.image_header import open_image
 from scripts.iib.logger import logger
 from PIL import Image
 from scripts.iib.plugin import plugin_insts
@@ -27,7 +28,9 @@ def parse_image_info(image_path: str) -> ImageGenerationInfo:
         parsers.append(SdWebUIStealthParser)
     
     parsers.append(SdWebUIParser)
-    with Image.open(image_path) as img:
+    # 隐写解析需要读取像素，直接交给 PIL；其他情况只读取文件头中的元数据
+    opener = Image.open if enable_stealth_parser else open_image
+    with opener(image_path) as img:
         for parser in parsers:
             if parser.test(img, image_path):
                 try:
@@ -5,8 +5,104 @@ from scripts.iib.tool import (
     read_sd_webui_gen_info_from_image,
 )
 from scripts.iib.parsers.model import ImageGenerationInfo, ImageGenerationParams
-# https://github.com/neggles/sd-webui-stealth-pnginfo/blob/main/scripts/stealth_pnginfo.py
+
+try:
+    import numpy as np
+except Exception:
+    np = None
+
+STEALTH_ALPHA_SIGS = {b'stealth_pnginfo': False, b'stealth_pngcomp': True}
+STEALTH_RGB_SIGS = {b'stealth_rgbinfo': False, b'stealth_rgbcomp': True}
+STEALTH_SIG_BITS = len('stealth_pnginfo') * 8
+
+
 def read_info_from_image_stealth(image, fast_check=False):
+    if np is not None and image.mode in ('RGB', 'RGBA'):
+        return read_info_from_image_stealth_np(image, fast_check)
+    return read_info_from_image_stealth_py(image, fast_check)
+
+
+def _stealth_pixels(image, count: int):
+    """
+    First count pixels in the column-major order used by the encoder, shape (n, channels).
+    Only the leading columns that contain them are converted to an array.
+    """
+    width, height = image.size
+    cols = min(width, -(-count // height))
+    arr = np.asarray(image.crop((0, 0, cols, height)))
+    return arr.transpose(1, 0, 2).reshape(cols * height, -1)[:count]
+
+
+def _bits_to_bytes(bits) -> bytes:
+    # 与原实现一致：最后不足 8 位的部分按其自身的位数转成一个字节，不在右侧补 0
+    full = len(bits) // 8 * 8
+    data = np.packbits(bits[:full]).tobytes()
+    if full < len(bits):
+        data += bytes([int(''.join(map(str, bits[full:].tolist())), 2)])
+    return data
+
+
+def _bits_to_int(bits) -> int:
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def read_info_from_image_stealth_np(image, fast_check=False):
+    """
+    NumPy version of read_info_from_image_stealth_py with the same output.
+    The RGB signature is checked at pixel 40, the alpha signature at pixel 120.
+    Returns None where the pure Python version fails without data.
+    """
+    width, height = image.size
+    total = width * height
+    has_alpha = image.mode == 'RGBA'
+    pixels = _stealth_pixels(image, min(total, STEALTH_SIG_BITS if has_alpha else STEALTH_SIG_BITS // 3))
+    mode = None
+    compressed = False
+    if len(pixels) >= STEALTH_SIG_BITS // 3:
+        sig = np.packbits(pixels[: STEALTH_SIG_BITS // 3, :3].reshape(-1) & 1).tobytes()
+        if sig in STEALTH_RGB_SIGS:
+            mode, compressed = 'rgb', STEALTH_RGB_SIGS[sig]
+    if mode is None and has_alpha and len(pixels) >= STEALTH_SIG_BITS:
+        sig = np.packbits(pixels[:STEALTH_SIG_BITS, 3] & 1).tobytes()
+        if sig in STEALTH_ALPHA_SIGS:
+            mode, compressed = 'alpha', STEALTH_ALPHA_SIGS[sig]
+    if fast_check:
+        return mode is not None
+    if mode is None:
+        return None
+
+    if mode == 'alpha':
+        start = STEALTH_SIG_BITS
+        if total < start + 32:
+            return None
+        param_len = _bits_to_int(_stealth_pixels(image, start + 32)[start:, 3] & 1)
+        # 原实现逐像素比较 index == param_len，长度为 0 或超出图片时读不到数据
+        if param_len == 0 or total < start + 32 + param_len:
+            return None
+        bits = _stealth_pixels(image, start + 32 + param_len)[start + 32 :, 3] & 1
+    else:
+        start = STEALTH_SIG_BITS // 3
+        if total < start + 11:
+            return None
+        param_len = _bits_to_int(_stealth_pixels(image, start + 11)[start:, :3].reshape(-1)[:32] & 1)
+        # 第 33 位属于数据，之后每个像素读 3 位，至少再读一个像素
+        data_pixels = max(1, -(-(param_len - 1) // 3))
+        if total < start + 11 + data_pixels:
+            return None
+        bits = (_stealth_pixels(image, start + 11 + data_pixels)[start:, :3].reshape(-1) & 1)[32 : 32 + param_len]
+    if len(bits) == 0:
+        return None
+    byte_data = _bits_to_bytes(bits)
+    try:
+        if compressed:
+            return gzip.decompress(byte_data).decode('utf-8')
+        return byte_data.decode('utf-8', errors='ignore')
+    except Exception:
+        return None
+
+
+# https://github.com/neggles/sd-webui-stealth-pnginfo/blob/main/scripts/stealth_pnginfo.py
+def read_info_from_image_stealth_py(image, fast_check=False):
     width, height = image.size
     pixels = image.load()
 
@@ -0,0 +1,293 @@
+"""
+Thumbnail and video cover generation off the event loop.
+
+Decoding and WebP encoding are CPU bound, when they ran inside the async /image-thumbnail handler
+a cold folder blocked every other request until the whole grid was rendered. They now run in a
+thread pool (a process pool with IIB_THUMBNAIL_PROCESSES=true), and at most `workers * 2` jobs are
+handed to it at a time, the remaining requests wait in the event loop without holding anything.
+
+Concurrent requests for the same cache file share one job, and cache files are written to a temp
+file and renamed into place, so a reader never gets a half written webp.
+"""
+import asyncio
+import io
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from scripts.iib.blob_store import blob_store
+from scripts.iib.logger import logger
+from scripts.iib.tool import get_process_pool_context
+
+
+def get_thumbnail_workers() -> int:
+    """
+    Number of threads (or processes with IIB_THUMBNAIL_PROCESSES) that generate thumbnails, 0 (default) means one per CPU.
+    """
+    try:
+        workers = int(os.getenv("IIB_THUMBNAIL_WORKERS", "0"))
+    except ValueError:
+        workers = 0
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+def is_thumbnail_processes_enabled():
+    return os.getenv("IIB_THUMBNAIL_PROCESSES", "false").lower() == "true"
+
+
+def atomic_write(file_path: str, write: Callable[[str], None]):
+    """
+    Calls write(tmp_path) and moves the result to file_path.
+    """
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def generate_thumbnail(path: str, cache_path: str, size: str):
+    with Image.open(path) as img:
+        w, h = size.split("x")
+        img.thumbnail((int(w), int(h)))
+        atomic_write(cache_path, lambda tmp_path: img.save(tmp_path, "webp"))
+
+
+def render_thumbnail(path: str, size: str) -> bytes:
+    """
+    Returns the webp bytes instead of writing a file, for the blob store.
+    """
+    with Image.open(path) as img:
+        w, h = size.split("x")
+        buf = io.BytesIO()
+        img.thumbnail((int(w), int(h)))
+        img.save(buf, "webp")
+        return buf.getvalue()
+
+
+def generate_thumbnails(path: str, targets: List[Tuple[str, Optional[str]]]) -> List[Tuple[str, Optional[bytes]]]:
+    """
+    Generates several sizes from a single decode, targets are (size, cache_path).
+    Thumbnails without a cache_path are returned as webp bytes for the blob store, the others are
+    written to their cache file and returned with None.
+    """
+    def area(size: str):
+        w, h = size.split("x")
+        return int(w) * int(h)
+
+    res = []
+    with Image.open(path) as img:
+        # 从大到小生成，第一次按最大的尺寸 draft 解码，后面的在上一张缩略图上继续缩小
+        for size, cache_path in sorted(targets, key=lambda x: area(x[0]), reverse=True):
+            w, h = size.split("x")
+            img.thumbnail((int(w), int(h)))
+            if cache_path:
+                atomic_write(cache_path, lambda tmp_path: img.save(tmp_path, "webp"))
+                res.append((size, None))
+            else:
+                buf = io.BytesIO()
+                img.save(buf, "webp")
+                res.append((size, buf.getvalue()))
+    return res
+
+
+# 视频封面只用作网格的背景图，和默认的缩略图一样大
+video_cover_max_size = (512, 512)
+
+
+def get_video_cover_position() -> Tuple[float, bool]:
+    """
+    IIB_VIDEO_COVER_POSITION is either seconds ("0.5") or a fraction of the duration ("10%").
+    Returns (value, is_fraction).
+    """
+    value = os.getenv("IIB_VIDEO_COVER_POSITION", "0.5").strip()
+    try:
+        if value.endswith("%"):
+            return float(value[:-1]) / 100, True
+        return float(value), False
+    except ValueError:
+        return 0.5, False
+
+
+def get_video_meta(container, stream) -> Dict:
+    import av
+
+    duration = None
+    if stream.duration and stream.time_base:
+        duration = float(stream.duration * stream.time_base)
+    elif container.duration:
+        duration = container.duration / av.time_base
+    return {
+        "duration": duration,
+        "width": stream.codec_context.width,
+        "height": stream.codec_context.height,
+        "codec": stream.codec_context.name,
+    }
+
+
+def probe_video(path: str) -> Dict:
+    """
+    Only reads the container header, nothing is decoded.
+    """
+    import av
+
+    with av.open(path) as container:
+        return get_video_meta(container, container.streams.video[0])
+
+
+def generate_video_cover(path: str, cache_path: str) -> Dict:
+    """
+    Seeks to the keyframe at or before IIB_VIDEO_COVER_POSITION and decodes that single frame,
+    instead of decoding every frame from the start. Returns the metadata from probe_video.
+    """
+    import av
+
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        meta = get_video_meta(container, stream)
+        position, is_fraction = get_video_cover_position()
+        if is_fraction:
+            position *= meta["duration"] or 0
+        if position > 0 and stream.time_base:
+            try:
+                container.seek(int(position / stream.time_base), stream=stream, backward=True)
+            except av.error.FFmpegError as e:
+                # 无法 seek 的流从头解码第一帧
+                logger.warning("failed to seek %s, using the first frame: %s", path, e)
+                container.seek(0)
+        frame = next(container.decode(stream), None)
+        if frame is None:
+            raise ValueError(f"no video frame found in {path}")
+        w, h = frame.width, frame.height
+        scale = min(video_cover_max_size[0] / w, video_cover_max_size[1] / h, 1)
+        img = frame.to_image(width=max(1, round(w * scale)), height=max(1, round(h * scale)))
+    atomic_write(cache_path, lambda tmp_path: img.save(tmp_path, "webp"))
+    return meta
+
+
+class ThumbnailPool:
+    """
+    Runs the jobs in a thread pool, PIL releases the GIL while decoding and encoding.
+    Worker processes are opt-in and fall back to threads when they can't be started or break, like ExifParserPool.
+    """
+
+    def __init__(self, workers: int, use_processes=False):
+        self.workers = workers
+        self.executor: Optional[Executor] = None
+        self.use_processes = use_processes
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        # cache_path -> 正在生成的任务
+        self.inflight: Dict[str, asyncio.Future] = {}
+
+    def get_executor(self) -> Executor:
+        if self.executor is None:
+            if self.use_processes:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=get_process_pool_context())
+            else:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="iib-thumbnail")
+        return self.executor
+
+    def _disable_processes(self, e: Exception):
+        logger.error("Thumbnail worker processes are unavailable, using threads instead. error: %s", e)
+        executor, self.executor = self.executor, None
+        self.use_processes = False
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _run(self, fn, *args):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.workers * 2)
+        async with self.semaphore:
+            loop = asyncio.get_running_loop()
+            if self.use_processes:
+                # 只有进程池本身的问题才降级，图片本身的错误照常抛出
+                try:
+                    future = loop.run_in_executor(self.get_executor(), fn, *args)
+                except Exception as e:
+                    self._disable_processes(e)
+                else:
+                    try:
+                        return await future
+                    except BrokenProcessPool as e:
+                        if self.use_processes:
+                            self._disable_processes(e)
+            return await loop.run_in_executor(self.get_executor(), fn, *args)
+
+    async def _run_once(
+        self,
+        key: str,
+        exists: Callable[[], bool],
+        job: Callable[[], Awaitable],
+        on_generated: Optional[Callable[[], None]] = None,
+    ):
+        """
+        Single flight per key (cache path or blob key): later callers await the job the first one started.
+        on_generated runs once after the job succeeded, not for every caller that awaited it.
+        """
+        task = self.inflight.get(key)
+        if task is None:
+            if exists():
+                return  # 刚被上一个任务生成
+
+            async def run():
+                res = await job()
+                if on_generated:
+                    on_generated()
+                return res
+
+            task = asyncio.ensure_future(run())
+            self.inflight[key] = task
+
+            def on_done(t: asyncio.Future):
+                if self.inflight.get(key) is t:
+                    del self.inflight[key]
+                if not t.cancelled():
+                    t.exception()  # 所有请求都断开时避免 "exception was never retrieved"
+
+            task.add_done_callback(on_done)
+        # 单个请求断开不应取消其他请求共享的任务
+        return await asyncio.shield(task)
+
+    async def generate(self, path: str, cache_path: str, size: str, on_generated: Optional[Callable[[], None]] = None):
+        return await self._run_once(
+            cache_path,
+            lambda: os.path.exists(cache_path),
+            lambda: self._run(generate_thumbnail, path, cache_path, size),
+            on_generated,
+        )
+
+    async def generate_blob(self, path: str, key: str, size: str, on_generated: Optional[Callable[[], None]] = None):
+        async def job():
+            data = await self._run(render_thumbnail, path, size)
+            await asyncio.to_thread(blob_store.put, key, data)
+
+        return await self._run_once(key, lambda: blob_store.contains(key), job, on_generated)
+
+    async def generate_video_cover(
+        self, path: str, cache_path: str, on_generated: Optional[Callable[[], None]] = None
+    ) -> Optional[Dict]:
+        """
+        Returns the video metadata, or None if the cover was generated by someone else in the meantime.
+        """
+        return await self._run_once(
+            cache_path,
+            lambda: os.path.exists(cache_path),
+            lambda: self._run(generate_video_cover, path, cache_path),
+            on_generated,
+        )
+
+
+thumbnail_pool = ThumbnailPool(get_thumbnail_workers(), is_thumbnail_processes_enabled())
@@ -1,6 +1,7 @@
 import ctypes
 from datetime import datetime
 import json
+import multiprocessing
 import os
 import platform
 import re
@@ -37,6 +38,17 @@ cwd = os.getcwd() if is_exe_ver else os.path.normpath(os.path.join(__file__, "..
 is_win = platform.system().lower().find("windows") != -1
 
 
+def get_process_pool_context():
+    """
+    Start method for worker process pools. Forking the server copies locks held by its other threads
+    (sqlite, cache flush, fs watcher) into the children, so workers come from a fork server where
+    there is one and are spawned otherwise. Frozen builds need multiprocessing.freeze_support() in app.py.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
 def normalize_output_lang(lang: Optional[str]) -> str:
     """
     Map frontend language keys to a human-readable instruction for LLM output language.
@@ -160,6 +172,54 @@ def to_abs_path(path):
     return os.path.normpath(path)
 
 
+def split_path(path: str) -> List[str]:
+    """
+    "/a/b" -> ["/", "a", "b"], "C:\\a\\b" -> ["C:\\", "a", "b"]
+    """
+    drive, rest = os.path.splitdrive(to_abs_path(path))
+    return [drive + os.sep] + [part for part in rest.split(os.sep) if part]
+
+
+class PathTrie:
+    """
+    Path component trie of a list of folders, answers whether a path is one of them, under one of
+    them or above one of them in O(depth) instead of comparing it with every folder.
+    """
+
+    end = ""  # 分割后的路径不会有空的部分
+
+    def __init__(self, paths: List[str]):
+        self.root: Dict[str, Dict] = {}
+        for path in paths:
+            node = self.root
+            for part in split_path(path):
+                node = node.setdefault(part, {})
+            node[self.end] = {}
+
+    def match(self, path: str) -> Optional[bool]:
+        """
+        True if path is one of the folders or inside one of them, False if it's a parent of one of
+        them, None otherwise.
+        """
+        node = self.root
+        for part in split_path(path):
+            node = node.get(part)
+            if node is None:
+                return None
+            if self.end in node:
+                return True
+        return False
+
+    def is_under(self, path: str) -> bool:
+        return self.match(path) is True
+
+    def is_related(self, path: str) -> bool:
+        """
+        Like is_under, but parents of the folders count too, they are needed to navigate to them.
+        """
+        return self.match(path) is not None
+
+
 def get_valid_img_dirs(
     conf,
     keys=sd_img_dirs,
@@ -410,6 +470,10 @@ def get_created_date_by_stat(stat: os.stat_result):
         is_st_birthtime_available = False
         return get_formatted_date(stat.st_ctime)
     
+def get_created_timestamp_by_stat(stat: os.stat_result) -> float:
+    birthtime = getattr(stat, "st_birthtime", None)
+    return stat.st_ctime if birthtime is None else birthtime
+
 def birthtime_sort_key_fn(x):
     stat = x.stat()
     global is_st_birthtime_available
@@ -434,6 +498,21 @@ def find(lst, comparator):
 def findIndex(lst, comparator):
     return next((i for i, item in enumerate(lst) if comparator(item)), -1)
 
+
+def get_seeded_random_key(id, seed):
+    """
+    A 32 bit hash of (id, seed), the same seed always shuffles ids in the same order.
+    Works on ints and on numpy uint64 arrays with the same result, it's also registered as the
+    sqlite function iib_random_key.
+    """
+    x = (id * 0x9E3779B1 + seed) & 0xFFFFFFFF
+    x ^= x >> 16
+    x = (x * 0x7FEB352D) & 0xFFFFFFFF
+    x ^= x >> 15
+    x = (x * 0x846CA68B) & 0xFFFFFFFF
+    x ^= x >> 16
+    return x
+
 def unquote(text):
     if len(text) == 0 or text[0] != '"' or text[-1] != '"':
         return text
@@ -15,7 +15,8 @@ import requests
 from fastapi import Depends, FastAPI, HTTPException
 from pydantic import BaseModel
 
-from scripts.iib.db.datamodel import DataBase, ImageEmbedding, ImageEmbeddingFail, TopicClusterCache, TopicTitleCache
+from scripts.iib.db.file_exists import filter_existing
+from scripts.iib.db.datamodel import DataBase, Dir, ImageEmbedding, ImageEmbeddingFail, TopicClusterCache, TopicTitleCache
 from scripts.iib.tool import cwd, accumulate_streaming_response
 from scripts.iib.logger import logger
 
@@ -847,15 +848,14 @@ def mount_topic_cluster_routes(
 
             # If embeddings didn't change and we have a cached clustering result, return it directly.
             conn = DataBase.get_conn()
-            like_prefixes = [os.path.join(f, "%") for f in folders]
+            where, folder_params = Dir.get_folder_filter_sql(folders)
             with closing(conn.cursor()) as cur:
-                where = " OR ".join(["image.path LIKE ?"] * len(like_prefixes))
                 cur.execute(
                     f"""SELECT COUNT(*), MAX(image_embedding.updated_at)
                         FROM image
                         INNER JOIN image_embedding ON image_embedding.image_id = image.id
-                        WHERE ({where}) AND image_embedding.model = ?""",
-                    (*like_prefixes, model),
+                        WHERE {where} AND image_embedding.model = ?""",
+                    (*folder_params, model),
                 )
                 row = cur.fetchone() or (0, "")
             embeddings_count = int(row[0] or 0)
@@ -965,15 +965,14 @@ def mount_topic_cluster_routes(
             raise HTTPException(status_code=400, detail=f"Folder not found: {folder}")
 
         conn = DataBase.get_conn()
-        like_prefix = os.path.join(folder, "%")
+        where, folder_params = Dir.get_folder_filter_sql([folder])
         with closing(conn.cursor()) as cur:
-            cur.execute("SELECT id, path, exif FROM image WHERE path LIKE ?", (like_prefix,))
+            cur.execute(f"SELECT id, path, exif FROM image WHERE {where}", folder_params)
             rows = cur.fetchall()
+        rows, _ = filter_existing(rows, lambda x: x[1], lambda x: x[0])
 
         images = []
         for image_id, path, exif in rows:
-            if not isinstance(path, str) or not os.path.exists(path):
-                continue
             text_raw = _extract_prompt_text(exif, max_chars=max_chars)
             if _PROMPT_NORMALIZE_ENABLED:
                 text = _clean_prompt_for_semantic(text_raw)
@@ -1265,15 +1264,14 @@ def mount_topic_cluster_routes(
         return {"folders_changed": False}
 
     def _embeddings_state(conn: Connection, folders: List[str], model: str) -> Dict:
-        like_prefixes = [os.path.join(f, "%") for f in folders]
+        where, folder_params = Dir.get_folder_filter_sql(folders)
         with closing(conn.cursor()) as cur:
-            where = " OR ".join(["image.path LIKE ?"] * len(like_prefixes))
             cur.execute(
                 f"""SELECT COUNT(*), MAX(image_embedding.updated_at)
                     FROM image
                     INNER JOIN image_embedding ON image_embedding.image_id = image.id
-                    WHERE ({where}) AND image_embedding.model = ?""",
-                (*like_prefixes, str(model)),
+                    WHERE {where} AND image_embedding.model = ?""",
+                (*folder_params, str(model)),
             )
             row = cur.fetchone() or (0, "")
         return {"embeddings_count": int(row[0] or 0), "embeddings_max_updated_at": str(row[1] or "")}
@@ -1414,22 +1412,20 @@ def mount_topic_cluster_routes(
             progress_cb({"stage": "clustering", "folder": folder, "folders": folders})
 
         conn = DataBase.get_conn()
-        like_prefixes = [os.path.join(f, "%") for f in folders]
+        where, folder_params = Dir.get_folder_filter_sql(folders)
         with closing(conn.cursor()) as cur:
-            where = " OR ".join(["image.path LIKE ?"] * len(like_prefixes))
             cur.execute(
                 f"""SELECT image.id, image.path, image.exif, image_embedding.vec
                     FROM image
                     INNER JOIN image_embedding ON image_embedding.image_id = image.id
-                    WHERE ({where}) AND image_embedding.model = ?""",
-                (*like_prefixes, model),
+                    WHERE {where} AND image_embedding.model = ?""",
+                (*folder_params, model),
             )
             rows = cur.fetchall()
+        rows, _ = filter_existing(rows, lambda x: x[1], lambda x: x[0])
 
         items = []
         for n, (image_id, path, exif, vec_blob) in enumerate(rows):
-            if not isinstance(path, str) or not os.path.exists(path):
-                continue
             if not vec_blob:
                 continue
             vec = _blob_to_vec_f32(vec_blob)
@@ -1765,17 +1761,17 @@ def mount_topic_cluster_routes(
             qv[i] *= qinv
 
         conn = DataBase.get_conn()
-        like_prefixes = [os.path.join(f, "%") for f in folders]
+        where, folder_params = Dir.get_folder_filter_sql(folders)
         with closing(conn.cursor()) as cur:
-            where = " OR ".join(["image.path LIKE ?"] * len(like_prefixes))
             cur.execute(
                 f"""SELECT image.id, image.path, image.exif, image_embedding.vec
                     FROM image
                     INNER JOIN image_embedding ON image_embedding.image_id = image.id
-                    WHERE ({where}) AND image_embedding.model = ?""",
-                (*like_prefixes, model),
+                    WHERE {where} AND image_embedding.model = ?""",
+                (*folder_params, model),
             )
             rows = cur.fetchall()
+        rows, _ = filter_existing(rows, lambda x: x[1], lambda x: x[0])
 
         # TopK by cosine similarity (brute force; MVP only)
         import heapq
@@ -1783,8 +1779,6 @@ def mount_topic_cluster_routes(
         heap: List[Tuple[float, Dict]] = []
         total = 0
         for image_id, path, exif, vec_blob in rows:
-            if not isinstance(path, str) or not os.path.exists(path):
-                continue
             if not vec_blob:
                 continue
             v = _blob_to_vec_f32(vec_blob)
@@ -1,16 +1,15 @@
-import hashlib
 import os
 from typing import List
-from scripts.iib.tool import get_formatted_date, get_cache_dir, is_video_file
+from scripts.iib.tool import get_formatted_date, is_video_file
 from concurrent.futures import ThreadPoolExecutor
 import time
+from scripts.iib.cache_manager import cache_manager, get_video_cover_cache_path
+from scripts.iib.thumbnail import generate_video_cover
+from scripts.iib.db.datamodel import DataBase, VideoMeta
 
 
 def generate_video_covers(dirs,verbose=False):
   start_time = time.time()
-  import imageio.v3 as iio
-  
-  cache_base_dir = get_cache_dir()
 
   def process_video(item):
     if item.is_dir():
@@ -25,23 +24,16 @@ def generate_video_covers(dirs,verbose=False):
       path = os.path.normpath(item.path)
       stat = item.stat()
       t = get_formatted_date(stat.st_mtime)
-      hash_dir = hashlib.md5((path + t).encode("utf-8")).hexdigest()
-      cache_dir = os.path.join(cache_base_dir, "iib_cache", "video_cover", hash_dir)
-      cache_path = os.path.join(cache_dir, "cover.webp")
+      _, cache_path = get_video_cover_cache_path(path, t)
 
       # 如果缓存文件存在，则直接返回该文件
       if os.path.exists(cache_path):
         print(f"Video cover already exists: {path}")
         return
 
-      frame = iio.imread(
-        path,
-        index=16,
-        plugin="pyav",
-      )
-
-      os.makedirs(cache_dir, exist_ok=True)
-      iio.imwrite(cache_path, frame, extension=".webp")
+      meta = generate_video_cover(path, cache_path)
+      cache_manager.add(cache_path, path, t, miss=False)
+      VideoMeta.save(DataBase.get_conn(), path, t, meta)
       verbose and print(f"Video cover generated: {path}")
     except Exception as e:
       print(f"Error generating video cover: {path}")
@@ -53,6 +45,7 @@ def generate_video_covers(dirs,verbose=False):
       for item in folder_listing:
         executor.submit(process_video, item)
 
+  cache_manager.flush()
   print("Video covers generated successfully.")
   end_time = time.time()
   execution_time = end_time - start_time
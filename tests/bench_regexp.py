@@ -0,0 +1,156 @@
+"""
+Benchmark and correctness check of the regexp search (find_by_substring with regexp) on a synthetic database.
+Not collected by pytest, run from the repository root:
+
+    python tests/bench_regexp.py --images 1000000
+
+Compares recompiling the pattern for every row (the old regexp function), the cached compiled
+pattern, and the cached pattern with the literal LIKE / FTS prefilter, then checks that the
+search returns the same images as Python's re.search over every row.
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+patterns = [
+    r"img12345\d",
+    r"out/7/3/img\d+",
+    r"prompt (cat|dog)",
+    r"steps: \d+",
+    r"seed: 4242\b",
+    r"sampler: (euler a|dpm)",
+]
+
+check_patterns = patterns + [
+    "masterpiece",
+    "(foo|bar)baz",
+    r"^/data/.*\.png$",
+    r"\bsteps\b",
+    "Ste+ps",
+    "img_1",
+    "out%",
+    r"\\",
+    "0_",
+    "1%",
+    "İ",
+    "ſeed",
+]
+
+words = ["cat", "dog", "masterpiece", "1girl", "landscape", "night", "city", "forest", "red", "blue"]
+
+
+def create_db(path: str, count: int):
+    from scripts.iib.db.datamodel import DataBase, ImageFts
+
+    conn = DataBase.get_conn()
+    rnd = random.Random(0)
+    batch = []
+    for i in range(count):
+        exif = "prompt {}\nNegative prompt: lowres\nSteps: 20, Sampler: {}, Seed: {}".format(
+            ", ".join(rnd.sample(words, 3)), rnd.choice(["Euler a", "DPM++ 2M", "DDIM"]), i
+        )
+        date = "2024-01-01 00:00:00" if i % 2 else "2024-06-01 12:00:00"
+        batch.append((f"/data/out/{i % 10}/{i // 10 % 10}/img{i}.png", exif, 1000, date))
+        if len(batch) == 10000:
+            conn.executemany("INSERT INTO image (path, exif, size, date) VALUES (?, ?, ?, ?)", batch)
+            batch = []
+    conn.executemany("INSERT INTO image (path, exif, size, date) VALUES (?, ?, ?, ?)", batch)
+    conn.commit()
+    ImageFts.rebuild(conn)
+
+
+def search(pattern: str, limit=500, path_only=False):
+    from scripts.iib.db.datamodel import DataBase, Image
+
+    return [img.id for img in Image.find_by_substring(DataBase.get_conn(), "", limit, regexp=pattern, path_only=path_only)[0]]
+
+
+def bench():
+    import scripts.iib.db.datamodel as datamodel
+
+    conn = datamodel.DataBase.get_conn()
+    get_regexp_literal = datamodel.get_regexp_literal
+
+    def recompile_regexp(expr, item):
+        if not isinstance(item, str):
+            return False
+        return re.compile(expr, flags=re.IGNORECASE | re.MULTILINE | re.DOTALL).search(item) is not None
+
+    def cached_regexp(expr, item):
+        if not isinstance(item, str):
+            return False
+        return datamodel.compile_regexp(expr).search(item) is not None
+
+    def timed(pattern):
+        t = time.time()
+        ids = search(pattern)
+        return time.time() - t, ids
+
+    print("%-26s %7s %9s %9s %16s" % ("pattern", "results", "recompile", "cached", "cached+literal"))
+    for pattern in patterns:
+        # 不提取字面量就是原来的查询
+        datamodel.get_regexp_literal = lambda expr: ""
+        conn.create_function("regexp", 2, recompile_regexp)
+        t_old, old = timed(pattern)
+        conn.create_function("regexp", 2, cached_regexp)
+        t_cached, cached = timed(pattern)
+        datamodel.get_regexp_literal = get_regexp_literal
+        t_new, new = timed(pattern)
+        assert old == cached == new, pattern
+        print("%-26s %7d %8.2fs %8.2fs %15.3fs" % (pattern, len(new), t_old, t_cached, t_new))
+
+
+def check():
+    from scripts.iib.db.datamodel import DataBase
+
+    rows = DataBase.get_conn().execute("SELECT id, path, exif FROM image").fetchall()
+    bad = 0
+    for pattern in check_patterns:
+        expr = re.compile(pattern, re.IGNORECASE | re.MULTILINE | re.DOTALL)
+        for path_only in (False, True):
+            got = sorted(search(pattern, 10**9, path_only))
+            expected = sorted(
+                id for id, path, exif in rows if expr.search(path) or (not path_only and exif and expr.search(exif))
+            )
+            if got != expected:
+                bad += 1
+                print("MISMATCH", pattern, "path_only" if path_only else "", len(got), len(expected))
+    print(len(check_patterns), "patterns checked against re.search,", bad, "mismatches")
+    return bad
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=1000000)
+    parser.add_argument("--check-images", type=int, default=20000, help="size of the database used for the correctness check")
+    parser.add_argument("--db", help="reuse this database instead of creating a temporary one")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    db_path = args.db or os.path.join(tmp, "bench.db")
+    exists = os.path.exists(db_path)
+    os.environ["IIB_DB_PATH"] = db_path
+    import scripts.iib.db.datamodel as datamodel
+
+    # 合成的数据没有对应的文件，跳过文件存在检查
+    datamodel.filter_existing = lambda items, get_path, get_id: (items, [])
+    if not exists:
+        t = time.time()
+        create_db(db_path, args.images)
+        print("created %d images in %.1fs" % (args.images, time.time() - t))
+    bench()
+
+    datamodel.DataBase.path = os.path.join(tmp, "check.db")
+    del datamodel.DataBase.local.conn
+    create_db(datamodel.DataBase.path, args.check_images)
+    sys.exit(1 if check() else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+The NumPy stealth pnginfo decoder must return exactly what the original pure Python one does.
+Run from the repository root: python -m pytest tests
+"""
+import gzip
+import random
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from scripts.iib.parsers.sd_webui_stealth import (
+    read_info_from_image_stealth_np,
+    read_info_from_image_stealth_py,
+)
+
+TEXT = "masterpiece, 1girl, 中文提示词\nNegative prompt: lowres\nSteps: 20, Sampler: Euler a, Seed: 42"
+
+
+def to_bits(data: bytes) -> str:
+    return "".join(format(b, "08b") for b in data)
+
+
+def add_stealth_info(img: Image.Image, text: str, mode: str, compressed: bool, bit_len=None) -> Image.Image:
+    """
+    Same layout as the sd-webui-stealth-pnginfo encoder: signature, 32 bit length, data,
+    written to the lowest bit of alpha or of r, g, b, column by column.
+    """
+    if mode == "alpha":
+        sig = "stealth_pngcomp" if compressed else "stealth_pnginfo"
+    else:
+        sig = "stealth_rgbcomp" if compressed else "stealth_rgbinfo"
+    data = gzip.compress(text.encode("utf-8")) if compressed else text.encode("utf-8")
+    data_bits = to_bits(data)
+    if bit_len is None:
+        bit_len = len(data_bits)
+    bits = to_bits(sig.encode()) + format(bit_len, "032b") + data_bits
+    img = img.copy()
+    pixels = img.load()
+    width, height = img.size
+    step = 1 if mode == "alpha" else 3
+    index = 0
+    for x in range(width):
+        for y in range(height):
+            if index >= len(bits):
+                return img
+            px = list(pixels[x, y])
+            if mode == "alpha":
+                px[3] = (px[3] & ~1) | int(bits[index])
+            else:
+                for c, bit in enumerate(bits[index : index + 3]):
+                    px[c] = (px[c] & ~1) | int(bit)
+            pixels[x, y] = tuple(px)
+            index += step
+    return img
+
+
+def noise_image(size, mode: str, seed=0) -> Image.Image:
+    rng = np.random.default_rng(seed)
+    channels = 4 if mode == "RGBA" else 3
+    arr = rng.integers(0, 256, (size[1], size[0], channels), dtype=np.uint8)
+    return Image.fromarray(arr, mode)
+
+
+def read_py(img: Image.Image, fast_check=False):
+    try:
+        return read_info_from_image_stealth_py(img, fast_check)
+    except UnboundLocalError:
+        # 原实现在没有读到数据时直接抛出，NumPy 版本返回 None
+        return None
+
+
+def assert_same(img: Image.Image):
+    expected = read_py(img)
+    assert read_info_from_image_stealth_np(img) == expected
+    assert bool(read_info_from_image_stealth_np(img, True)) == bool(read_py(img, True))
+    return expected
+
+
+@pytest.mark.parametrize("compressed", [False, True])
+@pytest.mark.parametrize(
+    "image_mode, mode",
+    [("RGBA", "alpha"), ("RGBA", "rgb"), ("RGB", "rgb")],
+)
+@pytest.mark.parametrize("size", [(64, 64), (7, 300), (300, 7)])
+def test_roundtrip(image_mode, mode, compressed, size):
+    img = add_stealth_info(noise_image(size, image_mode), TEXT, mode, compressed)
+    assert assert_same(img) == TEXT
+
+
+@pytest.mark.parametrize("mode", ["alpha", "rgb"])
+@pytest.mark.parametrize("trim", [1, 3, 5])
+def test_partial_last_byte(mode, trim):
+    data_len = len(TEXT.encode("utf-8")) * 8
+    img = add_stealth_info(noise_image((64, 64), "RGBA"), TEXT, mode, False, data_len - trim)
+    assert_same(img)
+
+
+@pytest.mark.parametrize("mode", ["alpha", "rgb"])
+def test_length_beyond_image(mode):
+    img = add_stealth_info(noise_image((16, 16), "RGBA"), "x", mode, False, 10**6)
+    assert assert_same(img) is None
+
+
+@pytest.mark.parametrize("mode", ["alpha", "rgb"])
+def test_zero_length(mode):
+    img = add_stealth_info(noise_image((16, 16), "RGBA"), "", mode, False)
+    assert_same(img)
+
+
+@pytest.mark.parametrize("mode", ["alpha", "rgb"])
+def test_broken_gzip(mode):
+    img = add_stealth_info(noise_image((64, 64), "RGBA"), TEXT, mode, True)
+    arr = np.array(img)
+    # 翻转压缩数据中间的几位
+    arr[20:30, 5, :] ^= 1
+    assert assert_same(Image.fromarray(arr, "RGBA")) is None
+
+
+@pytest.mark.parametrize("image_mode", ["RGB", "RGBA"])
+@pytest.mark.parametrize("seed", range(5))
+def test_no_signature(image_mode, seed):
+    assert assert_same(noise_image((32, 32), image_mode, seed)) is None
+
+
+@pytest.mark.parametrize("image_mode", ["RGB", "RGBA"])
+def test_tiny_image(image_mode):
+    assert assert_same(noise_image((3, 3), image_mode)) is None
+
+
+def test_random_texts():
+    rnd = random.Random(0)
+    for _ in range(20):
+        text = "".join(rnd.choice("abc, :\n中文é") for _ in range(rnd.randint(1, 100)))
+        mode = rnd.choice(["alpha", "rgb"])
+        compressed = rnd.random() < 0.5
+        img = add_stealth_info(noise_image((rnd.randint(60, 120), rnd.randint(60, 120)), "RGBA"), text, mode, compressed)
+        assert assert_same(img) == text